@@ -0,0 +1,41 @@
+"""
+Loading of the function app with local containers
+
+The Functions host imports the function app as the package '__app__', so the functions import each other relatively.
+load_app() does the same, and points the containers of utils.helpers at local folders. The environment, e.g.
+HARMONY_API and TMPDIR, is read by the constants when the app is loaded, so it has to be set before.
+"""
+
+import importlib
+import os
+import sys
+import types
+
+from .fakes import AsyncLocalContainerClient
+from .fakes import LocalContainerClient
+
+# The root of the function app
+app_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app(containers_root: str):
+    """Load the function app as the package '__app__', with the containers stored under a local folder"""
+
+    package = types.ModuleType("__app__")
+    package.__path__ = [app_root]
+    sys.modules["__app__"] = package
+
+    containers = {}
+
+    def get_container(name: str) -> LocalContainerClient:
+        if name not in containers:
+            containers[name] = LocalContainerClient(os.path.join(containers_root, name))
+        return containers[name]
+
+    helpers = importlib.import_module("__app__.utils.helpers")
+    helpers.get_container_harmonycache = lambda: get_container("harmonycache")
+    helpers.get_container_harmonycache_async = lambda: AsyncLocalContainerClient(
+        get_container("harmonycache")
+    )
+    helpers.get_container_mhc = lambda: get_container("mhc")
+    helpers.get_container_web = lambda: get_container("$web")
@@ -0,0 +1,285 @@
+"""
+Local stand-ins for Azure Blob Storage and Harmony API
+
+LocalContainerClient keeps the blobs of a container as files under a local folder, so a seeded cache of a million
+vectors isn't held in memory, and a seed can be reused by hard-linking its files. It implements the part of
+azure.storage.blob.ContainerClient the functions use, including the overwrite and ETag conditions of uploads.
+
+The fake Harmony API is a local aiohttp server, run in a process of its own so it doesn't share the GIL with the
+functions, that returns deterministic vectors and instruments:
+
+- POST /text/vectors returns the vector of each text, seeded by the hash of the text (see get_vector)
+- POST /text/parse returns the instruments of each file, whose content is a base64 JSON description of the file
+  (see get_file_content)
+- GET /stats returns the numbers of calls and items the API got so far
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import types
+from typing import Iterator
+
+import numpy as np
+from aiohttp import web
+from azure.core.exceptions import ResourceExistsError
+from azure.core.exceptions import ResourceModifiedError
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+
+
+def get_etag(path: str) -> str:
+    """Get the ETag of a blob file, which changes whenever the file is replaced"""
+
+    stat = os.stat(path)
+
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+class _Downloader:
+    """The part of StorageStreamDownloader the functions use"""
+
+    def __init__(self, path: str, offset: int | None, length: int | None):
+        self._path = path
+        self._offset = offset or 0
+        self._length = length
+        self.properties = types.SimpleNamespace(etag=get_etag(path))
+
+    def readall(self) -> bytes:
+        with open(self._path, "rb") as file:
+            file.seek(self._offset)
+            return file.read(-1 if self._length is None else self._length)
+
+    def readinto(self, stream) -> int:
+        with open(self._path, "rb") as file:
+            file.seek(self._offset)
+            if self._length is None:
+                shutil.copyfileobj(file, stream)
+            else:
+                stream.write(file.read(self._length))
+            return file.tell() - self._offset
+
+
+class _BlobClient:
+    """The part of BlobClient the functions use"""
+
+    def __init__(self, container: "LocalContainerClient", blob: str):
+        self._path = container.get_path(blob)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self._path)
+
+    def get_blob_properties(self):
+        if not self.exists():
+            raise ResourceNotFoundError("The specified blob does not exist")
+
+        return types.SimpleNamespace(
+            etag=get_etag(self._path), size=os.path.getsize(self._path)
+        )
+
+
+class LocalContainerClient:
+    """A container of blobs stored as files under a local folder"""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def get_path(self, blob: str) -> str:
+        return os.path.join(self.root, *blob.split("/"))
+
+    def download_blob(
+        self, blob: str, offset: int | None = None, length: int | None = None, **kwargs
+    ) -> _Downloader:
+        path = self.get_path(blob)
+        if not os.path.isfile(path):
+            raise ResourceNotFoundError("The specified blob does not exist")
+
+        return _Downloader(path, offset, length)
+
+    def upload_blob(
+        self,
+        name: str,
+        data,
+        overwrite: bool = False,
+        etag: str | None = None,
+        match_condition: MatchConditions | None = None,
+        **kwargs,
+    ):
+        path = self.get_path(name)
+        if etag is not None and match_condition == MatchConditions.IfNotModified:
+            if not os.path.isfile(path) or get_etag(path) != etag:
+                raise ResourceModifiedError("The condition specified was not met")
+        elif not overwrite and os.path.isfile(path):
+            raise ResourceExistsError("The specified blob already exists")
+
+        # Blobs are replaced, never written in place, so hard-linked seeds aren't changed
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, partial_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(file_descriptor, "wb") as file:
+            if isinstance(data, str):
+                file.write(data.encode())
+            elif hasattr(data, "read"):
+                shutil.copyfileobj(data, file)
+            else:
+                file.write(data)
+        os.replace(partial_path, path)
+
+    def delete_blob(self, blob: str, **kwargs):
+        path = self.get_path(blob)
+        if not os.path.isfile(path):
+            raise ResourceNotFoundError("The specified blob does not exist")
+        os.remove(path)
+
+    def list_blobs(self, name_starts_with: str | None = None, **kwargs) -> Iterator:
+        names = []
+        for folder, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.startswith("tmp"):
+                    continue
+                path = os.path.join(folder, file_name)
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if name_starts_with is None or name.startswith(name_starts_with):
+                    names.append(name)
+
+        for name in sorted(names):
+            path = self.get_path(name)
+            yield types.SimpleNamespace(
+                name=name,
+                size=os.path.getsize(path),
+                etag=get_etag(path),
+                metadata=None,
+            )
+
+    def get_blob_client(self, blob: str) -> _BlobClient:
+        return _BlobClient(self, blob)
+
+
+class AsyncLocalContainerClient:
+    """The part of the async ContainerClient the functions use, on top of a LocalContainerClient"""
+
+    def __init__(self, container: LocalContainerClient):
+        self._container = container
+
+    async def __aenter__(self) -> "AsyncLocalContainerClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def upload_blob(self, name: str, data, **kwargs):
+        await asyncio.to_thread(self._container.upload_blob, name, data, **kwargs)
+
+
+def copy_container(source_root: str, target_root: str):
+    """Copy a container by hard-linking its blob files, so a seed is reused without copying its data"""
+
+    shutil.copytree(source_root, target_root, copy_function=os.link, dirs_exist_ok=True)
+
+
+def get_vector(text: str, dim: int) -> list[float]:
+    """Get the deterministic vector of a text"""
+
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+
+    return np.random.default_rng(seed).standard_normal(dim, dtype=np.float32).tolist()
+
+
+def get_file_content(name: str, n_instruments: int, n_questions: int) -> str:
+    """Get the content of a fake file, which the fake Harmony API parses into n_instruments of n_questions each"""
+
+    description = json.dumps(
+        {"name": name, "instruments": n_instruments, "questions": n_questions}
+    )
+
+    return (
+        "data:application/json;base64,"
+        + base64.b64encode(description.encode()).decode()
+    )
+
+
+def parse_file(file: dict) -> list[dict]:
+    """Get the instruments of a fake file"""
+
+    description = json.loads(base64.b64decode(file["content"].split(",", 1)[-1]))
+
+    return [
+        {
+            "file_id": file.get("file_id"),
+            "instrument_id": f"{description['name']}-{i}",
+            "instrument_name": f"{description['name']} sheet {i}",
+            "language": "en",
+            "questions": [
+                {
+                    "question_no": str(j + 1),
+                    "question_text": f"{description['name']} sheet {i} question {j}",
+                }
+                for j in range(description["questions"])
+            ],
+        }
+        for i in range(description["instruments"])
+    ]
+
+
+def create_harmony_api(dim: int, latency_seconds: float = 0.0) -> web.Application:
+    """Create the fake Harmony API"""
+
+    counts = {
+        "vectors_calls": 0,
+        "vectors_texts": 0,
+        "parse_calls": 0,
+        "parse_files": 0,
+    }
+
+    async def vectors(request: web.Request) -> web.Response:
+        texts = await request.json()
+        counts["vectors_calls"] += 1
+        counts["vectors_texts"] += len(texts)
+        await asyncio.sleep(latency_seconds)
+        return web.json_response([get_vector(text, dim) for text in texts])
+
+    async def parse(request: web.Request) -> web.Response:
+        files = await request.json()
+        counts["parse_calls"] += 1
+        counts["parse_files"] += len(files)
+        await asyncio.sleep(latency_seconds)
+        return web.json_response(
+            [instrument for file in files for instrument in parse_file(file)]
+        )
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(counts)
+
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post("/text/vectors", vectors)
+    app.router.add_post("/text/parse", parse)
+    app.router.add_get("/stats", stats)
+
+    return app
+
+
+async def serve_harmony_api(dim: int, latency_seconds: float, host: str = "127.0.0.1"):
+    """Serve the fake Harmony API on a free port, and print its URL once it is listening"""
+
+    runner = web.AppRunner(create_harmony_api(dim, latency_seconds), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    print(f"http://{host}:{port}", flush=True)
+
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the fake Harmony API")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(serve_harmony_api(dim=args.dim, latency_seconds=args.latency_ms / 1000))
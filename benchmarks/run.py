@@ -0,0 +1,528 @@
+"""
+Offline benchmarks of /api/match, /api/parse and /api/cache
+
+Runs a sweep of synthetic workloads end to end against local containers and a fake Harmony API, see benchmarks.fakes,
+and reports the results as JSON:
+
+    python -m benchmarks.run --workloads match,parse --hit-ratios 0,0.9 --vectors-cache-sizes 1000,1000000
+
+Each seed is written once per work dir, and each scenario runs in a process of its own on a hard-linked copy of its
+seeds, so scenarios don't share caches and the peak RSS of a scenario is its own. The configuration of the app, e.g.
+CACHE_DISK_TIER, is read from the environment as usual, and the settings that are set are included in the report.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy as np
+
+from . import workloads
+from .app import app_root
+from .app import load_app
+from .fakes import LocalContainerClient
+from .fakes import copy_container
+
+# The latency percentiles that are reported
+percentiles = [50, 90, 95, 99]
+
+
+def get_peak_rss_bytes() -> int:
+    """Get the peak resident set size of the process"""
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def get_latency_stats(latencies: list[float]) -> dict:
+    """Get the percentiles, mean and max of latencies in seconds, in milliseconds"""
+
+    if not latencies:
+        return {}
+
+    latencies_ms = np.array(latencies) * 1000
+
+    return {
+        **{
+            f"p{percentile}": float(np.percentile(latencies_ms, percentile))
+            for percentile in percentiles
+        },
+        "mean": float(latencies_ms.mean()),
+        "max": float(latencies_ms.max()),
+    }
+
+
+def get_upstream_stats() -> dict:
+    """Get the numbers of calls and items the fake Harmony API got so far"""
+
+    with urllib.request.urlopen(f"{os.environ['HARMONY_API']}/stats") as response:
+        return json.loads(response.read())
+
+
+def make_request(method: str, body=None, params: dict | None = None):
+    """Make the HttpRequest of a function"""
+
+    from azure.functions import HttpRequest
+
+    return HttpRequest(
+        method=method,
+        url="http://localhost/api",
+        body=json.dumps(body).encode() if body is not None else b"",
+        params=params or {},
+    )
+
+
+async def send_requests(
+    main, requests: list, concurrency: int
+) -> tuple[list, list, float]:
+    """
+    Send requests to an async function, at most concurrency at a time
+    :return: the latency and the response of each request, and the wall time until the last response
+    """
+
+    from __app__.utils import harmony_api
+    from __app__.utils import helpers
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = [0.0] * len(requests)
+    responses = [None] * len(requests)
+
+    async def send(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            responses[i] = await main(requests[i])
+            latencies[i] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(len(requests))))
+    wall_seconds = time.perf_counter() - started
+
+    # The cache entries are saved in the background after the responses
+    while helpers._background_tasks:
+        await asyncio.gather(*helpers._background_tasks)
+
+    # The session of the event loop is shared by all requests, it is only closed with the loop
+    session = harmony_api._async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+    return latencies, responses, wall_seconds
+
+
+def run_scenario(spec: dict) -> dict:
+    """Run a scenario in this process, on the containers of its work dir"""
+
+    load_app(os.path.join(spec["work_dir"], "containers"))
+    from __app__.utils import caches
+    from __app__.utils import mhc
+
+    workload = spec["workload"]
+    started = time.perf_counter()
+    function = importlib.import_module(f"__app__.{workload}")
+    if workload in ["match", "cache"]:
+        caches.get_vectors_cache()
+    if workload in ["parse", "cache"]:
+        caches.get_instruments_cache()
+    if workload == "match":
+        mhc.get_mhc_embeddings()
+    cold_start_seconds = time.perf_counter() - started
+    peak_rss_bytes_cold_start = get_peak_rss_bytes()
+    upstream_stats = get_upstream_stats()
+
+    if workload == "cache":
+        latencies, responses = [], []
+        cursor = None
+        started = time.perf_counter()
+        for _ in range(spec["requests"]):
+            params = {"format": "ndjson", "limit": str(spec["page_size"])}
+            if cursor is not None:
+                params["cursor"] = cursor
+            request_started = time.perf_counter()
+            response = function.main(make_request("GET", params=params))
+            latencies.append(time.perf_counter() - request_started)
+            responses.append(response)
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        wall_seconds = time.perf_counter() - started
+    else:
+        if workload == "match":
+            bodies = workloads.iter_match_bodies(
+                n_requests=spec["requests"],
+                n_instruments=spec["instruments"],
+                n_questions=spec["questions"],
+                hit_ratio=spec["hit_ratio"],
+                pool_size=spec["pool_size"],
+                seed=spec["seed"],
+            )
+        else:
+            bodies = workloads.iter_parse_bodies(
+                n_requests=spec["requests"],
+                n_files=spec["files"],
+                n_instruments=spec["instruments"],
+                n_questions=spec["questions"],
+                hit_ratio=spec["hit_ratio"],
+                pool_size=spec["pool_size"],
+                seed=spec["seed"],
+            )
+        requests = [make_request("POST", body) for body in bodies]
+        latencies, responses, wall_seconds = asyncio.run(
+            send_requests(function.main, requests, spec["concurrency"])
+        )
+
+    return {
+        **{key: value for key, value in spec.items() if key != "work_dir"},
+        "requests": len(latencies),
+        "errors": sum(response.status_code != 200 for response in responses),
+        "latency_ms": get_latency_stats(latencies),
+        "throughput_rps": len(latencies) / wall_seconds if wall_seconds > 0 else None,
+        "response_bytes_mean": (
+            float(np.mean([len(response.get_body()) for response in responses]))
+            if responses
+            else None
+        ),
+        "upstream": {
+            name: count - upstream_stats[name]
+            for name, count in get_upstream_stats().items()
+        },
+        "cold_start_seconds": cold_start_seconds,
+        "peak_rss_bytes_cold_start": peak_rss_bytes_cold_start,
+        "peak_rss_bytes": get_peak_rss_bytes(),
+    }
+
+
+def write_seed(spec: dict):
+    """Write a seed in this process, to the containers of its work dir"""
+
+    from . import seeds
+
+    containers_root = os.path.join(spec["work_dir"], "containers")
+    load_app(containers_root)
+    container = LocalContainerClient(os.path.join(containers_root, "harmonycache"))
+
+    if spec["kind"] == "vectors":
+        seeds.seed_vectors(
+            container=container,
+            n_entries=spec["cache_size"],
+            pool_size=spec["pool_size"],
+            dim=spec["dim"],
+        )
+        seeds.seed_mhc(
+            container=LocalContainerClient(os.path.join(containers_root, "mhc")),
+            n_questions=spec["mhc_size"],
+            dim=spec["dim"],
+        )
+    else:
+        seeds.seed_instruments(
+            container=container,
+            n_entries=spec["cache_size"],
+            pool_size=spec["pool_size"],
+            n_instruments=spec["instruments"],
+            n_questions=spec["questions"],
+        )
+
+
+def run_in_process(option: str, spec: dict, env: dict | None = None) -> str:
+    """Run a seed or a scenario in a process of its own, and get its output"""
+
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", option, json.dumps(spec)],
+        cwd=app_root,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+
+    return result.stdout
+
+
+def get_seed(work_dir: str, spec: dict) -> str:
+    """Get the work dir of a seed, the seed is written if it wasn't written before"""
+
+    spec_hash = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[
+        :12
+    ]
+    seed_dir = os.path.join(
+        work_dir, "seeds", f"{spec['kind']}-{spec['cache_size']}-{spec_hash}"
+    )
+    if not os.path.isdir(seed_dir):
+        logging.info(f"Seeding {spec['kind']} cache of {spec['cache_size']} entries")
+        partial_dir = f"{seed_dir}.partial"
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        run_in_process("--seed", {**spec, "work_dir": partial_dir})
+        os.rename(partial_dir, seed_dir)
+
+    return seed_dir
+
+
+def iter_scenarios(args: argparse.Namespace):
+    """Iterate over (scenario spec, seed specs) of the sweep"""
+
+    for workload in args.workloads:
+        if workload == "match":
+            for cache_size in args.vectors_cache_sizes:
+                pool_size = min(cache_size // 2, args.pool_size)
+                seed = {
+                    "kind": "vectors",
+                    "cache_size": cache_size,
+                    "pool_size": pool_size,
+                    "dim": args.dim,
+                    "mhc_size": args.mhc_size,
+                }
+                for hit_ratio in args.hit_ratios:
+                    yield {
+                        "workload": workload,
+                        "cache_size": cache_size,
+                        "hit_ratio": hit_ratio,
+                        "instruments": args.instruments,
+                        "questions": args.questions,
+                        "pool_size": pool_size,
+                    }, [seed]
+        elif workload == "parse":
+            for cache_size in args.instruments_cache_sizes:
+                pool_size = min(cache_size, args.pool_size)
+                seed = {
+                    "kind": "instruments",
+                    "cache_size": cache_size,
+                    "pool_size": pool_size,
+                    "instruments": args.sheets,
+                    "questions": args.questions,
+                }
+                for hit_ratio in args.hit_ratios:
+                    yield {
+                        "workload": workload,
+                        "cache_size": cache_size,
+                        "hit_ratio": hit_ratio,
+                        "files": args.files,
+                        "instruments": args.sheets,
+                        "questions": args.questions,
+                        "pool_size": pool_size,
+                    }, [seed]
+        else:
+            for vectors_cache_size, instruments_cache_size in zip(
+                args.vectors_cache_sizes, args.instruments_cache_sizes
+            ):
+                yield {
+                    "workload": workload,
+                    "cache_size": vectors_cache_size + instruments_cache_size,
+                    "page_size": args.page_size,
+                }, [
+                    {
+                        "kind": "vectors",
+                        "cache_size": vectors_cache_size,
+                        "pool_size": min(vectors_cache_size // 2, args.pool_size),
+                        "dim": args.dim,
+                        "mhc_size": args.mhc_size,
+                    },
+                    {
+                        "kind": "instruments",
+                        "cache_size": instruments_cache_size,
+                        "pool_size": min(instruments_cache_size, args.pool_size),
+                        "instruments": args.sheets,
+                        "questions": args.questions,
+                    },
+                ]
+
+
+def run_sweep(args: argparse.Namespace) -> dict:
+    """Run the scenarios of the sweep against a fake Harmony API"""
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="harmonycache-benchmarks-")
+    harmony_api = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fakes",
+            "--dim",
+            str(args.dim),
+            "--latency-ms",
+            str(args.upstream_latency_ms),
+        ],
+        cwd=app_root,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    harmony_api_url = harmony_api.stdout.readline().strip()
+
+    results = []
+    try:
+        for i, (scenario, seed_specs) in enumerate(iter_scenarios(args)):
+            scenario = {
+                **scenario,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "dim": args.dim,
+                "seed": i,
+            }
+            seed_dirs = [get_seed(work_dir, seed_spec) for seed_spec in seed_specs]
+
+            scenario_dir = os.path.join(work_dir, "scenarios", str(i))
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+            for seed_dir in seed_dirs:
+                for container_name in os.listdir(os.path.join(seed_dir, "containers")):
+                    copy_container(
+                        os.path.join(seed_dir, "containers", container_name),
+                        os.path.join(scenario_dir, "containers", container_name),
+                    )
+            os.makedirs(os.path.join(scenario_dir, "tmp"))
+
+            logging.info(f"Running {json.dumps(scenario)}")
+            output = run_in_process(
+                "--scenario",
+                {**scenario, "work_dir": scenario_dir},
+                env={
+                    "HARMONY_API": harmony_api_url,
+                    "TMPDIR": os.path.join(scenario_dir, "tmp"),
+                },
+            )
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+    finally:
+        harmony_api.terminate()
+        harmony_api.wait()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": get_settings(),
+        },
+        "options": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ["seed", "scenario", "output"]
+        },
+        "results": results,
+    }
+
+
+def get_settings() -> dict:
+    """Get the settings of the app that are set in the environment, without secrets"""
+
+    with open(os.path.join(app_root, "constants.py")) as file:
+        constants_source = file.read()
+
+    return {
+        name: value
+        for name, value in sorted(os.environ.items())
+        if f'"{name}"' in constants_source
+        and not any(secret in name for secret in ["CONNECTION_STRING", "KEY", "SECRET"])
+    }
+
+
+def parse_list(cast):
+    return lambda value: [cast(item) for item in value.split(",") if item]
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--workloads", type=parse_list(str), default=["match", "parse", "cache"]
+    )
+    parser.add_argument(
+        "--hit-ratios", type=parse_list(float), default=[0.0, 0.5, 0.9, 1.0]
+    )
+    parser.add_argument(
+        "--vectors-cache-sizes",
+        type=parse_list(int),
+        default=[1000, 10000, 100000],
+        help="the numbers of entries the vectors cache is seeded with, e.g. up to 1000000",
+    )
+    parser.add_argument(
+        "--instruments-cache-sizes",
+        type=parse_list(int),
+        default=[1000, 10000, 100000],
+        help="the numbers of files the instruments cache is seeded with",
+    )
+    parser.add_argument(
+        "--instruments", type=int, default=4, help="instruments per /api/match request"
+    )
+    parser.add_argument(
+        "--questions", type=int, default=25, help="questions per instrument"
+    )
+    parser.add_argument(
+        "--files", type=int, default=4, help="files per /api/parse request"
+    )
+    parser.add_argument("--sheets", type=int, default=2, help="instruments per file")
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=10000,
+        help="the most cache entries requests hit",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=20,
+        help="requests (or /api/cache pages) per scenario",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="requests sent at a time"
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=1000, help="items per /api/cache page"
+    )
+    parser.add_argument(
+        "--dim", type=int, default=384, help="the dimension of the vectors"
+    )
+    parser.add_argument(
+        "--mhc-size", type=int, default=1000, help="questions of the MHC corpus"
+    )
+    parser.add_argument(
+        "--upstream-latency-ms",
+        type=float,
+        default=0.0,
+        help="latency of the fake Harmony API",
+    )
+    parser.add_argument(
+        "--work-dir", help="keep the seeds in this folder, to reuse them in later runs"
+    )
+    parser.add_argument(
+        "--output", help="write the report to this file instead of stdout"
+    )
+    parser.add_argument("--seed", type=json.loads, help=argparse.SUPPRESS)
+    parser.add_argument("--scenario", type=json.loads, help=argparse.SUPPRESS)
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+
+    if args.seed is not None:
+        write_seed(args.seed)
+        return
+    if args.scenario is not None:
+        print(json.dumps(run_scenario(args.scenario)))
+        return
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(message)s")
+    report = json.dumps(run_sweep(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
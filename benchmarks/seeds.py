@@ -0,0 +1,198 @@
+"""
+Seeding of the caches and the MHC corpus
+
+The caches are written with the functions the app stores them with: the vectors cache as a snapshot, the instruments
+cache as compacted shards. The function app has to be loaded first, see benchmarks.app.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from . import workloads
+from .fakes import LocalContainerClient
+from .fakes import get_vector
+from .fakes import parse_file
+
+
+def seed_vectors(
+    container: LocalContainerClient, n_entries: int, pool_size: int, dim: int
+):
+    """
+    Seed the vectors cache with a snapshot of n_entries entries: pool_size questions linked to their negated texts,
+    their negated texts, and filler texts
+    """
+
+    from __app__ import constants
+    from __app__.utils import cache_storage
+    from __app__.utils import hashing
+    from __app__.utils import helpers
+    from __app__.utils import vector_snapshot
+    from __app__.utils.negator import get_negation_language
+    from __app__.utils.negator import negate_many
+    from __app__.utils.similarity import normalize
+
+    pool_texts = [workloads.get_pool_text(i) for i in range(pool_size)]
+    negated_texts = negate_many(pool_texts, ["en"] * pool_size)
+    n_fillers = max(n_entries - 2 * pool_size, 0)
+    texts = (
+        pool_texts
+        + negated_texts
+        + [workloads.get_filler_text(i) for i in range(n_fillers)]
+    )
+
+    keys = np.array(
+        [
+            hashing.add_namespace(
+                helpers.get_hash_value(text), constants.VECTORS_CACHE_NAMESPACE
+            )
+            for text in texts
+        ],
+        dtype=bytes,
+    )
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    cache_file_name = cache_storage.get_vectors_cache_file_name(
+        constants.VECTORS_CACHE_NAMESPACE
+    )
+
+    # The rows of the negated texts of the pool questions
+    rows = np.empty(len(keys), dtype=np.int64)
+    rows[order] = np.arange(len(keys))
+    negations = np.full(
+        (len(keys), len(vector_snapshot.negation_languages)), -1, dtype=np.int64
+    )
+    language_column = vector_snapshot.negation_languages.index(
+        get_negation_language("en")
+    )
+    negations[rows[:pool_size], language_column] = rows[pool_size : 2 * pool_size]
+
+    def get_vectors(chunk: slice) -> np.ndarray:
+        return normalize(
+            [get_vector(texts[i], dim) for i in order[chunk]],
+            dtype=constants.VECTOR_STORE_DTYPE,
+        )
+
+    def get_texts(chunk: slice) -> list[str]:
+        return [texts[i] for i in order[chunk]]
+
+    snapshot_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+    path = os.path.join(tempfile.mkdtemp(), snapshot_id)
+    vector_snapshot.write_snapshot(
+        path=path,
+        keys=sorted_keys,
+        negations=negations,
+        get_vectors=get_vectors,
+        get_texts=get_texts,
+        dim=dim,
+        dtype=constants.VECTOR_STORE_DTYPE,
+    )
+    snapshot_folder = vector_snapshot.get_snapshot_folder(cache_file_name, snapshot_id)
+    for file_name in vector_snapshot.snapshot_file_names:
+        with open(os.path.join(path, file_name), "rb") as file:
+            container.upload_blob(
+                name=f"{snapshot_folder}{file_name}",
+                data=file,
+                overwrite=True,
+            )
+    container.upload_blob(
+        name=vector_snapshot.get_manifest_blob_name(cache_file_name),
+        data=json.dumps(
+            {
+                "id": snapshot_id,
+                "count": len(keys),
+                "dim": dim,
+                "dtype": constants.VECTOR_STORE_DTYPE,
+                "normalized": True,
+                "negations": True,
+            }
+        ),
+        overwrite=True,
+    )
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+def seed_instruments(
+    container: LocalContainerClient,
+    n_entries: int,
+    pool_size: int,
+    n_instruments: int,
+    n_questions: int,
+    chunk_size: int = 10000,
+):
+    """
+    Seed the instruments cache with n_entries files: pool_size files of n_instruments instruments of n_questions
+    questions, and filler files of one instrument of one question
+    """
+
+    from __app__ import constants
+    from __app__.utils import cache_storage
+    from __app__.utils import cached_instruments
+    from __app__.utils import hashing
+
+    contents = [
+        workloads.get_pool_file_content(i, n_instruments, n_questions)
+        for i in range(pool_size)
+    ] + [
+        workloads.get_filler_file_content(i)
+        for i in range(max(n_entries - pool_size, 0))
+    ]
+
+    for start in range(0, len(contents), chunk_size):
+        entries = {}
+        for content in contents[start : start + chunk_size]:
+            hash_value = hashing.add_namespace(
+                hashing.get_content_key(content), constants.INSTRUMENTS_CACHE_NAMESPACE
+            )
+            entries[hash_value] = cached_instruments.to_json(
+                parse_file({"file_id": uuid.uuid4().hex, "content": content})
+            )
+        cache_storage.append_entries(
+            container=container,
+            cache_file_name=constants.cache_instruments_pkl,
+            entries=entries,
+        )
+
+    cache_storage.compact(
+        container=container, cache_file_name=constants.cache_instruments_pkl
+    )
+
+
+def seed_mhc(
+    container: LocalContainerClient, n_questions: int, dim: int, n_topics: int = 10
+):
+    """Seed the MHC corpus with n_questions questions"""
+
+    embeddings = io.BytesIO()
+    np.save(
+        embeddings,
+        np.array([get_vector(f"mhc question {i}", dim) for i in range(n_questions)]),
+    )
+
+    container.upload_blob(
+        name="mhc_questions.json",
+        data="\n".join(
+            json.dumps(
+                {"question_no": str(i + 1), "question_text": f"mhc question {i}"}
+            )
+            for i in range(n_questions)
+        ),
+        overwrite=True,
+    )
+    container.upload_blob(
+        name="mhc_all_metadatas.json",
+        data="\n".join(
+            json.dumps({"topics": [f"topic {i % n_topics}"]})
+            for i in range(n_questions)
+        ),
+        overwrite=True,
+    )
+    container.upload_blob(
+        name="mhc_embeddings.npy", data=embeddings.getvalue(), overwrite=True
+    )
@@ -0,0 +1,124 @@
+"""
+Synthetic workloads
+
+The caches are seeded with a pool of entries that requests hit, and filler entries that only make the cache bigger.
+A request hits the pool with the hit ratio of the workload, and misses with texts and files no request sent before,
+so every miss goes to Harmony API.
+"""
+
+from typing import Iterator
+
+import numpy as np
+
+from .fakes import get_file_content
+
+
+def get_pool_text(i: int) -> str:
+    """Get the text of a question of the pool of the vectors cache"""
+
+    return f"How often have you felt seed question {i}"
+
+
+def get_filler_text(i: int) -> str:
+    """Get the text of a filler entry of the vectors cache"""
+
+    return f"seed filler text {i}"
+
+
+def get_pool_file_content(i: int, n_instruments: int, n_questions: int) -> str:
+    """Get the content of a file of the pool of the instruments cache"""
+
+    return get_file_content(f"seed file {i}", n_instruments, n_questions)
+
+
+def get_filler_file_content(i: int) -> str:
+    """Get the content of a filler entry of the instruments cache"""
+
+    return get_file_content(f"seed filler file {i}", 1, 1)
+
+
+def sample_hits(
+    rng: np.random.Generator, n_items: int, hit_ratio: float, pool_size: int
+) -> list[int | None]:
+    """Sample the pool entry of each item of a request, None for a miss, the hits of a request are distinct"""
+
+    is_hit = (
+        rng.random(n_items) < hit_ratio if pool_size > 0 else np.zeros(n_items, bool)
+    )
+    pool_entries = rng.choice(
+        pool_size, size=int(is_hit.sum()), replace=bool(is_hit.sum() > pool_size)
+    )
+
+    entries: list[int | None] = [None] * n_items
+    for i, entry in zip(np.flatnonzero(is_hit), pool_entries):
+        entries[i] = int(entry)
+
+    return entries
+
+
+def iter_match_bodies(
+    n_requests: int,
+    n_instruments: int,
+    n_questions: int,
+    hit_ratio: float,
+    pool_size: int,
+    seed: int = 0,
+) -> Iterator[dict]:
+    """Iterate over the bodies of /api/match requests of n_instruments instruments of n_questions questions"""
+
+    rng = np.random.default_rng(seed)
+    for request in range(n_requests):
+        entries = sample_hits(rng, n_instruments * n_questions, hit_ratio, pool_size)
+        yield {
+            "instruments": [
+                {
+                    "instrument_id": f"instrument {request} {i}",
+                    "instrument_name": f"Instrument {i}",
+                    "language": "en",
+                    "questions": [
+                        {
+                            "question_no": str(j + 1),
+                            "question_text": (
+                                get_pool_text(entry)
+                                if entry is not None
+                                else f"How often have you felt new question {seed} {request} {i} {j}"
+                            ),
+                        }
+                        for j, entry in enumerate(
+                            entries[i * n_questions : (i + 1) * n_questions]
+                        )
+                    ],
+                }
+                for i in range(n_instruments)
+            ]
+        }
+
+
+def iter_parse_bodies(
+    n_requests: int,
+    n_files: int,
+    n_instruments: int,
+    n_questions: int,
+    hit_ratio: float,
+    pool_size: int,
+    seed: int = 0,
+) -> Iterator[list]:
+    """Iterate over the bodies of /api/parse requests of n_files files of n_instruments instruments each"""
+
+    rng = np.random.default_rng(seed)
+    for request in range(n_requests):
+        yield [
+            {
+                "file_id": f"file {request} {i}",
+                "file_name": f"file {i}.xlsx",
+                "file_type": "xlsx",
+                "content": (
+                    get_pool_file_content(entry, n_instruments, n_questions)
+                    if entry is not None
+                    else get_file_content(
+                        f"new file {seed} {request} {i}", n_instruments, n_questions
+                    )
+                ),
+            }
+            for i, entry in enumerate(sample_hits(rng, n_files, hit_ratio, pool_size))
+        ]
@@ -1,38 +1,220 @@
+import asyncio
+import base64
+import itertools
 import json
+from typing import Iterator
 
+import numpy as np
 from azure.functions import HttpResponse, HttpRequest
 
 from .. import constants
-from ..utils import helpers
+from ..utils import cache_storage
+from ..utils import cached_instruments
+from ..utils import caches
+from ..utils.bounded_cache import BoundedCache
+from ..utils.vector_store import VectorStore
 
-cache_instruments = helpers.get_cache_from_azure(
-    cache_file_name=constants.cache_instruments_pkl
-)
-cache_vectors = helpers.get_cache_from_azure(
-    cache_file_name=constants.cache_vectors_pkl
-)
+# The kinds of cached items, in the order they are exported
+cache_kinds = ["instruments", "vectors"]
 
+# The encodings of exported vectors, base64 encodings are little-endian
+vector_encodings = ["float", "float32", "float16"]
 
-def main(req: HttpRequest) -> HttpResponse:
+
+async def main(req: HttpRequest) -> HttpResponse:
     """
     Endpoint: GET /api/cache
+
+    The cached items, paged, filtered and encoded as set by the query parameters, see README.md.
     """
 
     if req.method != "GET":
         return HttpResponse("Method not allowed", status_code=405)
 
-    # Get cached items
-    response = {
-        "instruments": [v for k, v in cache_instruments.items()],
-        "vectors": [
-            {"text": v["text"], "vector": v["vector"]} for k, v in cache_vectors.items()
-        ],
-    }
+    try:
+        export_options = get_export_options(req.params)
+    except ValueError as e:
+        return HttpResponse(
+            body=str(e),
+            headers={"Content-Type": "application/json"},
+            status_code=400,
+        )
+
+    # The caches are read on the event loop, so /api/match and /api/parse don't change them during the export
+    cache_instruments = await asyncio.to_thread(caches.get_instruments_cache)
+    cache_vectors = await asyncio.to_thread(caches.get_vectors_cache)
+    caches.apply_synced_entries(cache_file_name=constants.cache_instruments_pkl)
+    caches.apply_synced_entries(
+        cache_file_name=cache_storage.get_vectors_cache_file_name()
+    )
 
-    return HttpResponse(
-        body=json.dumps(response),
-        headers={
-            "Content-Type": "application/json",
-        },
-        status_code=200,
+    # Get cached items, one more than the limit to know if there is a next page
+    items = iter_items(
+        cache_instruments=cache_instruments,
+        cache_vectors=cache_vectors,
+        kinds=export_options["kinds"],
+        cursor=export_options["cursor"],
+        vector_encoding=export_options["vector_encoding"],
     )
+    limit = export_options["limit"]
+    if limit is not None:
+        items = itertools.islice(items, limit + 1)
+    page = list(items)
+
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = get_cursor(kind=page[-1][0], hash_value=page[-1][1])
+
+    headers = {}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+
+    if export_options["format"] == "ndjson":
+        headers["Content-Type"] = "application/x-ndjson"
+        # The instruments of a file are one line each, with the hash of the file
+        body = b"".join(
+            json.dumps(
+                {"kind": kind, "hash": hash_value, **item}
+                if kind == "vectors"
+                else {"kind": kind, "hash": hash_value, "instrument": instrument}
+            ).encode()
+            + b"\n"
+            for kind, hash_value, item in page
+            for instrument in ([item] if kind == "vectors" else item)
+        )
+    else:
+        headers["Content-Type"] = "application/json"
+        response = {kind: [] for kind in export_options["kinds"]}
+        for kind, _, item in page:
+            if kind == "vectors":
+                response[kind].append(item)
+            else:
+                response[kind].extend(item)
+        if limit is not None:
+            response["next_cursor"] = next_cursor
+        body = json.dumps(response)
+
+    return HttpResponse(body=body, headers=headers, status_code=200)
+
+
+def get_export_options(params: dict) -> dict:
+    """
+    Get the options of the export from the query parameters
+    :raises ValueError: if an option is invalid
+    """
+
+    export_format = params.get("format", "json")
+    kind = params.get("kind")
+    cursor = params.get("cursor")
+    limit = params.get("limit")
+    vector_encoding = params.get("vector_encoding", "float")
+
+    if export_format not in ["json", "ndjson"]:
+        raise ValueError("'format' must be 'json' or 'ndjson'")
+    if kind is not None and kind not in cache_kinds:
+        raise ValueError(f"'kind' must be one of {', '.join(cache_kinds)}")
+    if vector_encoding not in vector_encodings:
+        raise ValueError(
+            f"'vector_encoding' must be one of {', '.join(vector_encodings)}"
+        )
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError("'limit' must be a positive integer")
+        limit = int(limit)
+    elif cursor is not None or export_format == "ndjson":
+        limit = constants.CACHE_EXPORT_PAGE_SIZE
+    if cursor is not None:
+        cursor_kind, _, _ = cursor.partition(":")
+        if cursor_kind not in cache_kinds:
+            raise ValueError("Invalid 'cursor'")
+
+    return {
+        "format": export_format,
+        "kinds": [kind] if kind is not None else cache_kinds,
+        "cursor": cursor,
+        "limit": limit,
+        "vector_encoding": vector_encoding,
+    }
+
+
+def get_cursor(kind: str, hash_value: str) -> str:
+    """Get the cursor of the page after a cached item"""
+
+    return f"{kind}:{hash_value}"
+
+
+def iter_items(
+    cache_instruments: BoundedCache,
+    cache_vectors: VectorStore,
+    kinds: list[str],
+    cursor: str | None = None,
+    vector_encoding: str = "float",
+) -> Iterator[tuple[str, str, dict | list]]:
+    """
+    Iterate over (kind, hash value, item) of cached items by kind and ascending hash value, starting after a cursor.
+    The item of a file is the list of its instruments.
+    """
+
+    cursor_kind, after = None, None
+    if cursor is not None:
+        cursor_kind, _, after = cursor.partition(":")
+
+    for kind in kinds:
+        # Skip the kinds before the kind of the cursor
+        if cursor_kind is not None and cache_kinds.index(kind) < cache_kinds.index(
+            cursor_kind
+        ):
+            continue
+        kind_after = after if kind == cursor_kind else None
+
+        if kind == "instruments":
+            # Items are not accesses of the entries, so the export doesn't change which entries are evicted
+            for hash_value, value in cache_instruments.iter_sorted(after=kind_after):
+                # The instruments of a file are cached together, as JSON bytes
+                yield kind, hash_value, cached_instruments.get_instruments(value)
+        else:
+            for hash_value, text, vector in cache_vectors.iter_sorted(after=kind_after):
+                yield kind, hash_value, get_vector_item(
+                    cache_vectors=cache_vectors,
+                    hash_value=hash_value,
+                    text=text,
+                    vector=vector,
+                    vector_encoding=vector_encoding,
+                )
+
+
+def encode_vector(vector: np.ndarray, vector_encoding: str = "float"):
+    """Encode a vector as a list of floats, or as base64 of its little-endian float32 or float16 bytes"""
+
+    if vector_encoding == "float":
+        return vector.tolist()
+
+    return base64.b64encode(
+        np.asarray(vector, dtype=np.dtype(vector_encoding).newbyteorder("<")).tobytes()
+    ).decode()
+
+
+def get_vector_item(
+    cache_vectors: VectorStore,
+    hash_value: str,
+    text: str,
+    vector: np.ndarray,
+    vector_encoding: str = "float",
+) -> dict:
+    """
+    Get a cached vector, with the negated texts of its text by negation language. The negated texts are peeked at, so
+    the export doesn't change which rows are evicted
+    """
+
+    item = {"text": text, "vector": encode_vector(vector, vector_encoding)}
+
+    negations = {}
+    for language, negated_hash_value in cache_vectors.get_negations(hash_value).items():
+        negated_text = cache_vectors.peek_text(negated_hash_value)
+        if negated_text is not None:
+            negations[language] = negated_text
+    if negations:
+        item["negations"] = negations
+
+    return item
@@ -0,0 +1,28 @@
+import logging
+
+from azure.functions import TimerRequest
+
+from .. import constants
+from ..utils import cache_storage
+from ..utils import helpers
+from ..utils import vector_snapshot
+
+
+def main(timer: TimerRequest):
+    """
+    Timer: compact the caches
+
+    Merges the log segments appended by /api/parse into the instrument cache shards, and the log segments appended by
+    /api/match into a new snapshot of the vector cache of each namespace
+    """
+
+    if timer.past_due:
+        logging.info("Cache compaction is past due")
+
+    container = helpers.get_container_harmonycache()
+
+    cache_storage.compact(
+        container=container, cache_file_name=constants.cache_instruments_pkl
+    )
+    for cache_file_name in cache_storage.vectors_caches:
+        vector_snapshot.compact(container=container, cache_file_name=cache_file_name)
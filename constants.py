@@ -5,3 +5,108 @@ cache_vectors_pkl = "cache_vectors.pkl"
 
 harmony_api = os.getenv("HARMONY_API")
 AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+
+# The dtype of cached vectors, "float32" or "float16"
+VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float32")
+
+# The number of leading hash characters that decide which shard a cache entry is persisted to
+CACHE_SHARD_PREFIX_LENGTH = int(os.getenv("CACHE_SHARD_PREFIX_LENGTH", "2"))
+
+# The number of cache blobs that are downloaded concurrently
+CACHE_DOWNLOAD_CONCURRENCY = int(os.getenv("CACHE_DOWNLOAD_CONCURRENCY", "16"))
+
+# The minimum number of log segments of a shard before it is compacted
+CACHE_COMPACTION_MIN_SEGMENTS = int(os.getenv("CACHE_COMPACTION_MIN_SEGMENTS", "1"))
+
+# How long the MHC corpus is used before checking if it changed
+MHC_REFRESH_INTERVAL_SECONDS = int(os.getenv("MHC_REFRESH_INTERVAL_SECONDS", "600"))
+
+# The number of rows of the similarity matrix that are computed at once
+SIMILARITY_BLOCK_SIZE = int(os.getenv("SIMILARITY_BLOCK_SIZE", "512"))
+
+# The nearest neighbour index of the MHC corpus, "exact" or "ivf" (approximate)
+NN_INDEX = os.getenv("NN_INDEX", "exact")
+
+# The number of vectors an exact nearest neighbour index searches at once
+NN_INDEX_BLOCK_SIZE = int(os.getenv("NN_INDEX_BLOCK_SIZE", "4096"))
+
+# The number of clusters of an IVF index, 0 for the square root of the number of vectors
+NN_INDEX_N_LISTS = int(os.getenv("NN_INDEX_N_LISTS", "0"))
+
+# The number of clusters an IVF index searches per query
+NN_INDEX_N_PROBE = int(os.getenv("NN_INDEX_N_PROBE", "8"))
+
+# The number of texts that are tokenized at once when negating
+NEGATION_BATCH_SIZE = int(os.getenv("NEGATION_BATCH_SIZE", "256"))
+
+# The maximum number of negated texts kept in memory
+NEGATION_MEMO_SIZE = int(os.getenv("NEGATION_MEMO_SIZE", "100000"))
+
+# The number of seconds to wait for a connection to and for a response from the Harmony API
+HARMONY_API_CONNECT_TIMEOUT_SECONDS = float(
+    os.getenv("HARMONY_API_CONNECT_TIMEOUT_SECONDS", "5")
+)
+HARMONY_API_TIMEOUT_SECONDS = float(os.getenv("HARMONY_API_TIMEOUT_SECONDS", "60"))
+
+# The number of retries of a failed Harmony API call, and the backoff factor between them
+HARMONY_API_RETRIES = int(os.getenv("HARMONY_API_RETRIES", "3"))
+HARMONY_API_RETRY_BACKOFF_SECONDS = float(
+    os.getenv("HARMONY_API_RETRY_BACKOFF_SECONDS", "0.5")
+)
+
+# The number of Harmony API calls that are sent concurrently
+HARMONY_API_CONCURRENCY = int(os.getenv("HARMONY_API_CONCURRENCY", "4"))
+
+# The maximum number of texts or files, and of bytes, of one Harmony API call
+HARMONY_API_VECTORS_BATCH_SIZE = int(os.getenv("HARMONY_API_VECTORS_BATCH_SIZE", "256"))
+HARMONY_API_PARSE_BATCH_SIZE = int(os.getenv("HARMONY_API_PARSE_BATCH_SIZE", "4"))
+HARMONY_API_MAX_BATCH_BYTES = int(os.getenv("HARMONY_API_MAX_BATCH_BYTES", "4000000"))
+
+# How long cache misses of concurrent requests are collected into one Harmony API call
+COALESCING_WINDOW_SECONDS = float(os.getenv("COALESCING_WINDOW_SECONDS", "0.01"))
+
+# The default number of cached items of a page of GET /api/cache
+CACHE_EXPORT_PAGE_SIZE = int(os.getenv("CACHE_EXPORT_PAGE_SIZE", "1000"))
+
+# How cache entries are evicted once a cache is over its budget, "lru", "lfu" or "ttl" (oldest first)
+CACHE_EVICTION_POLICY = os.getenv("CACHE_EVICTION_POLICY", "lru")
+
+# How long cache entries are kept in memory, 0 to keep them until they are evicted
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "0"))
+
+# The budgets of the caches in memory, 0 for no budget
+INSTRUMENTS_CACHE_MAX_ENTRIES = int(os.getenv("INSTRUMENTS_CACHE_MAX_ENTRIES", "0"))
+INSTRUMENTS_CACHE_MAX_BYTES = int(os.getenv("INSTRUMENTS_CACHE_MAX_BYTES", "0"))
+VECTORS_CACHE_MAX_ENTRIES = int(os.getenv("VECTORS_CACHE_MAX_ENTRIES", "0"))
+VECTORS_CACHE_MAX_BYTES = int(os.getenv("VECTORS_CACHE_MAX_BYTES", "0"))
+
+# Whether evicted cache entries are deleted from blob storage too, for all instances, not only the one evicting them
+CACHE_PERSIST_EVICTIONS = (
+    os.getenv("CACHE_PERSIST_EVICTIONS", "false").lower() == "true"
+)
+
+# Keep the caches in a local disk tier below memory, synced with blob storage by ETag
+CACHE_DISK_TIER = os.getenv("CACHE_DISK_TIER", "true").lower() == "true"
+
+# How often the caches pull the entries added by other instances, 0 to never sync
+CACHE_SYNC_INTERVAL_SECONDS = float(os.getenv("CACHE_SYNC_INTERVAL_SECONDS", "60"))
+
+# The minimum size of a cached JSON value that is compressed in storage
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", "1024"))
+
+# The algorithm file contents are hashed with into cache keys, 'sha256' or 'blake2b'
+CONTENT_HASH_ALGORITHM = os.getenv("CONTENT_HASH_ALGORITHM", "sha256")
+
+# The namespaces of the cache keys, e.g. the version of the embedding model and of the parser of Harmony API
+VECTORS_CACHE_NAMESPACE = os.getenv("VECTORS_CACHE_NAMESPACE", "")
+INSTRUMENTS_CACHE_NAMESPACE = os.getenv("INSTRUMENTS_CACHE_NAMESPACE", "")
+
+# The previous namespaces, whose entries are used while the current namespaces are warmed in the background, unset
+# for none ('' is the namespace of the keys cached before keys had namespaces). A match whose vectors are all cached
+# in the previous namespace uses them, and an instrument only cached in the previous namespace is returned, and the
+# values of the current namespace are computed in the background
+VECTORS_CACHE_PREVIOUS_NAMESPACE = os.getenv("VECTORS_CACHE_PREVIOUS_NAMESPACE")
+INSTRUMENTS_CACHE_PREVIOUS_NAMESPACE = os.getenv("INSTRUMENTS_CACHE_PREVIOUS_NAMESPACE")
+
+# Whether responses have a Server-Timing header with the duration of each stage of the request
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
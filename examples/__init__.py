@@ -2,16 +2,8 @@ import json
 
 from azure.functions import HttpResponse, HttpRequest
 
-from .. import constants
 from ..utils import helpers
 
-cache_instruments = helpers.get_cache_from_azure(
-    cache_file_name=constants.cache_instruments_pkl
-)
-cache_vectors = helpers.get_cache_from_azure(
-    cache_file_name=constants.cache_vectors_pkl
-)
-
 
 def main(req: HttpRequest) -> HttpResponse:
     """
@@ -1,27 +1,36 @@
+import asyncio
 import json
 import logging
-import os
-import tempfile
 import uuid
 from collections import Counter
 
+import aiohttp
 import numpy as np
-import requests
 from azure.functions import HttpResponse, HttpRequest
 
 from .. import constants
+from ..utils import cache_storage
+from ..utils import caches
+from ..utils import harmony_api
+from ..utils import hashing
 from ..utils import helpers
-from ..utils.negator import negate
-
-cache = helpers.get_cache_from_azure(cache_file_name=constants.cache_vectors_pkl)
-
-# While the function is running, the cache file must be temporarily saved in the temp dir
-cache_vectors_pkl_tmp_file_path = os.path.join(
-    tempfile.gettempdir(), constants.cache_vectors_pkl
+from ..utils import metrics
+from ..utils import mhc
+from ..utils import similarity
+from ..utils.negator import get_negation_language
+from ..utils.negator import negate_many
+from ..utils.single_flight import SingleFlight
+from ..utils.vector_store import VectorStore
+
+caches.warm_up(caches.get_vectors_cache, caches.get_previous_vectors_cache)
+
+vector_requests = SingleFlight(
+    fetch=harmony_api.get_vectors_async,
+    window_seconds=constants.COALESCING_WINDOW_SECONDS,
 )
 
 
-def main(req: HttpRequest) -> HttpResponse:
+async def main(req: HttpRequest) -> HttpResponse:
     """
     Endpoint: POST /api/match
 
@@ -37,10 +46,26 @@ def main(req: HttpRequest) -> HttpResponse:
 
     req_body = req.get_body()
     if req_body:
+        timer = metrics.StageTimer(function="match")
+        with timer.stage("cache"):
+            cache = await asyncio.to_thread(caches.get_vectors_cache)
+            previous_cache = await asyncio.to_thread(caches.get_previous_vectors_cache)
+            for cache_file_name in cache_storage.vectors_caches:
+                caches.apply_synced_entries(cache_file_name=cache_file_name)
+
         req_body_json = json.loads(req_body)
         instruments = req_body_json.get("instruments")
         query = req_body_json.get("query")
 
+        try:
+            match_options = get_match_options(req_body_json)
+        except ValueError as e:
+            return HttpResponse(
+                body=str(e),
+                headers={"Content-Type": "application/json", **timer.finish()},
+                status_code=400,
+            )
+
         # Assign any missing IDs
         for instrument in instruments or []:
             if instrument.get("file_id") is None:
@@ -49,7 +74,7 @@ def main(req: HttpRequest) -> HttpResponse:
                 instrument["instrument_id"] = uuid.uuid4().hex
 
         texts = []
-        negated_texts = []
+        languages = []
         instrument_ids = []
         question_indices = []
         all_questions = []
@@ -60,76 +85,231 @@ def main(req: HttpRequest) -> HttpResponse:
                 question["instrument_id"] = instrument_id
                 all_questions.append(question)
                 texts.append(question_text)
-                negated = negate(question_text, instrument.get("language"))
-                negated_texts.append(negated)
+                languages.append(instrument.get("language"))
                 instrument_ids.append(instrument_id)
                 question_indices.append(question_idx)
 
-        all_texts = texts + negated_texts
+        with timer.stage("hashing"):
+            negation_languages = [
+                get_negation_language(language) for language in languages
+            ]
+
+            # Questions with the same text and negation language share their negated text, their vectors and their
+            # similarities, so the work is done once per unique question and expanded to all questions
+            unique_questions: dict[tuple[str, str], int] = {}
+            question_rows = np.array(
+                [
+                    unique_questions.setdefault(question, len(unique_questions))
+                    for question in zip(texts, negation_languages)
+                ],
+                dtype=np.intp,
+            )
+            unique_positions = np.unique(question_rows, return_index=True)[1]
+            unique_texts = [texts[i] for i in unique_positions]
+            unique_languages = [languages[i] for i in unique_positions]
+            unique_negation_languages = [
+                negation_languages[i] for i in unique_positions
+            ]
+
+            hash_values = [get_vector_key(text) for text in unique_texts]
+
+        with timer.stage("negation"):
+            # The negated texts of cached questions are cached too, only the other questions are negated. A negated text
+            # doesn't depend on the model, so the negated texts of the previous namespace are used too
+            namespace_caches = {constants.VECTORS_CACHE_NAMESPACE: cache}
+            if previous_cache is not None:
+                namespace_caches.setdefault(
+                    constants.VECTORS_CACHE_PREVIOUS_NAMESPACE, previous_cache
+                )
+            negated_texts: list[str | None] = [
+                get_cached_negated_text(namespace_caches, text, negation_language)
+                for text, negation_language in zip(
+                    unique_texts, unique_negation_languages
+                )
+            ]
+            not_negated = [
+                i for i, negated in enumerate(negated_texts) if negated is None
+            ]
+            not_linked = [
+                i
+                for i, negation_language in enumerate(unique_negation_languages)
+                if cache.get_negation(hash_values[i], negation_language) is None
+            ]
+            for i, negated in zip(
+                not_negated,
+                await asyncio.to_thread(
+                    negate_many,
+                    [unique_texts[i] for i in not_negated],
+                    [unique_languages[i] for i in not_negated],
+                ),
+            ):
+                negated_texts[i] = negated
+
+        all_texts = unique_texts + negated_texts
 
         # Include query in all_texts
         if query:
             all_texts.append(query)
 
-        # A list of texts whose vectors aren't cached yet
-        texts_with_no_cached_vector: list[str] = []
-
-        all_vectors: list[dict[str, list[float]]] = []
-
-        for text in all_texts:
-            hash_value = helpers.get_hash_value(text)
-            if hash_value in cache.keys():
-                # If vector of text is cached
-                vector = cache[hash_value]
-                all_vectors.append(vector)
-            else:
-                # If vector of text is not cached
-                texts_with_no_cached_vector.append(text)
-
-        # Get vectors that aren't cached yet and cache them
-        if texts_with_no_cached_vector:
-            response_vectors = get_response_vectors(texts_with_no_cached_vector)
-            if response_vectors.ok:
-                vectors: list[list[float]] = response_vectors.json()
-                text_vectors = zip(texts_with_no_cached_vector, vectors)
-                for text, vector in text_vectors:
-                    hash_value = helpers.get_hash_value(text)
-                    cache[hash_value] = {"text": text, "vector": vector}
-                    all_vectors.append({"text": text, "vector": vector})
-            else:
+        with timer.stage("lookup"):
+            # A text can be both a question and a negated text, the vector of each text is looked up once
+            text_rows: dict[str, int] = {}
+            all_text_rows = np.array(
+                [text_rows.setdefault(text, len(text_rows)) for text in all_texts],
+                dtype=np.intp,
+            )
+            lookup_texts = list(text_rows)
+
+            # While the current namespace is warmed, the vectors of the previous namespace are used if they are all
+            # cached, the vectors of different namespaces are never mixed
+            namespace = constants.VECTORS_CACHE_NAMESPACE
+            lookup_cache = cache
+            if previous_cache is not None and previous_cache is not cache:
+                _, missing_in_namespace = cache.get_many(
+                    [get_vector_key(text) for text in lookup_texts]
+                )
+                texts_to_warm = [lookup_texts[i] for i in missing_in_namespace]
+                if texts_to_warm:
+                    _, missing_in_previous_namespace = previous_cache.get_many(
+                        [
+                            get_vector_key(
+                                text, constants.VECTORS_CACHE_PREVIOUS_NAMESPACE
+                            )
+                            for text in lookup_texts
+                        ]
+                    )
+                    if len(missing_in_previous_namespace) == 0:
+                        namespace = constants.VECTORS_CACHE_PREVIOUS_NAMESPACE
+                        lookup_cache = previous_cache
+                        hash_values_to_warm = [
+                            get_vector_key(text) for text in texts_to_warm
+                        ]
+                        helpers.run_in_background(
+                            warm_vectors(
+                                cache=cache,
+                                hash_values=hash_values_to_warm,
+                                texts=texts_to_warm,
+                            )
+                        )
+
+            # Look up the vectors of all texts at once, in the order of the texts
+            lookup_hash_values = [
+                get_vector_key(text, namespace) for text in lookup_texts
+            ]
+            rows, missing = lookup_cache.get_many(lookup_hash_values)
+
+            # The cached vectors are gathered before awaiting Harmony API, as concurrent requests can evict rows, which
+            # moves other rows
+            is_cached = rows >= 0
+            cached_vectors = lookup_cache.gather(rows[is_cached])
+        metrics.increment(
+            "harmonycache_cache_hits_total",
+            len(lookup_texts) - len(missing),
+            cache="cache_vectors",
+        )
+        metrics.increment(
+            "harmonycache_cache_misses_total", len(missing), cache="cache_vectors"
+        )
+
+        # Get vectors that aren't cached yet and cache them, concurrent requests missing the same texts share one call
+        new_hash_values = []
+        missing_vectors = None
+        if len(missing) > 0:
+            hash_values_with_no_cached_vector = [lookup_hash_values[i] for i in missing]
+            texts_with_no_cached_vector = [lookup_texts[i] for i in missing]
+            try:
+                with timer.stage("vectors"):
+                    vectors = await vector_requests.get_many(
+                        keys=hash_values_with_no_cached_vector,
+                        items=texts_with_no_cached_vector,
+                    )
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
                 error_msg = "Could not get vectors from Harmony API"
-                logging.error(error_msg)
+                logging.exception(error_msg)
                 return HttpResponse(
                     body=error_msg,
-                    headers={"Content-Type": "application/json"},
+                    headers={"Content-Type": "application/json", **timer.finish()},
                     status_code=500,
                 )
+            with timer.stage("store"):
+                new_hash_values = cache_vectors(
+                    cache=cache,
+                    hash_values=hash_values_with_no_cached_vector,
+                    texts=texts_with_no_cached_vector,
+                    vectors=vectors,
+                )
+                missing_vectors = similarity.normalize(vectors, dtype=cache.dtype)
+
+        # Assemble the vectors of all texts in their order
+        lookup_vectors = np.empty(
+            (len(lookup_texts), lookup_cache.dim), dtype=lookup_cache.dtype
+        )
+        if len(cached_vectors) > 0:
+            lookup_vectors[is_cached] = cached_vectors
+        if missing_vectors is not None:
+            lookup_vectors[missing] = missing_vectors
+        all_vectors = lookup_vectors[all_text_rows]
+
+        with timer.stage("store"):
+            # Link the questions to their negated texts, if they weren't linked in the current namespace yet
+            new_negations = {}
+            for i in not_linked:
+                negated_hash_value = get_vector_key(negated_texts[i])
+                cache.set_negation(
+                    hash_values[i], unique_negation_languages[i], negated_hash_value
+                )
+                new_negations.setdefault(hash_values[i], {})[
+                    unique_negation_languages[i]
+                ] = negated_hash_value
 
-            # Save cache to storage
-            helpers.save_cache_to_blob_storage(
-                cache_tmp_file_path=cache_vectors_pkl_tmp_file_path,
-                cache_file_name=constants.cache_vectors_pkl,
+            # Save new cache entries to storage
+            new_entries = cache.to_dict(new_hash_values)
+            for hash_value, negations in new_negations.items():
+                if hash_value not in new_entries:
+                    new_entries[hash_value] = {"negations": negations}
+
+            helpers.trim_and_save_cache_in_background(
                 cache=cache,
+                cache_file_name=cache_storage.get_vectors_cache_file_name(),
+                new_entries=new_entries,
             )
 
+            # The vectors read from the disk tier of the previous namespace are kept within its budget too
+            if lookup_cache is not cache:
+                helpers.trim_and_save_cache_in_background(
+                    cache=lookup_cache,
+                    cache_file_name=cache_storage.get_vectors_cache_file_name(
+                        constants.VECTORS_CACHE_PREVIOUS_NAMESPACE
+                    ),
+                    new_entries={},
+                )
+
         # Get similarity data
-        all_questions, similarity_with_polarity, query_similarity = get_similarity_data(
-            texts=texts,
+        all_questions, matches, query_similarity = await asyncio.to_thread(
+            get_similarity_data,
+            texts=unique_texts,
             all_questions=all_questions,
             query=query,
-            all_vectors=[v["vector"] for v in all_vectors],
+            all_vectors=all_vectors,
+            question_rows=question_rows,
+            timer=timer,
+            **match_options,
         )
 
         response = {
             "questions": all_questions,
-            "matches": similarity_with_polarity,
+            "matches": matches,
             "query_similarity": query_similarity,
         }
 
+        with timer.stage("serialize"):
+            body = json.dumps(response)
+
         return HttpResponse(
-            body=json.dumps(response),
+            body=body,
             headers={
                 "Content-Type": "application/json",
+                **timer.finish(),
             },
             status_code=200,
         )
@@ -137,94 +317,221 @@ def main(req: HttpRequest) -> HttpResponse:
         return HttpResponse(body="Invalid request", status_code=400)
 
 
-def get_response_vectors(texts: list[str]) -> requests.Response:
-    """Get response vectors"""
+def get_vector_key(
+    text: str, namespace: str = constants.VECTORS_CACHE_NAMESPACE
+) -> str:
+    """Get the cache key of the vector of a text in a namespace"""
 
-    return requests.post(
-        url=f"{constants.harmony_api}/text/vectors",
-        data=json.dumps(texts),
-        headers={"Content-Type": "application/json"},
-    )
+    return hashing.add_namespace(helpers.get_hash_value(text), namespace)
 
 
-def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> np.ndarray:
+def get_cached_negated_text(
+    namespace_caches: dict[str, VectorStore], text: str, negation_language: str
+) -> str | None:
+    """
+    Get the cached negated text of a text, from the vectors cache of the first namespace that has it
+    :param namespace_caches: the vectors caches by namespace, the current namespace first
     """
-    Cosine similarity
 
-    This function was copied from Harmony
+    for namespace, cache in namespace_caches.items():
+        negated_hash_value = cache.get_negation(
+            get_vector_key(text, namespace), negation_language
+        )
+        if negated_hash_value is not None and negated_hash_value in cache:
+            return cache.get_text(negated_hash_value)
+
+    return None
+
+
+def cache_vectors(
+    cache: VectorStore, hash_values: list[str], texts: list[str], vectors: list
+) -> list[str]:
+    """
+    Cache the vectors of texts
+    :return: the hash values of the vectors that weren't cached yet
     """
 
-    dp = np.dot(vec1, vec2.T)
-    m1 = np.mat(np.linalg.norm(vec1, axis=1))
-    m2 = np.mat(np.linalg.norm(vec2.T, axis=0))
+    new_hash_values = []
+    for hash_value, text, vector in zip(hash_values, texts, vectors):
+        # Only the first request to get a shared vector caches and saves it
+        if hash_value not in cache:
+            cache.add(hash_value=hash_value, text=text, vector=vector)
+            new_hash_values.append(hash_value)
+
+    return new_hash_values
+
 
-    return np.asarray(dp / np.matmul(m1.T, m2))
+async def warm_vectors(cache: VectorStore, hash_values: list[str], texts: list[str]):
+    """Get the vectors of texts that are only cached in the previous namespace, and cache them"""
+
+    try:
+        vectors = await vector_requests.get_many(keys=hash_values, items=texts)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        logging.exception("Could not warm vectors from Harmony API")
+        return
+
+    new_hash_values = cache_vectors(
+        cache=cache, hash_values=hash_values, texts=texts, vectors=vectors
+    )
+    helpers.trim_and_save_cache_in_background(
+        cache=cache,
+        cache_file_name=cache_storage.get_vectors_cache_file_name(),
+        new_entries=cache.to_dict(new_hash_values),
+    )
+
+
+def get_match_options(req_body_json: dict) -> dict:
+    """
+    Get the options of the matches from the request body
+    :raises ValueError: if an option is invalid
+    """
+
+    top_k = req_body_json.get("top_k")
+    min_similarity = req_body_json.get("min_similarity")
+    cross_instrument_only = req_body_json.get("cross_instrument_only", False)
+    mhc_top_k = req_body_json.get("mhc_top_k")
+
+    if top_k is not None and (
+        isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1
+    ):
+        raise ValueError("'top_k' must be a positive integer")
+    if min_similarity is not None and (
+        isinstance(min_similarity, bool) or not isinstance(min_similarity, (int, float))
+    ):
+        raise ValueError("'min_similarity' must be a number")
+    if not isinstance(cross_instrument_only, bool):
+        raise ValueError("'cross_instrument_only' must be a boolean")
+    if mhc_top_k is not None and (
+        isinstance(mhc_top_k, bool) or not isinstance(mhc_top_k, int) or mhc_top_k < 1
+    ):
+        raise ValueError("'mhc_top_k' must be a positive integer")
+
+    return {
+        "top_k": top_k,
+        "min_similarity": min_similarity,
+        "cross_instrument_only": cross_instrument_only,
+        "mhc_top_k": mhc_top_k,
+    }
 
 
 def get_similarity_data(
-    texts: list[str], all_questions: list, query: str, all_vectors: list[list[float]]
+    texts: list[str],
+    all_questions: list,
+    query: str,
+    all_vectors: np.ndarray,
+    question_rows: np.ndarray | None = None,
+    top_k: int | None = None,
+    min_similarity: float | None = None,
+    cross_instrument_only: bool = False,
+    mhc_top_k: int | None = None,
+    timer: metrics.StageTimer | None = None,
 ):
     """
     Get similarity data
 
-    Code snippets below were copied from Harmony
-    """
+    Code snippets below were copied from Harmony. The vectors are normalized, see utils.similarity
 
-    all_vectors = np.array(all_vectors)
+    If top_k, min_similarity or cross_instrument_only is given, the matches are a sparse CSR matrix instead of the
+    dense matrix. If mhc_top_k is given, the mhc_top_k nearest MHC questions of each question are added to it as
+    'nearest_matches_from_mhc_auto'.
 
-    vectors_pos = all_vectors[: len(texts), :]
-    vectors_neg = all_vectors[len(texts) : len(texts) * 2, :]
+    The texts and vectors are those of the unique questions, question_rows is the unique question of each question.
+    The similarities are computed once per unique question and expanded to all questions.
 
-    if query:
-        vector_query = np.array(all_vectors[-1:, :])
-        query_similarity = cosine_similarity(vectors_pos, vector_query)[:, 0]
-    else:
-        query_similarity = None
-
-    pairwise_similarity = cosine_similarity(vectors_pos, vectors_pos)
-    pairwise_similarity_neg1 = cosine_similarity(vectors_neg, vectors_pos)
-    pairwise_similarity_neg2 = cosine_similarity(vectors_pos, vectors_neg)
-
-    pairwise_similarity_neg_mean = np.mean(
-        [pairwise_similarity_neg1, pairwise_similarity_neg2], axis=0
-    )
+    The stages are timed with timer, if given.
+    """
 
-    similarity_difference = pairwise_similarity - pairwise_similarity_neg_mean
-    similarity_polarity = np.sign(similarity_difference)
+    if timer is None:
+        timer = metrics.StageTimer(function="match")
 
-    # Make sure that any 0's in polarity are converted to 1's
-    where_0 = np.where(np.abs(similarity_difference) < 0.001)
-    similarity_polarity[where_0] = 1
+    vectors_pos = all_vectors[: len(texts), :]
+    vectors_neg = all_vectors[len(texts) : len(texts) * 2, :]
+    if question_rows is None:
+        question_rows = np.arange(len(texts))
+    n_questions = len(question_rows)
 
-    similarity_max = np.max([pairwise_similarity, pairwise_similarity_neg_mean], axis=0)
-    similarity_with_polarity = similarity_max * similarity_polarity
+    with timer.stage("similarity"):
+        if query:
+            vector_query = all_vectors[-1:, :]
+            query_similarity = similarity.cosine_similarity(vectors_pos, vector_query)[
+                question_rows, 0
+            ]
+        else:
+            query_similarity = None
+
+        if top_k is not None or min_similarity is not None or cross_instrument_only:
+            groups = None
+            if cross_instrument_only:
+                _, groups = np.unique(
+                    [str(q.get("instrument_id")) for q in all_questions],
+                    return_inverse=True,
+                )
+            # The neighbours of a question depend on its position, so sparse matches are computed for all questions
+            indptr, indices, data = similarity.get_sparse_similarity_with_polarity(
+                vectors_pos=vectors_pos[question_rows],
+                vectors_neg=vectors_neg[question_rows],
+                top_k=top_k,
+                min_similarity=min_similarity,
+                groups=groups,
+            )
+            matches = {
+                "format": "csr",
+                "shape": [n_questions, n_questions],
+                "indptr": indptr.tolist(),
+                "indices": indices.tolist(),
+                "data": data.tolist(),
+            }
+        else:
+            matches = similarity.get_similarity_with_polarity(
+                vectors_pos=vectors_pos, vectors_neg=vectors_neg
+            )[np.ix_(question_rows, question_rows)].tolist()
 
     # Get MHC embeddings
-    mhc_questions, mhc_all_metadata, mhc_embeddings = helpers.get_mhc_embeddings()
-
-    # Work out similarity with MHC
-    if len(mhc_embeddings) > 0:
-        similarities_mhc = cosine_similarity(vectors_pos, mhc_embeddings)
-
-        ctrs = {}
-        for idx, a in enumerate(np.argmax(similarities_mhc, axis=1)):
-            if all_questions[idx].get("instrument_id") not in ctrs:
-                ctrs[all_questions[idx].get("instrument_id")] = Counter()
-            for topic in mhc_all_metadata[a]["topics"]:
-                ctrs[all_questions[idx].get("instrument_id")][topic] += 1
-            all_questions[idx]["nearest_match_from_mhc_auto"] = mhc_questions[a].dict()
-
-        instrument_to_category = {}
-        for instrument_id, counts in ctrs.items():
-            instrument_to_category[instrument_id] = []
-            max_count = max(counts.values())
-            for topic, topic_count in counts.items():
-                if topic_count > max_count / 2:
-                    instrument_to_category[instrument_id].append(topic)
-
-        for question in all_questions:
-            question["topics_auto"] = instrument_to_category[
-                question.get("instrument_id")
-            ]
+    with timer.stage("mhc_load"):
+        mhc_questions, mhc_all_metadata, mhc_embeddings, mhc_index = (
+            mhc.get_mhc_embeddings()
+        )
 
-    return all_questions, similarity_with_polarity.tolist(), query_similarity.tolist()
+    with timer.stage("mhc_search"):
+        # Work out similarity with MHC
+        if len(mhc_embeddings) > 0:
+            mhc_indices, mhc_similarities = mhc_index.search(
+                vectors_pos, k=mhc_top_k or 1
+            )
+            mhc_indices = mhc_indices[question_rows]
+            mhc_similarities = mhc_similarities[question_rows]
+
+            ctrs = {}
+            for idx, a in enumerate(mhc_indices[:, 0]):
+                if all_questions[idx].get("instrument_id") not in ctrs:
+                    ctrs[all_questions[idx].get("instrument_id")] = Counter()
+                for topic in mhc_all_metadata[a]["topics"]:
+                    ctrs[all_questions[idx].get("instrument_id")][topic] += 1
+                all_questions[idx]["nearest_match_from_mhc_auto"] = dict(
+                    mhc_questions[a]
+                )
+                if mhc_top_k:
+                    all_questions[idx]["nearest_matches_from_mhc_auto"] = [
+                        {"question": dict(mhc_questions[b]), "similarity": float(score)}
+                        for b, score in zip(mhc_indices[idx], mhc_similarities[idx])
+                        if b >= 0
+                    ]
+
+            instrument_to_category = {}
+            for instrument_id, counts in ctrs.items():
+                instrument_to_category[instrument_id] = []
+                max_count = max(counts.values())
+                for topic, topic_count in counts.items():
+                    if topic_count > max_count / 2:
+                        instrument_to_category[instrument_id].append(topic)
+
+            for question in all_questions:
+                question["topics_auto"] = instrument_to_category[
+                    question.get("instrument_id")
+                ]
+
+    return (
+        all_questions,
+        matches,
+        query_similarity.tolist() if query_similarity is not None else None,
+    )
@@ -0,0 +1,24 @@
+from azure.functions import HttpResponse, HttpRequest
+
+from ..utils import caches
+from ..utils import metrics
+
+# The caches aren't loaded by this endpoint, the gauges of a cache are only collected once it is loaded
+metrics.register_collector(caches.collect_metrics)
+
+
+def main(req: HttpRequest) -> HttpResponse:
+    """
+    Endpoint: GET /api/metrics
+
+    The metrics of the worker process in the Prometheus text format, see utils.metrics.
+    """
+
+    if req.method != "GET":
+        return HttpResponse("Method not allowed", status_code=405)
+
+    return HttpResponse(
+        body=metrics.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        status_code=200,
+    )
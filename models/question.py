@@ -26,6 +26,10 @@ class Question(BaseModel):
     nearest_match_from_mhc_auto: dict = Field(
         None, description="Automatically identified nearest MHC match"
     )
+    nearest_matches_from_mhc_auto: list = Field(
+        None,
+        description="Automatically identified nearest MHC matches with their similarity",
+    )
 
     class Config:
         schema_extra = {
@@ -1,29 +1,29 @@
+import asyncio
 import json
 import logging
-import os
-import tempfile
 import uuid
-from typing import Any
 
-import requests
+import aiohttp
 from azure.functions import HttpResponse, HttpRequest
 
 from .. import constants
+from ..utils import cached_instruments
+from ..utils import caches
+from ..utils import harmony_api
+from ..utils import hashing
 from ..utils import helpers
+from ..utils import metrics
+from ..utils.bounded_cache import BoundedCache
+from ..utils.single_flight import SingleFlight
 
-container = helpers.get_container_harmonycache()
+caches.warm_up(caches.get_instruments_cache)
 
-cache = helpers.get_cache_from_azure(cache_file_name=constants.cache_instruments_pkl)
 
-# While the function is running, the cache file must be temporarily saved in the temp dir
-cache_instruments_pkl_tmp_file_path = os.path.join(
-    tempfile.gettempdir(), constants.cache_instruments_pkl
-)
-
-
-def main(req: HttpRequest) -> HttpResponse:
+async def main(req: HttpRequest) -> HttpResponse:
     """
     Endpoint: POST /api/parse
+
+    Instruments are cached per file, and new cache entries are saved in the background after the response.
     """
 
     if req.method != "POST":
@@ -35,74 +35,164 @@ def main(req: HttpRequest) -> HttpResponse:
 
     req_body = req.get_body()
     if req_body:
+        timer = metrics.StageTimer(function="parse")
+        with timer.stage("cache"):
+            cache = await asyncio.to_thread(caches.get_instruments_cache)
+            caches.apply_synced_entries(cache_file_name=constants.cache_instruments_pkl)
+
         req_body_json = json.loads(req_body)
         files = req_body_json
 
+        # The JSON bytes of the instruments of each file in the response
         response = []
 
         # Check if 'files' is a list
         if not isinstance(files, list):
             return HttpResponse(
                 body="Invalid request",
-                headers={"Content-Type": "application/json"},
+                headers={"Content-Type": "application/json", **timer.finish()},
                 status_code=400,
             )
 
-        # A list of files whose instruments are not cached
+        # The unique files whose instruments are not cached, their keys, and the missing files with their unique file
         files_with_no_cached_instrument = []
+        hash_values = []
+        missing_files = []
+        missing_rows = []
+        miss_rows: dict[str, int] = {}
+
+        # The key of each unique content, a file sent more than once in a request is only hashed once
+        content_keys: dict[str, str] = {}
+
+        # The files whose instruments are only cached in the previous namespace, and their keys
+        files_to_warm = []
+        hash_values_to_warm = []
 
         for file in files:
             # Assign any missing IDs
             if file.get("file_id") is None:
                 file["file_id"] = uuid.uuid4().hex
 
+            # A file the client knows the key of may be sent without content, if its instrument is cached
+            content_hash = file.get("content_hash")
+            if hashing.is_content_key(content_hash):
+                with timer.stage("lookup"):
+                    instruments_json, is_current = get_cached_instruments(
+                        cache, content_hash
+                    )
+                if instruments_json is not None and (
+                    is_current or not file.get("content")
+                ):
+                    metrics.increment(
+                        "harmonycache_cache_hits_total", cache="cache_instruments"
+                    )
+                    response.append(instruments_json)
+                    continue
+
             # Check if 'content' is present
             if not file.get("content"):
-                logging.error(f"File with id '{file.get('file_id')}' has no content")
+                logging.error(
+                    f"File with id '{file.get('file_id')}' has no content and isn't cached"
+                )
                 continue
 
-            hash_value = helpers.get_hash_value(file["content"])
-            if hash_value in cache.keys():
-                # If instrument is cached
-                instrument = cache[hash_value]
-                response.append(instrument)
+            with timer.stage("hashing"):
+                content_key = content_keys.get(file["content"])
+                if content_key is None:
+                    content_key = hashing.get_content_key(file["content"])
+                    content_keys[file["content"]] = content_key
+                hash_value = hashing.add_namespace(
+                    content_key, constants.INSTRUMENTS_CACHE_NAMESPACE
+                )
+            with timer.stage("lookup"):
+                instruments_json, is_current = get_cached_instruments(
+                    cache, content_key
+                )
+            if instruments_json is not None:
+                # If instruments are cached
+                metrics.increment(
+                    "harmonycache_cache_hits_total", cache="cache_instruments"
+                )
+                response.append(instruments_json)
+                if not is_current:
+                    files_to_warm.append(file)
+                    hash_values_to_warm.append(hash_value)
             else:
-                # If instrument is not cached
-                files_with_no_cached_instrument.append(file)
+                # If instruments are not cached
+                metrics.increment(
+                    "harmonycache_cache_misses_total", cache="cache_instruments"
+                )
+                if hash_value not in miss_rows:
+                    miss_rows[hash_value] = len(files_with_no_cached_instrument)
+                    files_with_no_cached_instrument.append(file)
+                    hash_values.append(hash_value)
+                missing_files.append(file)
+                missing_rows.append(miss_rows[hash_value])
 
-        # Get instruments that aren't cached yet and cache them
+        # Get instruments that aren't cached yet and cache them, concurrent requests missing the same files share
+        # one call
         if files_with_no_cached_instrument:
-            response_parse = get_response_parse(
-                not_cached_files=files_with_no_cached_instrument
-            )
-            if response_parse.ok:
-                instruments: list = response_parse.json()
-                for file_with_no_cached_instrument in files_with_no_cached_instrument:
-                    instrument = get_file_instrument(
-                        file=file_with_no_cached_instrument, instruments=instruments
+            try:
+                with timer.stage("parse"):
+                    file_instruments = await parse_requests.get_many(
+                        keys=hash_values, items=files_with_no_cached_instrument
                     )
-                    if instrument:
-                        hash_value = helpers.get_hash_value(
-                            file_with_no_cached_instrument["content"]
-                        )
-                        cache[hash_value] = instrument
-                        response.append(instrument)
-            else:
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
                 error_msg = "Could not get instruments from Harmony API"
-                logging.error(error_msg)
-                return HttpResponse(body=error_msg, status_code=500)
-
-            # Save cache to storage
-            helpers.save_cache_to_blob_storage(
-                cache_tmp_file_path=cache_instruments_pkl_tmp_file_path,
-                cache_file_name=constants.cache_instruments_pkl,
-                cache=cache,
+                logging.exception(error_msg)
+                return HttpResponse(
+                    body=error_msg, headers=timer.finish(), status_code=500
+                )
+
+            with timer.stage("store"):
+                files_instruments_json = cache_instruments(
+                    cache=cache,
+                    hash_values=hash_values,
+                    file_instruments=file_instruments,
+                )
+            # The instruments of a unique file are shared by the files with its content, in this request and in
+            # concurrent requests, and each file gets them with its own ID
+            for file, row in zip(missing_files, missing_rows):
+                if files_instruments_json[row] is None:
+                    continue
+                if all(
+                    instrument.get("file_id") == file["file_id"]
+                    for instrument in file_instruments[row]
+                ):
+                    response.append(files_instruments_json[row])
+                else:
+                    response.append(
+                        cached_instruments.get_instruments_json(
+                            cached_instruments.to_json(
+                                with_file_id(file_instruments[row], file["file_id"])
+                            )
+                        )
+                    )
+
+        # Instruments of the previous namespace are parsed again for the current namespace after the response
+        if files_to_warm:
+            helpers.run_in_background(
+                warm_instruments(
+                    cache=cache, hash_values=hash_values_to_warm, files=files_to_warm
+                )
+            )
+
+        with timer.stage("serialize"):
+            body = (
+                b"["
+                + b",".join(
+                    instruments_json
+                    for instruments_json in response
+                    if instruments_json
+                )
+                + b"]"
             )
 
         return HttpResponse(
-            body=json.dumps(response),
+            body=body,
             headers={
                 "Content-Type": "application/json",
+                **timer.finish(),
             },
             status_code=200,
         )
@@ -114,19 +204,120 @@ def main(req: HttpRequest) -> HttpResponse:
         )
 
 
-def get_response_parse(not_cached_files: list) -> requests.Response:
-    """Get response parse"""
+def get_cached_instruments(
+    cache: BoundedCache, content_key: str
+) -> tuple[bytes | None, bool]:
+    """
+    Get the JSON bytes of the cached instruments of a content key, from the current namespace, or else from the
+    previous namespace, see utils.cached_instruments.get_instruments_json
+    :return: the JSON bytes, None if the instruments aren't cached, and whether they are from the current namespace
+    """
 
-    return requests.post(
-        url=f"{constants.harmony_api}/text/parse",
-        data=json.dumps(not_cached_files),
-        headers={"Content-Type": "application/json"},
+    hash_value = hashing.add_namespace(
+        content_key, constants.INSTRUMENTS_CACHE_NAMESPACE
     )
+    if hash_value in cache:
+        return cached_instruments.get_instruments_json(cache[hash_value]), True
 
+    if constants.INSTRUMENTS_CACHE_PREVIOUS_NAMESPACE is not None:
+        hash_value = hashing.add_namespace(
+            content_key, constants.INSTRUMENTS_CACHE_PREVIOUS_NAMESPACE
+        )
+        if hash_value in cache:
+            return cached_instruments.get_instruments_json(cache[hash_value]), False
+
+    return None, False
 
-def get_file_instrument(file: Any, instruments: list):
-    """Get file instrument"""
 
+def cache_instruments(
+    cache: BoundedCache, hash_values: list[str], file_instruments: list[list]
+) -> list[bytes | None]:
+    """
+    Cache the instruments parsed from files, and save the new cache entries in the background
+    :return: the JSON bytes of the instruments of each file, see get_cached_instruments, None for a file without
+        instruments
+    """
+
+    files_instruments_json = []
+    new_entries = {}
+    for hash_value, instruments in zip(hash_values, file_instruments):
+        if not instruments:
+            files_instruments_json.append(None)
+            continue
+        value = cached_instruments.to_json(instruments)
+        # Only the first request to get shared instruments caches and saves them
+        if hash_value not in cache:
+            cache[hash_value] = value
+            new_entries[hash_value] = value
+        files_instruments_json.append(cached_instruments.get_instruments_json(value))
+
+    helpers.trim_and_save_cache_in_background(
+        cache=cache,
+        cache_file_name=constants.cache_instruments_pkl,
+        new_entries=new_entries,
+    )
+
+    return files_instruments_json
+
+
+async def warm_instruments(cache: BoundedCache, hash_values: list[str], files: list):
+    """Parse files whose instruments are only cached in the previous namespace, and cache them"""
+
+    try:
+        file_instruments = await parse_requests.get_many(keys=hash_values, items=files)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        logging.exception("Could not warm instruments from Harmony API")
+        return
+
+    cache_instruments(
+        cache=cache, hash_values=hash_values, file_instruments=file_instruments
+    )
+
+
+def with_file_id(instruments: list, file_id: str) -> list:
+    """Copy instruments with the ID of a file, the instruments are left unchanged"""
+
+    return [{**instrument, "file_id": file_id} for instrument in instruments]
+
+
+def get_instruments_by_file_id(instruments: list) -> dict[str, list]:
+    """Get the instruments of each file ID, in the order of the instruments"""
+
+    instruments_by_file_id = {}
     for instrument in instruments:
-        if instrument.get("file_id") == file.get("file_id"):
-            return instrument
+        instruments_by_file_id.setdefault(instrument.get("file_id"), []).append(
+            instrument
+        )
+
+    return instruments_by_file_id
+
+
+async def parse_files(files: list) -> list[list]:
+    """
+    Parse files into the instruments of each file, an empty list for a file without instruments
+
+    Files of concurrent requests are parsed together and may have the same ID, so every file is sent with an ID of
+    its own and its instruments get the ID of the file back.
+    """
+
+    file_ids = [uuid.uuid4().hex for _ in files]
+    instruments = await harmony_api.parse_async(
+        [{**file, "file_id": file_id} for file, file_id in zip(files, file_ids)]
+    )
+
+    # The instruments are indexed once, rather than searched for each file
+    instruments_by_file_id = get_instruments_by_file_id(instruments)
+
+    file_instruments = []
+    for file, file_id in zip(files, file_ids):
+        instruments_of_file = instruments_by_file_id.get(file_id, [])
+        for instrument in instruments_of_file:
+            instrument["file_id"] = file.get("file_id")
+        file_instruments.append(instruments_of_file)
+
+    return file_instruments
+
+
+parse_requests = SingleFlight(
+    fetch=parse_files, window_seconds=constants.COALESCING_WINDOW_SECONDS
+)
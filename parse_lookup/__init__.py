@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+from azure.functions import HttpResponse, HttpRequest
+
+from .. import constants
+from ..utils import cached_instruments
+from ..utils import caches
+from ..utils import hashing
+
+caches.warm_up(caches.get_instruments_cache)
+
+
+async def main(req: HttpRequest) -> HttpResponse:
+    """
+    Endpoint: POST /api/parse/lookup
+
+    Look up the cached instruments of content hashes, so a client only sends the files that are missing to /api/parse.
+    """
+
+    if req.method != "POST":
+        return HttpResponse(
+            "Method not allowed",
+            headers={"Content-Type": "application/json"},
+            status_code=405,
+        )
+
+    try:
+        content_hashes = json.loads(req.get_body())
+    except ValueError:
+        content_hashes = None
+
+    # Check if 'content_hashes' is a list of strings
+    if not isinstance(content_hashes, list) or not all(
+        isinstance(content_hash, str) for content_hash in content_hashes
+    ):
+        return HttpResponse(
+            body="Invalid request",
+            headers={"Content-Type": "application/json"},
+            status_code=400,
+        )
+
+    cache = await asyncio.to_thread(caches.get_instruments_cache)
+    caches.apply_synced_entries(cache_file_name=constants.cache_instruments_pkl)
+
+    # Only instruments in the current namespace are hits, a file only cached in the previous namespace is sent to
+    # /api/parse, which returns its instruments and parses it again in the background
+    hits = []
+    missing = []
+    for content_hash in dict.fromkeys(content_hashes):
+        hash_value = hashing.add_namespace(
+            content_hash, constants.INSTRUMENTS_CACHE_NAMESPACE
+        )
+        if hashing.is_content_key(content_hash) and hash_value in cache:
+            hits.append(
+                b'{"content_hash": '
+                + json.dumps(content_hash).encode()
+                + b', "instruments": ['
+                + cached_instruments.get_instruments_json(cache[hash_value])
+                + b"]}"
+            )
+        else:
+            missing.append(content_hash)
+
+    return HttpResponse(
+        body=b'{"hits": ['
+        + b", ".join(hits)
+        + b'], "missing": '
+        + json.dumps(missing).encode()
+        + b"}",
+        headers={"Content-Type": "application/json"},
+        status_code=200,
+    )
@@ -0,0 +1,15 @@
+"""
+The Functions host imports the function app as the package '__app__', so its modules import each other relatively.
+The tests import it the same way.
+"""
+
+import os
+import sys
+import types
+
+app_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "__app__" not in sys.modules:
+    package = types.ModuleType("__app__")
+    package.__path__ = [app_root]
+    sys.modules["__app__"] = package
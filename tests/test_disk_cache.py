@@ -0,0 +1,94 @@
+import hashlib
+import types
+
+from azure.core.exceptions import ResourceModifiedError
+from azure.core.exceptions import ResourceNotFoundError
+
+from __app__.utils import cache_storage
+from __app__.utils import disk_cache
+from __app__.utils.disk_cache import DiskCache
+
+cache_file_name = "cache_test.pkl"
+
+
+class Container:
+    """A container of blobs in memory"""
+
+    def __init__(self):
+        self.blobs: dict[str, tuple[bytes, dict | None]] = {}
+        self.downloads: list[str] = []
+
+    def get_etag(self, name: str) -> str:
+        return f'"{hashlib.md5(self.blobs[name][0]).hexdigest()}"'
+
+    def download_blob(self, blob: str, **kwargs):
+        if blob not in self.blobs:
+            raise ResourceNotFoundError(blob)
+        self.downloads.append(blob)
+        data = self.blobs[blob][0]
+
+        return types.SimpleNamespace(
+            readall=lambda: data,
+            properties=types.SimpleNamespace(etag=self.get_etag(blob)),
+        )
+
+    def upload_blob(self, name: str, data, etag=None, metadata=None, **kwargs):
+        if etag is not None and (name not in self.blobs or self.get_etag(name) != etag):
+            raise ResourceModifiedError(name)
+        self.blobs[name] = (data, metadata)
+
+    def delete_blob(self, blob: str, **kwargs):
+        del self.blobs[blob]
+
+    def list_blobs(self, name_starts_with: str = "", **kwargs):
+        for name in sorted(self.blobs):
+            if name.startswith(name_starts_with):
+                yield types.SimpleNamespace(
+                    name=name, etag=self.get_etag(name), metadata=self.blobs[name][1]
+                )
+
+    def get_blob_client(self, blob: str):
+        return types.SimpleNamespace(exists=lambda: blob in self.blobs)
+
+
+def sync(container: Container, disk: DiskCache) -> list[str]:
+    """Sync a disk tier and return the names of the blobs downloaded"""
+
+    container.downloads = []
+    disk_cache.sync_from_blob_storage(
+        container=container, cache_file_name=cache_file_name, disk=disk
+    )
+
+    return container.downloads
+
+
+def test_sync_applies_new_segments(tmp_path):
+    container = Container()
+    disk = DiskCache(str(tmp_path / "cache.sqlite"))
+    cache_storage.append_entries(container, cache_file_name, {"aa1": 1, "bb1": 2})
+
+    assert len(sync(container, disk)) == 2
+    assert disk.get_many(["aa1", "bb1"]) == {"aa1": 1, "bb1": 2}
+    assert sync(container, disk) == []
+
+
+def test_sync_skips_shards_compacted_from_synced_segments(tmp_path):
+    container = Container()
+    disk = DiskCache(str(tmp_path / "cache.sqlite"))
+    cache_storage.append_entries(container, cache_file_name, {"aa1": 1, "bb1": 2})
+    sync(container, disk)
+
+    cache_storage.compact(container, cache_file_name)
+
+    assert sync(container, disk) == []
+    assert disk.get_many(["aa1", "bb1"]) == {"aa1": 1, "bb1": 2}
+
+    # A segment compacted before it was synced changes the shard of its prefix only
+    cache_storage.append_entries(container, cache_file_name, {"aa1": None, "aa2": 3})
+    cache_storage.compact(container, cache_file_name)
+
+    assert sync(container, disk) == [
+        cache_storage.get_shard_blob_name(cache_file_name, "aa")
+    ]
+    assert disk.get_many(["aa1", "aa2", "bb1"]) == {"aa2": 3, "bb1": 2}
+    assert sync(container, disk) == []
@@ -0,0 +1,99 @@
+import pytest
+
+from __app__.utils import eviction
+from __app__.utils.eviction import EvictionPolicy
+
+
+def add_entries(policy: EvictionPolicy, keys: list[str], nbytes: int = 1):
+    for key in keys:
+        policy.add(key, nbytes)
+
+
+def test_unknown_policy_raises():
+    with pytest.raises(ValueError):
+        EvictionPolicy(policy="fifo")
+
+
+def test_no_budget_selects_nothing():
+    policy = EvictionPolicy(policy="lru", ttl_seconds=0)
+    add_entries(policy, [str(i) for i in range(100)])
+
+    assert policy.select() == []
+
+
+def test_tracks_entries_and_bytes():
+    policy = EvictionPolicy(ttl_seconds=0)
+    policy.add("a", 10)
+    policy.add("b", 5)
+    policy.add("a", 3)
+
+    assert len(policy) == 2
+    assert policy.nbytes == 8
+
+    policy.remove("a")
+
+    assert "a" not in policy
+    assert policy.nbytes == 5
+
+
+def test_lru_evicts_least_recently_used_down_to_the_low_watermark():
+    policy = EvictionPolicy(policy="lru", max_entries=10, ttl_seconds=0)
+    add_entries(policy, [str(i) for i in range(11)])
+    policy.touch("0")
+    policy.touch("1")
+
+    # 11 entries are trimmed to 90% of 10
+    assert policy.select() == ["2", "3"]
+
+
+def test_lfu_evicts_least_frequently_used_then_least_recently_used():
+    policy = EvictionPolicy(policy="lfu", max_entries=4, ttl_seconds=0)
+    add_entries(policy, ["a", "b", "c", "d", "e"])
+    for key in ["a", "a", "b", "c", "c", "e"]:
+        policy.touch(key)
+
+    # d was used least often, then b, which was used before e
+    assert policy.select() == ["d", "b"]
+
+
+def test_ttl_policy_evicts_oldest_entries_first():
+    policy = EvictionPolicy(policy="ttl", max_entries=4, ttl_seconds=0)
+    add_entries(policy, ["a", "b", "c", "d", "e"])
+    policy.touch("a")
+
+    assert policy.select() == ["a", "b"]
+
+
+def test_byte_budget():
+    policy = EvictionPolicy(policy="lru", max_bytes=100, ttl_seconds=0)
+    add_entries(policy, ["a", "b", "c"], nbytes=40)
+
+    # 120 bytes are trimmed to 90 bytes
+    assert policy.select() == ["a"]
+
+
+def test_expired_entries_are_selected_whatever_the_budget(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(eviction.time, "time", lambda: now)
+    policy = EvictionPolicy(policy="lru", ttl_seconds=60)
+    add_entries(policy, ["a", "b"])
+    now = 1030.0
+    add_entries(policy, ["c"])
+
+    now = 1070.0
+
+    assert policy.select_expired() == ["a", "b"]
+    assert policy.select() == ["a", "b"]
+
+
+def test_replacing_an_entry_renews_it(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(eviction.time, "time", lambda: now)
+    policy = EvictionPolicy(policy="lru", ttl_seconds=60)
+    add_entries(policy, ["a", "b"])
+    now = 1050.0
+    add_entries(policy, ["a"])
+
+    now = 1070.0
+
+    assert policy.select_expired() == ["b"]
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from __app__.utils import json_segments
+
+
+def test_segment_round_trip_with_tombstone_and_compression(monkeypatch):
+    monkeypatch.setattr(json_segments.constants, "CACHE_COMPRESS_MIN_BYTES", 100)
+    large = {"questions": ["How often have you felt down?"] * 50}
+    entries = {
+        "b": {"instrument_name": "small"},
+        "a": large,
+        "c": None,
+        "d": b'{"already": "json"}',
+    }
+
+    data = json_segments.write_segment(entries)
+    reader = json_segments.SegmentReader(data)
+
+    assert json_segments.is_segment(data)
+    # The large value is stored compressed
+    assert len(data) < len(json.dumps(large))
+    assert len(reader) == 4
+    assert reader.keys() == ["a", "b", "c", "d"]
+    assert json.loads(reader.get("a")) == large
+    assert json.loads(reader.get("b")) == {"instrument_name": "small"}
+    assert reader.get("d") == b'{"already": "json"}'
+    assert "c" in reader
+    assert reader.get("c") is None
+    assert "x" not in reader
+    assert reader.get("x", "default") == "default"
+    assert reader.to_dict() == {
+        "a": json.dumps(large).encode(),
+        "b": json.dumps({"instrument_name": "small"}).encode(),
+        "c": None,
+        "d": b'{"already": "json"}',
+    }
+
+
+def test_empty_segment():
+    reader = json_segments.SegmentReader(json_segments.write_segment({}))
+
+    assert len(reader) == 0
+    assert list(reader.items()) == []
+
+
+def test_non_ascii_keys_and_values():
+    entries = {"clé": {"texte": "À quelle fréquence ?"}}
+
+    reader = json_segments.SegmentReader(json_segments.write_segment(entries))
+
+    assert json.loads(reader.get("clé")) == entries["clé"]
+
+
+@pytest.mark.parametrize("data", [b"", b"not a segment", json_segments.magic])
+def test_reading_something_else_raises(data):
+    with pytest.raises(ValueError):
+        json_segments.SegmentReader(data)
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import importlib
+import json
+
+import numpy as np
+import pytest
+from azure.functions import HttpRequest
+
+from __app__.utils import caches
+from __app__.utils import helpers
+from __app__.utils import mhc
+from __app__.utils import similarity
+from __app__.utils.negator import negate_many
+from __app__.utils.vector_store import VectorStore
+from test_similarity import get_baseline_similarity_with_polarity
+
+
+def get_vector(text: str, dim: int) -> list[float]:
+    """A vector that only depends on the text"""
+
+    rng = np.random.default_rng(int(hashlib.sha256(text.encode()).hexdigest()[:8], 16))
+
+    return rng.standard_normal(dim).tolist()
+
+
+class Fetcher:
+    """Records the texts of each fetch and returns their vectors"""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.calls: list[list[str]] = []
+
+    async def __call__(self, texts: list[str]) -> list[list[float]]:
+        self.calls.append(list(texts))
+
+        return [get_vector(text, self.dim) for text in texts]
+
+
+@pytest.fixture
+def match(monkeypatch):
+    # The caches are set by the tests instead of being loaded from blob storage
+    monkeypatch.setattr(caches, "warm_up", lambda *getters: None)
+    module = importlib.import_module("__app__.match")
+
+    monkeypatch.setattr(helpers, "save_cache_in_background", lambda **kwargs: None)
+    monkeypatch.setattr(
+        mhc, "get_mhc_embeddings", lambda: ([], [], np.zeros((0, 16)), None)
+    )
+    monkeypatch.setattr(module.constants, "VECTORS_CACHE_PREVIOUS_NAMESPACE", None)
+    monkeypatch.setattr(module.constants, "VECTORS_CACHE_NAMESPACE", "")
+
+    return module
+
+
+def set_caches(monkeypatch, cache: VectorStore, previous_cache: VectorStore | None):
+    monkeypatch.setattr(caches, "get_vectors_cache", lambda: cache)
+    monkeypatch.setattr(caches, "get_previous_vectors_cache", lambda: previous_cache)
+
+
+def make_request(instruments: list) -> HttpRequest:
+    return HttpRequest(
+        method="POST",
+        url="http://localhost/api/match",
+        body=json.dumps({"instruments": instruments}).encode(),
+    )
+
+
+def get_instruments(question_texts: list[str]) -> list:
+    return [
+        {
+            "file_id": "f1",
+            "instrument_id": "i1",
+            "language": "en",
+            "questions": [
+                {"question_no": str(i), "question_text": text}
+                for i, text in enumerate(question_texts)
+            ],
+        }
+    ]
+
+
+def call(match, req: HttpRequest):
+    """Call the endpoint and wait for its background tasks"""
+
+    async def run():
+        response = await match.main(req)
+        while helpers._background_tasks:
+            await asyncio.gather(*list(helpers._background_tasks))
+        return response
+
+    return asyncio.run(run())
+
+
+def test_a_new_namespace_can_have_vectors_of_another_dimension(match, monkeypatch):
+    texts = ["I feel sad", "I am happy", "I sleep well"]
+    monkeypatch.setattr(match.constants, "VECTORS_CACHE_PREVIOUS_NAMESPACE", "v1")
+
+    # The previous model had vectors of dimension 8, the current model has vectors of dimension 16
+    previous_cache = VectorStore()
+    for text in texts + negate_many(texts, ["en"] * len(texts)):
+        previous_cache.add(
+            match.get_vector_key(text, "v1"), text=text, vector=get_vector(text, 8)
+        )
+    cache = VectorStore()
+    set_caches(monkeypatch, cache=cache, previous_cache=previous_cache)
+    fetcher = Fetcher(dim=16)
+    monkeypatch.setattr(match.vector_requests, "fetch", fetcher)
+
+    # The previous namespace is used while the current namespace is warmed in the background
+    response = call(match, make_request(get_instruments(texts)))
+    assert response.status_code == 200
+    assert len(fetcher.calls) == 1
+    assert cache.dim == 16 and len(cache) == 6
+    assert previous_cache.dim == 8
+
+    # Once it is warmed, the current namespace is used
+    response = call(match, make_request(get_instruments(texts)))
+    assert response.status_code == 200
+    assert len(fetcher.calls) == 1
+
+
+def test_matches_of_cached_and_missing_texts(match, monkeypatch):
+    texts = [
+        "I feel sad",
+        "I am happy",
+        "I feel sad",
+        "I sleep well",
+        "I am happy",
+        "I worry a lot",
+    ]
+    negated_texts = negate_many(texts, ["en"] * len(texts))
+
+    # Some questions and some negated texts are cached, the other texts are missing
+    cache = VectorStore()
+    for text in ["I am happy", negated_texts[0], negated_texts[5]]:
+        cache.add(match.get_vector_key(text), text=text, vector=get_vector(text, 16))
+    set_caches(monkeypatch, cache=cache, previous_cache=None)
+    fetcher = Fetcher(dim=16)
+    monkeypatch.setattr(match.vector_requests, "fetch", fetcher)
+
+    response = call(match, make_request(get_instruments(texts)))
+
+    assert response.status_code == 200
+    assert sorted(
+        text for call_texts in fetcher.calls for text in call_texts
+    ) == sorted(
+        {
+            "I feel sad",
+            "I sleep well",
+            "I worry a lot",
+            negated_texts[1],
+            negated_texts[3],
+        }
+    )
+    expected = get_baseline_similarity_with_polarity(
+        similarity.normalize([get_vector(text, 16) for text in texts]),
+        similarity.normalize([get_vector(text, 16) for text in negated_texts]),
+    )
+    np.testing.assert_allclose(
+        json.loads(response.get_body())["matches"], expected, atol=1e-5
+    )
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from __app__.utils import nn_index
+from __app__.utils.similarity import normalize
+
+
+def get_vectors(n: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    return normalize(np.random.default_rng(seed).standard_normal((n, dim)))
+
+
+def get_brute_force_top_k(
+    vectors: np.ndarray, queries: np.ndarray, k: int
+) -> tuple[np.ndarray, np.ndarray]:
+    scores = np.matmul(queries, vectors.T)
+    indices = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+
+    return indices, np.take_along_axis(scores, indices, axis=1)
+
+
+@pytest.mark.parametrize("block_size", [7, 4096])
+def test_exact_index_matches_brute_force(block_size):
+    vectors = get_vectors(100)
+    queries = get_vectors(10, seed=1)
+    expected_indices, expected_scores = get_brute_force_top_k(vectors, queries, 5)
+
+    indices, scores = nn_index.ExactIndex(vectors, block_size=block_size).search(
+        queries, k=5
+    )
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_exact_index_k_larger_than_the_index():
+    vectors = get_vectors(3)
+
+    indices, scores = nn_index.ExactIndex(vectors).search(vectors, k=10)
+
+    assert indices.shape == (3, 3)
+    np.testing.assert_array_equal(indices[:, 0], [0, 1, 2])
+    np.testing.assert_allclose(scores[:, 0], 1, atol=1e-6)
+
+
+def test_ivf_index_probing_all_lists_is_exact():
+    vectors = get_vectors(200)
+    queries = get_vectors(10, seed=1)
+    expected_indices, expected_scores = get_brute_force_top_k(vectors, queries, 5)
+
+    index = nn_index.IVFIndex(vectors, n_lists=8, n_probe=8)
+    indices, scores = index.search(queries, k=5)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_ivf_index_lists_partition_the_vectors():
+    index = nn_index.IVFIndex(get_vectors(200), n_lists=8, n_probe=2)
+
+    assert index.offsets[0] == 0 and index.offsets[-1] == 200
+    assert sorted(index.order.tolist()) == list(range(200))
+
+
+def test_ivf_index_finds_the_vectors_themselves():
+    vectors = get_vectors(200)
+
+    indices, scores = nn_index.IVFIndex(vectors, n_lists=8, n_probe=1).search(
+        vectors, k=1
+    )
+
+    # A vector is always in the list of its closest centroid
+    np.testing.assert_array_equal(indices[:, 0], np.arange(200))
+    np.testing.assert_allclose(scores[:, 0], 1, atol=1e-6)
+
+
+def test_ivf_index_searches_queries_of_empty_lists_exactly():
+    vectors = get_vectors(200)
+    query = get_vectors(1, seed=1)
+    expected_indices, expected_scores = get_brute_force_top_k(vectors, query, 3)
+
+    # An empty list whose centroid is the query, e.g. a cluster that lost all its vectors in the last iteration
+    index = nn_index.IVFIndex(vectors, n_lists=8, n_probe=1)
+    index.centroids = np.concatenate([index.centroids, query])
+    index.offsets = np.append(index.offsets, index.offsets[-1])
+    index.n_lists += 1
+    indices, scores = index.search(query, k=3)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-6)
+
+
+def test_build_index():
+    vectors = get_vectors(10)
+
+    assert isinstance(nn_index.build_index(vectors, kind="exact"), nn_index.ExactIndex)
+    assert isinstance(nn_index.build_index(vectors, kind="ivf"), nn_index.IVFIndex)
+    assert isinstance(
+        nn_index.build_index(vectors[:0], kind="ivf"), nn_index.ExactIndex
+    )
@@ -0,0 +1,86 @@
+import asyncio
+import importlib
+import json
+
+import pytest
+from azure.functions import HttpRequest
+
+from __app__.utils import caches
+from __app__.utils import harmony_api
+from __app__.utils import helpers
+from __app__.utils.bounded_cache import BoundedCache
+
+
+class Parser:
+    """Records the files of each parse and returns one instrument per file"""
+
+    def __init__(self):
+        self.calls: list[list] = []
+
+    async def __call__(self, files: list) -> list:
+        self.calls.append(files)
+        await asyncio.sleep(0)
+
+        return [
+            {"file_id": file["file_id"], "instrument_name": file["file_name"]}
+            for file in files
+        ]
+
+
+@pytest.fixture
+def parse(monkeypatch):
+    # The cache is set by the tests instead of being loaded from blob storage
+    monkeypatch.setattr(caches, "warm_up", lambda *getters: None)
+    module = importlib.import_module("__app__.parse")
+
+    cache = BoundedCache()
+    monkeypatch.setattr(caches, "get_instruments_cache", lambda: cache)
+    monkeypatch.setattr(helpers, "save_cache_in_background", lambda **kwargs: None)
+    monkeypatch.setattr(module.constants, "INSTRUMENTS_CACHE_PREVIOUS_NAMESPACE", None)
+
+    return module
+
+
+def make_request(files: list) -> HttpRequest:
+    return HttpRequest(
+        method="POST",
+        url="http://localhost/api/parse",
+        body=json.dumps(files).encode(),
+    )
+
+
+def get_file(file_id: str, content: str = "data:text/plain;base64,UEhR") -> dict:
+    return {"file_id": file_id, "file_name": "PHQ.txt", "content": content}
+
+
+def get_file_ids(response) -> list[str]:
+    return [instrument["file_id"] for instrument in json.loads(response.get_body())]
+
+
+def test_a_file_sent_twice_is_parsed_once(parse, monkeypatch):
+    parser = Parser()
+    monkeypatch.setattr(harmony_api, "parse_async", parser)
+
+    response = asyncio.run(
+        parse.main(make_request([get_file("a"), get_file("b"), get_file("c", "x")]))
+    )
+
+    assert response.status_code == 200
+    assert get_file_ids(response) == ["a", "b", "c"]
+    assert len(parser.calls) == 1 and len(parser.calls[0]) == 2
+
+
+def test_concurrent_requests_share_a_parse(parse, monkeypatch):
+    parser = Parser()
+    monkeypatch.setattr(harmony_api, "parse_async", parser)
+
+    async def run():
+        return await asyncio.gather(
+            parse.main(make_request([get_file("a")])),
+            parse.main(make_request([get_file("b")])),
+        )
+
+    responses = asyncio.run(run())
+
+    assert [get_file_ids(response) for response in responses] == [["a"], ["b"]]
+    assert len(parser.calls) == 1 and len(parser.calls[0]) == 1
@@ -0,0 +1,117 @@
+import numpy as np
+
+from __app__.utils import similarity
+
+
+def get_baseline_similarity_with_polarity(
+    vectors_pos: np.ndarray, vectors_neg: np.ndarray
+) -> np.ndarray:
+    """The dense similarity with polarity of Harmony, before it was computed in blocks"""
+
+    pairwise_similarity = similarity.cosine_similarity(vectors_pos, vectors_pos)
+    pairwise_similarity_neg1 = similarity.cosine_similarity(vectors_neg, vectors_pos)
+    pairwise_similarity_neg2 = similarity.cosine_similarity(vectors_pos, vectors_neg)
+    pairwise_similarity_neg_mean = np.mean(
+        [pairwise_similarity_neg1, pairwise_similarity_neg2], axis=0
+    )
+
+    similarity_difference = pairwise_similarity - pairwise_similarity_neg_mean
+    similarity_polarity = np.sign(similarity_difference)
+    similarity_polarity[np.abs(similarity_difference) < 0.001] = 1
+
+    similarity_max = np.max([pairwise_similarity, pairwise_similarity_neg_mean], axis=0)
+
+    return similarity_max * similarity_polarity
+
+
+def get_vectors(n: int, dim: int = 16, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    vectors_pos = similarity.normalize(rng.standard_normal((n, dim)))
+    # Negated texts are close to the opposite of some of the texts, so both polarities occur
+    vectors_neg = similarity.normalize(
+        np.where(rng.random((n, 1)) < 0.5, -1, 1) * vectors_pos
+        + 0.5 * rng.standard_normal((n, dim))
+    )
+
+    return vectors_pos, vectors_neg
+
+
+def test_normalize():
+    vectors = similarity.normalize([[3, 4], [0, 0]])
+
+    np.testing.assert_allclose(vectors, [[0.6, 0.8], [0, 0]])
+
+
+def test_similarity_with_polarity_matches_the_baseline(monkeypatch):
+    vectors_pos, vectors_neg = get_vectors(50)
+    expected = get_baseline_similarity_with_polarity(vectors_pos, vectors_neg)
+
+    # Several blocks, the last one partial
+    monkeypatch.setattr(similarity.constants, "SIMILARITY_BLOCK_SIZE", 16)
+    result = similarity.get_similarity_with_polarity(vectors_pos, vectors_neg)
+
+    assert (expected < 0).any() and (expected > 0).any()
+    np.testing.assert_allclose(result, expected, atol=1e-5)
+
+
+def test_iter_similarity_with_polarity_covers_all_rows():
+    vectors_pos, vectors_neg = get_vectors(20)
+    expected = get_baseline_similarity_with_polarity(vectors_pos, vectors_neg)
+
+    blocks = [
+        (rows, block.copy())
+        for rows, block in similarity.iter_similarity_with_polarity(
+            vectors_pos, vectors_neg, block_size=8
+        )
+    ]
+
+    assert [(rows.start, rows.stop) for rows, _ in blocks] == [
+        (0, 8),
+        (8, 16),
+        (16, 20),
+    ]
+    np.testing.assert_allclose(
+        np.concatenate([block for _, block in blocks]), expected, atol=1e-5
+    )
+
+
+def test_sparse_similarity_with_polarity_keeps_top_k():
+    vectors_pos, vectors_neg = get_vectors(30)
+    expected = get_baseline_similarity_with_polarity(vectors_pos, vectors_neg)
+    np.fill_diagonal(expected, 0)
+
+    indptr, indices, data = similarity.get_sparse_similarity_with_polarity(
+        vectors_pos, vectors_neg, top_k=3
+    )
+
+    assert indptr.tolist() == list(range(0, 91, 3))
+    for row in range(30):
+        columns = indices[indptr[row] : indptr[row + 1]]
+        assert row not in columns
+        np.testing.assert_allclose(
+            np.abs(data[indptr[row] : indptr[row + 1]]),
+            np.sort(np.abs(expected[row]))[::-1][:3],
+            atol=1e-5,
+        )
+        np.testing.assert_allclose(
+            data[indptr[row] : indptr[row + 1]], expected[row, columns], atol=1e-5
+        )
+
+
+def test_sparse_similarity_with_polarity_filters_pairs():
+    vectors_pos, vectors_neg = get_vectors(30)
+    groups = np.arange(30) % 3
+    expected = get_baseline_similarity_with_polarity(vectors_pos, vectors_neg)
+    keep = (np.abs(expected) >= 0.2) & (groups[:, None] != groups[None, :])
+
+    indptr, indices, data = similarity.get_sparse_similarity_with_polarity(
+        vectors_pos, vectors_neg, min_similarity=0.2, groups=groups
+    )
+
+    result = np.zeros((30, 30))
+    for row in range(30):
+        result[row, indices[indptr[row] : indptr[row + 1]]] = data[
+            indptr[row] : indptr[row + 1]
+        ]
+    assert indptr[-1] == keep.sum()
+    np.testing.assert_allclose(result, np.where(keep, expected, 0), atol=1e-5)
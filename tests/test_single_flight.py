@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from __app__.utils.single_flight import SingleFlight
+
+
+class Fetcher:
+    """Records the items of each fetch and returns the items in upper case"""
+
+    def __init__(self, error: Exception | None = None, n_results: int | None = None):
+        self.calls: list[list] = []
+        self.error = error
+        self.n_results = n_results
+
+    async def __call__(self, items: list) -> list:
+        self.calls.append(list(items))
+        await asyncio.sleep(0)
+        if self.error is not None:
+            raise self.error
+        results = [item.upper() for item in items]
+
+        return results if self.n_results is None else results[: self.n_results]
+
+
+def test_repeated_keys_of_a_request_are_fetched_once():
+    fetcher = Fetcher()
+    single_flight = SingleFlight(fetch=fetcher, window_seconds=0)
+
+    results = asyncio.run(single_flight.get_many(["a", "b", "a"], ["x", "y", "x"]))
+
+    assert results == ["X", "Y", "X"]
+    assert fetcher.calls == [["x", "y"]]
+    assert len(single_flight) == 0
+
+
+def test_concurrent_requests_share_one_fetch():
+    fetcher = Fetcher()
+    single_flight = SingleFlight(fetch=fetcher, window_seconds=0.01)
+
+    async def run():
+        return await asyncio.gather(
+            single_flight.get_many(["a", "b"], ["x", "y"]),
+            single_flight.get_many(["b", "c"], ["y", "z"]),
+        )
+
+    assert asyncio.run(run()) == [["X", "Y"], ["Y", "Z"]]
+    assert fetcher.calls == [["x", "y", "z"]]
+
+
+def test_keys_are_fetched_again_once_the_fetch_is_done():
+    fetcher = Fetcher()
+    single_flight = SingleFlight(fetch=fetcher, window_seconds=0)
+
+    async def run():
+        await single_flight.get_many(["a"], ["x"])
+        await single_flight.get_many(["a"], ["x"])
+
+    asyncio.run(run())
+
+    assert fetcher.calls == [["x"], ["x"]]
+
+
+def test_an_error_is_raised_in_every_waiting_request():
+    fetcher = Fetcher(error=ValueError("upstream"))
+    single_flight = SingleFlight(fetch=fetcher, window_seconds=0.01)
+
+    async def run():
+        return await asyncio.gather(
+            single_flight.get_many(["a"], ["x"]),
+            single_flight.get_many(["a", "b"], ["x", "y"]),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert len(fetcher.calls) == 1
+    assert len(single_flight) == 0
+
+
+def test_a_fetch_with_missing_results_raises():
+    single_flight = SingleFlight(fetch=Fetcher(n_results=1), window_seconds=0)
+
+    with pytest.raises(ValueError):
+        asyncio.run(single_flight.get_many(["a", "b"], ["x", "y"]))
+
+
+def test_a_cancelled_request_does_not_cancel_the_others():
+    fetcher = Fetcher()
+    single_flight = SingleFlight(fetch=fetcher, window_seconds=0.01)
+
+    async def run():
+        cancelled = asyncio.create_task(single_flight.get_many(["a"], ["x"]))
+        other = asyncio.create_task(single_flight.get_many(["a"], ["x"]))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        return await other
+
+    assert asyncio.run(run()) == ["X"]
+    assert fetcher.calls == [["x"]]
@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+from __app__.utils.eviction import EvictionPolicy
+from __app__.utils.vector_store import VectorStore
+
+
+def get_vectors(n: int, dim: int = 8, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, dim))
+
+
+def unit(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_add_many_normalizes_and_returns_rows():
+    store = VectorStore(capacity=2)
+    vectors = get_vectors(5)
+
+    rows = store.add_many(["a", "b", "c", "d", "e"], list("ABCDE"), vectors)
+
+    assert rows == [0, 1, 2, 3, 4]
+    assert len(store) == 5
+    assert store.dim == 8
+    np.testing.assert_allclose(
+        store.get_vectors(["a", "b", "c", "d", "e"]), unit(vectors), rtol=1e-6
+    )
+    assert store.get_text("c") == "C"
+
+
+def test_add_existing_hash_value_replaces_its_row():
+    store = VectorStore()
+    vectors = get_vectors(3)
+    store.add_many(["a", "b"], ["A", "B"], vectors[:2])
+
+    row = store.add("a", "A", vectors[2])
+
+    assert row == 0
+    assert len(store) == 2
+    np.testing.assert_allclose(store.get_vector("a"), unit(vectors[2:])[0], rtol=1e-6)
+
+
+def test_add_vector_of_other_dimension_raises():
+    store = VectorStore()
+    store.add("a", "A", get_vectors(1, dim=8)[0])
+
+    with pytest.raises(ValueError):
+        store.add("b", "B", get_vectors(1, dim=4)[0])
+
+
+def test_evict_moves_last_row_into_evicted_row():
+    store = VectorStore()
+    vectors = get_vectors(4)
+    store.add_many(["a", "b", "c", "d"], list("ABCD"), vectors)
+    nbytes = store.nbytes
+
+    store.evict(["b"])
+
+    assert len(store) == 3
+    assert "b" not in store
+    assert store.get_row("d") == 1
+    assert store.nbytes < nbytes
+    expected = unit(vectors)[[0, 2, 3]]
+    np.testing.assert_allclose(store.get_vectors(["a", "c", "d"]), expected, rtol=1e-6)
+    assert [store.get_text(h) for h in ["a", "c", "d"]] == ["A", "C", "D"]
+
+
+def test_evict_last_row_and_unknown_hash_value():
+    store = VectorStore()
+    store.add_many(["a", "b"], ["A", "B"], get_vectors(2))
+
+    store.evict(["b", "unknown"])
+
+    assert len(store) == 1
+    assert store.get_row("a") == 0
+
+
+def test_rows_are_reused_after_evictions():
+    store = VectorStore(capacity=4)
+    vectors = get_vectors(6)
+    store.add_many(["a", "b", "c", "d"], list("ABCD"), vectors[:4])
+    store.evict(["a", "c"])
+
+    rows = store.add_many(["e", "f"], ["E", "F"], vectors[4:])
+
+    assert rows == [2, 3]
+    assert store._matrix.shape[0] == 4
+    expected = unit(vectors)[[1, 3, 4, 5]]
+    np.testing.assert_allclose(
+        store.get_vectors(["b", "d", "e", "f"]), expected, rtol=1e-6
+    )
+
+
+def test_get_many_and_gather():
+    store = VectorStore()
+    vectors = get_vectors(3)
+    store.add_many(["a", "b", "c"], list("ABC"), vectors)
+
+    rows, missing = store.get_many(["c", "x", "a", "y"])
+
+    assert rows.tolist() == [2, -1, 0, -1]
+    assert missing.tolist() == [1, 3]
+    np.testing.assert_allclose(
+        store.gather(rows[rows >= 0]), unit(vectors)[[2, 0]], rtol=1e-6
+    )
+
+
+def test_trim_evicts_least_recently_used_rows_down_to_the_low_watermark():
+    store = VectorStore(policy=EvictionPolicy(policy="lru", max_entries=3))
+    store.add_many(["a", "b", "c"], list("ABC"), get_vectors(3))
+    store.get_row("a")
+    store.add("d", "D", get_vectors(1, seed=1)[0])
+
+    evicted = store.trim()
+
+    assert evicted == ["b", "c"]
+    assert sorted(h for h, _, _ in store.items()) == ["a", "d"]
+
+
+def test_negations_are_dropped_with_their_row():
+    store = VectorStore()
+    store.add_many(["a", "b"], ["A", "not A"], get_vectors(2))
+    store.set_negation("a", "en", "b")
+
+    assert store.get_negation("a", "en") == "b"
+
+    store.evict(["a"])
+
+    assert store.get_negation("a", "en") is None
+
+
+def test_iter_sorted_resumes_after_a_hash_value():
+    store = VectorStore()
+    store.add_many(["c", "a", "d", "b"], list("CADB"), get_vectors(4))
+
+    assert [h for h, _, _ in store.iter_sorted()] == ["a", "b", "c", "d"]
+    assert [h for h, _, _ in store.iter_sorted(after="b")] == ["c", "d"]
+
+
+def test_peek_text_is_not_an_access():
+    store = VectorStore(policy=EvictionPolicy(policy="lru", max_entries=3))
+    store.add_many(["a", "b", "c"], list("ABC"), get_vectors(3))
+
+    assert store.peek_text("a") == "A"
+    assert store.peek_text("x") is None
+
+    store.add("d", "D", get_vectors(1, seed=1)[0])
+
+    assert store.trim() == ["a", "b"]
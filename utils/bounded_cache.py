@@ -0,0 +1,155 @@
+import bisect
+import itertools
+import json
+from collections.abc import MutableMapping
+from typing import Iterator
+
+from .disk_cache import DiskCache
+from .eviction import EvictionPolicy
+
+
+class BoundedCache(MutableMapping):
+    """
+    A dict of cache entries with a budget of entries and bytes
+
+    The size of an entry is the size of its JSON, which approximates its footprint in memory, or its size if it is JSON
+    bytes already. Reading an entry counts as an access of the entry, iterating over the cache doesn't.
+
+    With a disk tier, entries are written through to the disk, and an entry that isn't in memory is read from the
+    disk and promoted to memory. An entry evicted because the cache is over its budget stays on the disk, only expired
+    entries are deleted from it.
+    """
+
+    def __init__(
+        self,
+        entries: dict | None = None,
+        policy: EvictionPolicy | None = None,
+        disk: DiskCache | None = None,
+    ):
+        self.policy = policy if policy is not None else EvictionPolicy()
+        self.disk = disk
+        self._entries: dict = {}
+        # The keys in memory in ascending order, built on first use and dropped when a key is added or removed
+        self._sorted_keys: list[str] | None = None
+        for key, value in (entries or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key: str):
+        if key not in self._entries:
+            value = None if self.disk is None else self.disk.get(key)
+            if value is None:
+                raise KeyError(key)
+            self._promote(key, value)
+
+        value = self._entries[key]
+        self.policy.touch(key)
+
+        return value
+
+    def __setitem__(self, key: str, value):
+        self._promote(key, value)
+        if self.disk is not None:
+            self.disk.put_many({key: value})
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self._demote(key)
+        if self.disk is not None:
+            self.disk.delete_many([key])
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries or (self.disk is not None and key in self.disk)
+
+    def __iter__(self) -> Iterator[str]:
+        if self.disk is not None:
+            return self.disk.iter_keys()
+
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        if self.disk is not None:
+            return len(self.disk)
+
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        """The approximate number of bytes used by the entries in memory"""
+
+        return self.policy.nbytes
+
+    def _promote(self, key: str, value):
+        """Put an entry in memory"""
+
+        if key not in self._entries:
+            self._sorted_keys = None
+        self._entries[key] = value
+        self.policy.add(
+            key,
+            (
+                len(value)
+                if isinstance(value, bytes)
+                else len(json.dumps(value, default=str))
+            ),
+        )
+
+    def _demote(self, key: str):
+        """Remove an entry from memory"""
+
+        if self._entries.pop(key, None) is not None:
+            self._sorted_keys = None
+        self.policy.remove(key)
+
+    def items(self):
+        if self.disk is not None:
+            return self.disk.iter_sorted()
+
+        return self._entries.items()
+
+    def iter_sorted(self, after: str | None = None) -> Iterator[tuple[str, object]]:
+        """
+        Iterate over (key, value) by ascending key, starting after a key. Only the entries that are iterated over are
+        read, so a page of entries costs the size of the page rather than the size of the cache.
+        """
+
+        if self.disk is not None:
+            yield from self.disk.iter_sorted(after=after)
+            return
+
+        if self._sorted_keys is None:
+            self._sorted_keys = sorted(self._entries)
+        keys = self._sorted_keys
+        start = 0 if after is None else bisect.bisect_right(keys, after)
+        for key in itertools.islice(keys, start, None):
+            if key in self._entries:
+                yield key, self._entries[key]
+
+    def values(self):
+        return (value for _, value in self.items())
+
+    def apply_entries(self, entries: dict):
+        """Apply newer cache entries, e.g. entries pulled from other instances, a tombstone (None) deletes its entry"""
+
+        for key, value in entries.items():
+            if value is None:
+                self.pop(key, None)
+            else:
+                self[key] = value
+
+    def trim(self) -> list[str]:
+        """
+        Evict the entries selected by the eviction policy
+        :return: the keys of the entries that were deleted, not only evicted from memory
+        """
+
+        expired = set(self.policy.select_expired())
+        deleted = []
+        for key in self.policy.select():
+            self._demote(key)
+            if self.disk is None or key in expired:
+                deleted.append(key)
+        if self.disk is not None:
+            self.disk.delete_many(deleted)
+
+        return deleted
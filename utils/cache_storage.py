@@ -0,0 +1,421 @@
+"""
+Sharded, append-only cache persistence in Azure Blob Storage
+
+A cache, e.g. 'cache_vectors.pkl', is stored under the folder 'cache_vectors/':
+
+- 'cache_vectors/shards/<prefix>.pkl' holds the compacted entries of all keys starting with <prefix>
+- 'cache_vectors/log/<prefix>/<segment>.pkl' holds entries appended since the last compaction
+
+A request with cache misses only uploads log segments with its new entries, so the cost of a write doesn't grow
+with the size of the cache. The log segments are periodically merged into the shards by the 'compact' function.
+
+Blobs are never overwritten blindly: a log segment has a unique name and is only created if it doesn't exist, and a
+shard is only replaced if its ETag didn't change since it was read (If-Match), so concurrent writers can't clobber
+each other's entries.
+
+A shard records in its metadata the ETag of the shard it was compacted from and a digest of the names of the log
+segments merged into it, so a disk tier that applied them already doesn't download the shard again, see
+utils.disk_cache.
+
+An evicted entry is appended as a tombstone, an entry whose value is None, which deletes the entry when it is
+merged.
+
+Shards and log segments are pickles, except for the caches in json_caches, whose values are stored as JSON bytes in
+segment files, see utils.json_segments. Blobs written before are still read.
+"""
+
+import asyncio
+import hashlib
+import logging
+import pickle
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError
+from azure.core.exceptions import ResourceModifiedError
+from azure.storage.blob import ContainerClient
+from azure.storage.blob.aio import ContainerClient as AsyncContainerClient
+
+from .. import constants
+from . import hashing
+from . import json_segments
+
+# The caches whose values are JSON
+json_caches = [constants.cache_instruments_pkl]
+
+
+def get_cache_folder(cache_file_name: str) -> str:
+    """Get the blob folder of a cache, e.g. 'cache_vectors.pkl' -> 'cache_vectors'"""
+
+    return cache_file_name.rsplit(".", 1)[0]
+
+
+def get_namespace_cache_file_name(cache_file_name: str, namespace: str) -> str:
+    """Get the file name of the cache of a namespace, e.g. 'cache_vectors.pkl', 'v2' -> 'cache_vectors@v2.pkl'"""
+
+    if not namespace:
+        return cache_file_name
+
+    folder, extension = cache_file_name.rsplit(".", 1)
+
+    return f"{folder}@{namespace}.{extension}"
+
+
+def get_vectors_cache_file_name(
+    namespace: str = constants.VECTORS_CACHE_NAMESPACE,
+) -> str:
+    """Get the file name of the vectors cache of a namespace, the vectors of each namespace are a separate cache"""
+
+    return get_namespace_cache_file_name(constants.cache_vectors_pkl, namespace)
+
+
+# The vectors caches of the current and the previous namespace
+vectors_caches = list(
+    dict.fromkeys(
+        get_vectors_cache_file_name(namespace)
+        for namespace in [
+            constants.VECTORS_CACHE_NAMESPACE,
+            constants.VECTORS_CACHE_PREVIOUS_NAMESPACE,
+        ]
+        if namespace is not None
+    )
+)
+
+
+def get_shard_prefix(key: str) -> str:
+    """Get the shard prefix of a cache key, the prefix of its digest for a versioned key"""
+
+    return hashing.get_digest(key)[: constants.CACHE_SHARD_PREFIX_LENGTH]
+
+
+def get_shard_blob_name(cache_file_name: str, prefix: str) -> str:
+    """Get the blob name of a shard"""
+
+    return f"{get_cache_folder(cache_file_name)}/shards/{prefix}.pkl"
+
+
+def get_log_folder(cache_file_name: str, prefix: str = "") -> str:
+    """Get the blob folder of the log segments (of a prefix)"""
+
+    folder = f"{get_cache_folder(cache_file_name)}/log/"
+    if prefix:
+        folder += f"{prefix}/"
+
+    return folder
+
+
+def group_by_shard_prefix(entries: dict) -> dict[str, dict]:
+    """Group cache entries by shard prefix"""
+
+    groups: dict[str, dict] = {}
+    for key, value in entries.items():
+        groups.setdefault(get_shard_prefix(key), {})[key] = value
+
+    return groups
+
+
+def update_entries(entries: dict, new_entries: dict):
+    """
+    Update cache entries with newer entries. A newer vector entry may only hold 'negations', which are added to the
+    negations of the entry. Tombstones replace entries, so they can still delete entries merged after them.
+    """
+
+    for key, value in new_entries.items():
+        old_value = entries.get(key)
+        if (
+            isinstance(old_value, dict)
+            and isinstance(value, dict)
+            and "negations" in value
+        ):
+            value = {
+                **old_value,
+                **value,
+                "negations": {**old_value.get("negations", {}), **value["negations"]},
+            }
+        entries[key] = value
+
+
+def remove_tombstones(entries: dict) -> dict:
+    """Remove the tombstones of deleted entries"""
+
+    return {key: value for key, value in entries.items() if value is not None}
+
+
+def get_tombstones(keys: list[str]) -> dict:
+    """Get the tombstones of deleted entries"""
+
+    return {key: None for key in keys}
+
+
+def has_legacy_cache(container: ContainerClient, cache_file_name: str) -> bool:
+    """Check if a cache is (also) stored as a single pickle, which is how caches were stored before sharding"""
+
+    return container.get_blob_client(blob=cache_file_name).exists()
+
+
+def dumps_entries(cache_file_name: str, entries: dict) -> bytes:
+    """Serialize the entries of a shard or log segment, as a segment file of JSON bytes for a JSON cache"""
+
+    if cache_file_name in json_caches:
+        return json_segments.write_segment(entries)
+
+    return pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def loads_entries(data: bytes) -> dict:
+    """Deserialize the entries of a blob, a segment file or a pickle"""
+
+    if json_segments.is_segment(data):
+        return json_segments.SegmentReader(data).to_dict()
+
+    return pickle.loads(data)
+
+
+def download_entries(container: ContainerClient, blob_name: str) -> dict:
+    """Download and deserialize the entries of a blob"""
+
+    return loads_entries(container.download_blob(blob=blob_name).readall())
+
+
+def download_entries_and_etag(
+    container: ContainerClient, blob_name: str
+) -> tuple[dict, str]:
+    """Download and deserialize the entries of a blob, with the ETag of the version that was downloaded"""
+
+    downloader = container.download_blob(blob=blob_name)
+
+    return loads_entries(downloader.readall()), downloader.properties.etag
+
+
+def upload_blob_if_unchanged(
+    container: ContainerClient,
+    blob_name: str,
+    data,
+    etag: str | None,
+    metadata: dict[str, str] | None = None,
+):
+    """
+    Upload a blob only if it didn't change since it was read, or only if it doesn't exist if it wasn't read (etag None)
+    :raises ResourceModifiedError: if the blob changed since it was read
+    :raises ResourceExistsError: if the blob was created since it was found missing
+    """
+
+    if etag is None:
+        container.upload_blob(
+            name=blob_name, data=data, overwrite=False, metadata=metadata
+        )
+    else:
+        container.upload_blob(
+            name=blob_name,
+            data=data,
+            overwrite=True,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified,
+            metadata=metadata,
+        )
+
+
+def get_segments_digest(segment_names: Iterable[str]) -> str:
+    """Get a digest of the names of log segments, regardless of their order"""
+
+    return hashlib.sha256("\n".join(sorted(segment_names)).encode()).hexdigest()
+
+
+def get_shard_metadata(shard_etag: str | None, segment_names: list[str]) -> dict:
+    """Get the metadata of a shard compacted from a shard (None if there was none) and log segments"""
+
+    return {
+        "base_etag": (shard_etag or "").strip('"'),
+        "merged_segments": get_segments_digest(segment_names),
+    }
+
+
+def download_many_entries(
+    container: ContainerClient, blob_names: Iterable[str]
+) -> list[dict]:
+    """Download the entries of many blobs concurrently, in the order of the blob names"""
+
+    with ThreadPoolExecutor(
+        max_workers=constants.CACHE_DOWNLOAD_CONCURRENCY
+    ) as executor:
+        return list(
+            executor.map(lambda name: download_entries(container, name), blob_names)
+        )
+
+
+def get_segments(cache_file_name: str, entries: dict) -> list[tuple[str, bytes]]:
+    """Get the log segments of new cache entries, one segment per shard prefix touched, as (blob name, data)"""
+
+    segment_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+
+    return [
+        (
+            f"{get_log_folder(cache_file_name, prefix)}{segment_id}.pkl",
+            dumps_entries(cache_file_name, shard_entries),
+        )
+        for prefix, shard_entries in group_by_shard_prefix(entries).items()
+    ]
+
+
+def append_entries(
+    container: ContainerClient, cache_file_name: str, entries: dict
+) -> list[str]:
+    """
+    Append new cache entries as log segments, one segment per shard prefix touched
+    :return: the names of the uploaded segments
+    """
+
+    segment_names = []
+    for segment_name, data in get_segments(cache_file_name, entries):
+        container.upload_blob(name=segment_name, data=data, overwrite=False)
+        segment_names.append(segment_name)
+
+    return segment_names
+
+
+async def append_entries_async(
+    container: AsyncContainerClient, cache_file_name: str, entries: dict
+) -> list[str]:
+    """
+    Append new cache entries as log segments with an async container client, the segments are uploaded concurrently
+    :return: the names of the uploaded segments
+    """
+
+    segments = get_segments(cache_file_name, entries)
+    await asyncio.gather(
+        *(
+            container.upload_blob(name=segment_name, data=data, overwrite=False)
+            for segment_name, data in segments
+        )
+    )
+
+    return [segment_name for segment_name, _ in segments]
+
+
+def load_entries(
+    container: ContainerClient, cache_file_name: str, keep_tombstones: bool = False
+) -> dict:
+    """
+    Load all entries of a cache: the legacy single pickle (if any), then the shards, then the log segments in the
+    order they were written
+    :param keep_tombstones: keep the tombstones of deleted entries, instead of leaving the entries out
+    """
+
+    entries = {}
+
+    # Caches written before sharding was introduced are a single pickle
+    if has_legacy_cache(container, cache_file_name):
+        legacy = download_entries(container, cache_file_name)
+        entries.update(legacy if isinstance(legacy, dict) else legacy.to_dict())
+
+    shard_names = [
+        blob.name
+        for blob in container.list_blobs(
+            name_starts_with=f"{get_cache_folder(cache_file_name)}/shards/"
+        )
+    ]
+    segment_names = [
+        blob.name
+        for blob in container.list_blobs(
+            name_starts_with=get_log_folder(cache_file_name)
+        )
+    ]
+
+    # Segment names start with the time they were written
+    segment_names.sort(key=lambda name: name.rsplit("/", 1)[-1])
+
+    for shard_entries in download_many_entries(container, shard_names + segment_names):
+        update_entries(entries, shard_entries)
+
+    if not keep_tombstones:
+        entries = remove_tombstones(entries)
+
+    return entries
+
+
+def compact(container: ContainerClient, cache_file_name: str) -> int:
+    """
+    Merge the log segments of a cache into its shards, and migrate the legacy single pickle (if any) into shards
+    :return: the number of log segments merged
+    """
+
+    segment_names_by_prefix: dict[str, list[str]] = {}
+    for blob in container.list_blobs(name_starts_with=get_log_folder(cache_file_name)):
+        prefix = blob.name[len(get_log_folder(cache_file_name)) :].split("/", 1)[0]
+        segment_names_by_prefix.setdefault(prefix, []).append(blob.name)
+
+    legacy_entries_by_prefix = {}
+    has_legacy = has_legacy_cache(container, cache_file_name)
+    if has_legacy:
+        legacy = download_entries(container, cache_file_name)
+        legacy_entries_by_prefix = group_by_shard_prefix(
+            legacy if isinstance(legacy, dict) else legacy.to_dict()
+        )
+
+    n_merged = 0
+    n_conflicts = 0
+    for prefix in set(segment_names_by_prefix) | set(legacy_entries_by_prefix):
+        segment_names = sorted(segment_names_by_prefix.get(prefix, []))
+        if len(segment_names) < constants.CACHE_COMPACTION_MIN_SEGMENTS and (
+            prefix not in legacy_entries_by_prefix
+        ):
+            continue
+
+        shard_name = get_shard_blob_name(cache_file_name, prefix)
+        shard_entries = legacy_entries_by_prefix.get(prefix, {})
+        shard_etag = None
+        try:
+            entries, shard_etag = download_entries_and_etag(container, shard_name)
+            update_entries(shard_entries, entries)
+        except (Exception,):
+            pass
+        for segment_entries in download_many_entries(container, segment_names):
+            update_entries(shard_entries, segment_entries)
+
+        try:
+            upload_blob_if_unchanged(
+                container=container,
+                blob_name=shard_name,
+                data=dumps_entries(cache_file_name, remove_tombstones(shard_entries)),
+                etag=shard_etag,
+                metadata=get_shard_metadata(shard_etag, segment_names),
+            )
+        except (ResourceExistsError, ResourceModifiedError):
+            # Another compaction replaced the shard, its segments are merged by the next compaction
+            logging.warning(f"Shard {shard_name} changed while it was compacted")
+            n_conflicts += 1
+            continue
+
+        # Only delete the segments that were merged, new ones may have been appended in the meantime
+        for segment_name in segment_names:
+            container.delete_blob(blob=segment_name)
+        n_merged += len(segment_names)
+
+    # The legacy pickle is only deleted once all of its entries are in the shards
+    if has_legacy and n_conflicts == 0:
+        container.delete_blob(blob=cache_file_name)
+
+    logging.info(f"Merged {n_merged} log segments of {cache_file_name}")
+
+    return n_merged
+
+
+def delete_all(container: ContainerClient, cache_file_name: str):
+    """Delete all blobs of a cache"""
+
+    blob_names = [
+        blob.name
+        for blob in container.list_blobs(
+            name_starts_with=f"{get_cache_folder(cache_file_name)}/"
+        )
+    ]
+    for blob_name in blob_names + [cache_file_name]:
+        try:
+            container.delete_blob(blob=blob_name)
+        except (Exception,):
+            logging.error(f"Could not delete blob {blob_name}")
+            logging.error(traceback.format_exc())
@@ -0,0 +1,64 @@
+"""
+Incremental sync of the caches between instances
+
+Each instance appends the entries it adds to the log of a cache, see utils.cache_storage, and pulls the log segments
+appended by other instances every CACHE_SYNC_INTERVAL_SECONDS:
+
+- with a disk tier, the disk is synced with blob storage by ETag, see utils.disk_cache, and the new entries are read
+  from the disk on first use
+- without a disk tier, a LogReader downloads the log segments it hasn't seen before, and their entries are applied to
+  the cache in memory
+
+A pull only lists the log and downloads the new segments, so its cost doesn't grow with the size of the cache.
+"""
+
+from azure.storage.blob import ContainerClient
+
+from . import cache_storage
+
+
+class LogReader:
+    """
+    Reads the log segments of a cache that weren't read before
+
+    The reader starts at the segments that exist when it is created, so it should be created before the cache is
+    loaded: a segment appended in between is loaded and read again, which is harmless, but never missed.
+    """
+
+    def __init__(self, container: ContainerClient, cache_file_name: str):
+        self.cache_file_name = cache_file_name
+        self._seen = set(self.list_segment_names(container))
+
+    def list_segment_names(self, container: ContainerClient) -> list[str]:
+        """List the log segments of the cache in the order they were written"""
+
+        # Segment names start with the time they were written
+        return sorted(
+            (
+                blob.name
+                for blob in container.list_blobs(
+                    name_starts_with=cache_storage.get_log_folder(self.cache_file_name)
+                )
+            ),
+            key=lambda name: name.rsplit("/", 1)[-1],
+        )
+
+    def pull(self, container: ContainerClient) -> dict:
+        """
+        Read the log segments that were appended since the last pull
+        :return: the entries of the new segments, with tombstones
+        """
+
+        segment_names = self.list_segment_names(container)
+        new_segment_names = [name for name in segment_names if name not in self._seen]
+
+        entries = {}
+        for segment_entries in cache_storage.download_many_entries(
+            container, new_segment_names
+        ):
+            cache_storage.update_entries(entries, segment_entries)
+
+        # Segments that were compacted are forgotten, so the set doesn't grow forever
+        self._seen = set(segment_names)
+
+        return entries
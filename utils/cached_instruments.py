@@ -0,0 +1,43 @@
+"""
+Values of the instruments cache
+
+The value of a content key is the JSON bytes of the list of instruments parsed from the file, e.g. one instrument per
+sheet of a spreadsheet. Values cached before files had several instruments are a single instrument, as JSON bytes or
+as the object itself, and are read as a list of that instrument.
+
+The JSON bytes of the instruments of each file are spliced into the /api/parse and /api/parse/lookup responses as
+they are, so cached instruments are not decoded to build the responses.
+"""
+
+import json
+
+from . import json_segments
+
+
+def to_json(instruments: list) -> bytes:
+    """Get the cache value of the instruments of a file"""
+
+    return json.dumps(instruments).encode()
+
+
+def get_instruments_json(value) -> bytes:
+    """
+    Get the instruments of a cache value as JSON bytes to splice into a JSON list, the JSON of each instrument
+    separated by commas, without the brackets of the list
+    """
+
+    value_json = json_segments.to_json_bytes(value).strip()
+    if value_json.startswith(b"["):
+        return value_json[1:-1].strip()
+
+    return value_json
+
+
+def get_instruments(value) -> list:
+    """Get the instruments of a cache value"""
+
+    instruments = json.loads(value) if isinstance(value, bytes) else value
+    if isinstance(instruments, list):
+        return instruments
+
+    return [instruments]
@@ -0,0 +1,208 @@
+"""
+Caches shared by all functions of a worker
+
+The caches are loaded on first use instead of at import time, so a cold start doesn't block on downloading them.
+warm_up() starts loading them in the background.
+
+Each cache has a budget in memory, see utils.eviction. A cache is trimmed to its budget once it is loaded, the
+functions that add entries trim it after adding them.
+
+With CACHE_DISK_TIER, each cache has a local disk tier below memory, see utils.disk_cache. The disk is synced with
+blob storage when the cache is loaded, and the entries are read from the disk into memory on first use.
+
+The vectors of each namespace are a separate cache, with its own snapshot, so a namespace can have vectors of a
+different dimension, e.g. those of a new embedding model.
+
+Every CACHE_SYNC_INTERVAL_SECONDS, the entries added by other instances are pulled in the background, see
+utils.cache_sync. Without a disk tier, the pulled entries are only applied to a cache by apply_synced_entries(), which
+the functions that change the cache call on the event loop, so a cache doesn't change under a request reading it.
+"""
+
+import logging
+import threading
+import time
+import traceback
+
+from .. import constants
+from . import cache_storage
+from . import disk_cache
+from . import helpers
+from .bounded_cache import BoundedCache
+from .cache_sync import LogReader
+from .disk_cache import DiskCache
+from .eviction import EvictionPolicy
+from .vector_store import VectorStore
+
+cache_file_names = [constants.cache_instruments_pkl, *cache_storage.vectors_caches]
+
+_caches: dict = {}
+_locks = {cache_file_name: threading.Lock() for cache_file_name in cache_file_names}
+
+# The state of the sync of each cache with the other instances
+_log_readers: dict[str, LogReader] = {}
+_synced_at: dict[str, float] = {}
+_synced_entries: dict[str, dict] = {}
+_sync_locks = {
+    cache_file_name: threading.Lock() for cache_file_name in cache_file_names
+}
+_synced_entries_lock = threading.Lock()
+
+
+def _get_cache(cache_file_name: str, load):
+    """Get a cache, load it if it wasn't loaded yet, and start a sync if it is due"""
+
+    cache = _caches.get(cache_file_name)
+    if cache is None:
+        with _locks[cache_file_name]:
+            cache = _caches.get(cache_file_name)
+            if cache is None:
+                # Without a disk tier, the log is read from the segments that exist before the cache is loaded
+                if (
+                    constants.CACHE_SYNC_INTERVAL_SECONDS > 0
+                    and not constants.CACHE_DISK_TIER
+                ):
+                    _log_readers[cache_file_name] = LogReader(
+                        container=helpers.get_container_harmonycache(),
+                        cache_file_name=cache_file_name,
+                    )
+                cache = load(cache_file_name=cache_file_name)
+                _synced_at[cache_file_name] = time.monotonic()
+                _caches[cache_file_name] = cache
+
+    if (
+        constants.CACHE_SYNC_INTERVAL_SECONDS > 0
+        and time.monotonic() - _synced_at[cache_file_name]
+        >= constants.CACHE_SYNC_INTERVAL_SECONDS
+        and _sync_locks[cache_file_name].acquire(blocking=False)
+    ):
+        _synced_at[cache_file_name] = time.monotonic()
+        threading.Thread(target=sync, args=(cache_file_name,), daemon=True).start()
+
+    return cache
+
+
+def sync(cache_file_name: str):
+    """Pull the entries that other instances added to a cache since the last sync, the sync lock must be held"""
+
+    try:
+        container = helpers.get_container_harmonycache()
+        cache = _caches[cache_file_name]
+        if cache.disk is not None:
+            disk_cache.sync_from_blob_storage(
+                container=container, cache_file_name=cache_file_name, disk=cache.disk
+            )
+        else:
+            entries = _log_readers[cache_file_name].pull(container)
+            with _synced_entries_lock:
+                cache_storage.update_entries(
+                    _synced_entries.setdefault(cache_file_name, {}), entries
+                )
+    except (Exception,):
+        logging.error(f"Could not sync {cache_file_name}")
+        logging.error(traceback.format_exc())
+    finally:
+        _sync_locks[cache_file_name].release()
+
+
+def apply_synced_entries(cache_file_name: str):
+    """Apply the entries pulled by the last syncs to a cache in memory"""
+
+    with _synced_entries_lock:
+        entries = _synced_entries.pop(cache_file_name, None)
+    if entries:
+        _caches[cache_file_name].apply_entries(entries)
+
+
+def get_disk_cache(cache_file_name: str) -> DiskCache | None:
+    """Get the disk tier of a cache, None if there is no disk tier"""
+
+    if not constants.CACHE_DISK_TIER:
+        return None
+
+    return DiskCache(disk_cache.get_local_disk_cache_path(cache_file_name))
+
+
+def load_instruments_cache(cache_file_name: str) -> BoundedCache:
+    """Load the instruments cache, trimmed to its budget"""
+
+    policy = EvictionPolicy(
+        max_entries=constants.INSTRUMENTS_CACHE_MAX_ENTRIES,
+        max_bytes=constants.INSTRUMENTS_CACHE_MAX_BYTES,
+    )
+    disk = get_disk_cache(cache_file_name)
+    if disk is not None:
+        disk_cache.sync_from_blob_storage(
+            container=helpers.get_container_harmonycache(),
+            cache_file_name=cache_file_name,
+            disk=disk,
+        )
+        cache = BoundedCache(policy=policy, disk=disk)
+    else:
+        cache = BoundedCache(
+            helpers.get_cache_from_azure(cache_file_name=cache_file_name),
+            policy=policy,
+        )
+    cache.trim()
+
+    return cache
+
+
+def load_vectors_cache(cache_file_name: str) -> VectorStore:
+    """Load the vectors cache, trimmed to its budget"""
+
+    cache = helpers.get_vector_store_from_azure(
+        cache_file_name=cache_file_name,
+        policy=EvictionPolicy(
+            max_entries=constants.VECTORS_CACHE_MAX_ENTRIES,
+            max_bytes=constants.VECTORS_CACHE_MAX_BYTES,
+        ),
+        disk=get_disk_cache(cache_file_name),
+    )
+    cache.trim()
+
+    return cache
+
+
+def get_instruments_cache() -> BoundedCache:
+    """Get the instruments cache"""
+
+    return _get_cache(
+        cache_file_name=constants.cache_instruments_pkl,
+        load=load_instruments_cache,
+    )
+
+
+def get_vectors_cache(
+    namespace: str = constants.VECTORS_CACHE_NAMESPACE,
+) -> VectorStore:
+    """Get the vectors cache of a namespace"""
+
+    return _get_cache(
+        cache_file_name=cache_storage.get_vectors_cache_file_name(namespace),
+        load=load_vectors_cache,
+    )
+
+
+def get_previous_vectors_cache() -> VectorStore | None:
+    """Get the vectors cache of the previous namespace, None if there is no previous namespace"""
+
+    if constants.VECTORS_CACHE_PREVIOUS_NAMESPACE is None:
+        return None
+
+    return get_vectors_cache(constants.VECTORS_CACHE_PREVIOUS_NAMESPACE)
+
+
+def collect_metrics():
+    """Get the entries and the bytes in memory of each loaded cache, the gauges of utils.metrics"""
+
+    for cache_file_name, cache in list(_caches.items()):
+        labels = {"cache": cache_storage.get_cache_folder(cache_file_name)}
+        yield "harmonycache_cache_entries", labels, len(cache)
+        yield "harmonycache_cache_bytes", labels, cache.nbytes
+
+
+def warm_up(*getters):
+    """Start loading caches in the background"""
+
+    for getter in getters:
+        threading.Thread(target=getter, daemon=True).start()
@@ -0,0 +1,370 @@
+"""
+Local disk tier of a cache
+
+The entries of a cache, e.g. 'cache_vectors.pkl', are kept in a sqlite database
+'<temp dir>/harmonycache/cache_vectors.sqlite', which survives across invocations and is shared by the workers of a
+host. The values are pickled like the values of the blob log segments.
+
+The database also holds the ETags of the blobs it was synced from, so a sync only downloads the blobs that changed
+since. A new log segment is applied on top of the entries. A changed shard is downloaded with the log segments of its
+prefix, and they replace all entries of the prefix in one transaction, so the entries are never missing in between.
+A shard that was compacted from the shard and the log segments that were synced already holds no new entries, so it
+isn't downloaded.
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Iterable
+from typing import Iterator
+
+from azure.storage.blob import BlobProperties
+from azure.storage.blob import ContainerClient
+
+from .. import constants
+from . import cache_storage
+
+
+class DiskCache:
+    """A sqlite database of cache entries"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (name TEXT PRIMARY KEY, etag TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self._connection.create_function(
+                "shard_prefix", 1, cache_storage.get_shard_prefix, deterministic=True
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries").fetchone()[
+                0
+            ]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return (
+                self._connection.execute(
+                    "SELECT 1 FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                is not None
+            )
+
+    @contextmanager
+    def _transaction(self):
+        """Run statements in one write transaction"""
+
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def get(self, key: str, default=None):
+        """Get the value of a key"""
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+
+        return default if row is None else pickle.loads(row[0])
+
+    def get_many(self, keys: list[str], chunk_size: int = 500) -> dict:
+        """Get the values of the keys that are stored"""
+
+        entries = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start : start + chunk_size]
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            entries.update((key, pickle.loads(value)) for key, value in rows)
+
+        return entries
+
+    def put_many(self, entries: dict):
+        """Store entries, a tombstone (None) deletes its entry"""
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "DELETE FROM entries WHERE key = ?",
+                [(key,) for key, value in entries.items() if value is None],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)",
+                [
+                    (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+                    for key, value in entries.items()
+                    if value is not None
+                ],
+            )
+
+    def delete_many(self, keys: Iterable[str]):
+        """Delete entries"""
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "DELETE FROM entries WHERE key = ?", [(key,) for key in keys]
+            )
+
+    def replace_shards(self, entries_by_prefix: dict[str, dict]):
+        """Replace all entries of shards with new entries, by shard prefix, in one transaction"""
+
+        prefixes = list(entries_by_prefix)
+        if not prefixes:
+            return
+
+        with self._transaction() as connection:
+            connection.execute(
+                f"DELETE FROM entries WHERE shard_prefix(key) IN ({','.join('?' * len(prefixes))})",
+                prefixes,
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)",
+                [
+                    (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+                    for entries in entries_by_prefix.values()
+                    for key, value in entries.items()
+                    if value is not None
+                ],
+            )
+
+    def iter_sorted(
+        self, after: str | None = None, chunk_size: int = 1000
+    ) -> Iterator[tuple[str, object]]:
+        """Iterate over (key, value) by ascending key, starting after a key, a chunk of entries at a time"""
+
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key, value FROM entries WHERE key > ? ORDER BY key LIMIT ?",
+                    (after or "", chunk_size),
+                ).fetchall()
+            for key, value in rows:
+                yield key, pickle.loads(value)
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+    def iter_keys(self, chunk_size: int = 10000) -> Iterator[str]:
+        """Iterate over the keys by ascending key"""
+
+        after = ""
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key FROM entries WHERE key > ? ORDER BY key LIMIT ?",
+                    (after, chunk_size),
+                ).fetchall()
+            for (key,) in rows:
+                yield key
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][0]
+
+    def get_blob_etags(self) -> dict[str, str]:
+        """Get the ETags of the blobs the entries were synced from"""
+
+        with self._lock:
+            return dict(self._connection.execute("SELECT name, etag FROM blobs"))
+
+    def set_blob_etags(self, etags: dict[str, str], deleted: Iterable[str] = ()):
+        """Record the ETags of synced blobs, and forget blobs that were deleted"""
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO blobs (name, etag) VALUES (?, ?)", etags.items()
+            )
+            connection.executemany(
+                "DELETE FROM blobs WHERE name = ?", [(name,) for name in deleted]
+            )
+
+
+def get_local_disk_cache_path(cache_file_name: str) -> str:
+    """Get the path of the disk tier of a cache in the temp dir"""
+
+    return os.path.join(
+        tempfile.gettempdir(),
+        "harmonycache",
+        f"{cache_storage.get_cache_folder(cache_file_name)}.sqlite",
+    )
+
+
+def apply_entries(disk: DiskCache, new_entries: dict):
+    """Apply newer entries to a disk tier, with the semantics of cache_storage.update_entries"""
+
+    entries = disk.get_many(
+        [
+            key
+            for key, value in new_entries.items()
+            if isinstance(value, dict) and "negations" in value
+        ]
+    )
+    cache_storage.update_entries(entries, new_entries)
+    disk.put_many(entries)
+
+
+def is_compacted_from_synced(
+    shard: BlobProperties, synced_etags: dict[str, str], synced_segment_names: list[str]
+) -> bool:
+    """
+    Check if a shard was compacted from the version of the shard that was synced and from log segments that were all
+    synced, see cache_storage.get_shard_metadata
+    :param synced_segment_names: the log segments of the prefix of the shard that were synced and don't exist anymore
+    """
+
+    metadata = shard.metadata or {}
+    expected_metadata = cache_storage.get_shard_metadata(
+        synced_etags.get(shard.name), synced_segment_names
+    )
+
+    return all(metadata.get(key) == value for key, value in expected_metadata.items())
+
+
+def sync_from_blob_storage(
+    container: ContainerClient, cache_file_name: str, disk: DiskCache
+) -> int:
+    """
+    Sync a disk tier with the blobs of a cache (legacy single pickle, shards, log segments), only downloading the blobs
+    that changed since the last sync
+    :return: the number of blobs downloaded
+    """
+
+    shards_folder = f"{cache_storage.get_cache_folder(cache_file_name)}/shards/"
+    log_folder = cache_storage.get_log_folder(cache_file_name)
+    blobs = {
+        blob.name: blob
+        for prefix in [shards_folder, log_folder]
+        for blob in container.list_blobs(name_starts_with=prefix, include=["metadata"])
+    }
+    etags = {name: blob.etag for name, blob in blobs.items()}
+    if cache_storage.has_legacy_cache(container, cache_file_name):
+        etags[cache_file_name] = (
+            container.get_blob_client(blob=cache_file_name).get_blob_properties().etag
+        )
+    synced_etags = disk.get_blob_etags()
+
+    shard_names = sorted(name for name in etags if name.startswith(shards_folder))
+    # Segment names start with the time they were written
+    segment_names = sorted(
+        (name for name in etags if name.startswith(log_folder)),
+        key=lambda name: name.rsplit("/", 1)[-1],
+    )
+
+    def get_prefix(name: str) -> str:
+        if name.startswith(shards_folder):
+            return name[len(shards_folder) :].rsplit(".", 1)[0]
+        return name[len(log_folder) :].split("/", 1)[0]
+
+    legacy_changed = (
+        cache_file_name in etags
+        and synced_etags.get(cache_file_name) != etags[cache_file_name]
+    )
+
+    # The segments that were synced and were compacted since, by prefix
+    compacted_segment_names: dict[str, list[str]] = {}
+    for name in synced_etags:
+        if name.startswith(log_folder) and name not in etags:
+            compacted_segment_names.setdefault(get_prefix(name), []).append(name)
+
+    changed_shard_names = []
+    compacted_shard_names = []
+    for name in shard_names:
+        if not legacy_changed and synced_etags.get(name) == etags[name]:
+            continue
+        if not legacy_changed and is_compacted_from_synced(
+            blobs[name], synced_etags, compacted_segment_names.get(get_prefix(name), [])
+        ):
+            compacted_shard_names.append(name)
+        else:
+            changed_shard_names.append(name)
+
+    # With a changed legacy pickle, all entries are replaced
+    legacy_entries_by_prefix = {}
+    if legacy_changed:
+        legacy = cache_storage.download_entries(container, cache_file_name)
+        legacy_entries_by_prefix = cache_storage.group_by_shard_prefix(
+            legacy if isinstance(legacy, dict) else legacy.to_dict()
+        )
+        changed_prefixes = {get_prefix(name) for name in shard_names + segment_names}
+        changed_prefixes |= set(legacy_entries_by_prefix)
+    else:
+        changed_prefixes = {get_prefix(name) for name in changed_shard_names}
+
+    # The entries of each changed prefix are downloaded before they replace the entries of the prefix, a chunk of
+    # prefixes at a time, so the cache is never held in memory as a whole
+    blob_names_by_prefix: dict[str, list[str]] = {
+        prefix: [] for prefix in sorted(changed_prefixes)
+    }
+    for name in shard_names + segment_names:
+        if get_prefix(name) in blob_names_by_prefix:
+            blob_names_by_prefix[get_prefix(name)].append(name)
+    prefixes = list(blob_names_by_prefix)
+    for start in range(0, len(prefixes), constants.CACHE_DOWNLOAD_CONCURRENCY):
+        chunk = prefixes[start : start + constants.CACHE_DOWNLOAD_CONCURRENCY]
+        chunk_blob_names = [
+            name for prefix in chunk for name in blob_names_by_prefix[prefix]
+        ]
+        entries_by_prefix = {
+            prefix: dict(legacy_entries_by_prefix.get(prefix, {})) for prefix in chunk
+        }
+        for blob_name, entries in zip(
+            chunk_blob_names,
+            cache_storage.download_many_entries(container, chunk_blob_names),
+        ):
+            cache_storage.update_entries(
+                entries_by_prefix[get_prefix(blob_name)], entries
+            )
+        disk.replace_shards(entries_by_prefix)
+
+    # The new segments of the other prefixes are applied on top of their entries
+    new_segment_names = [
+        name
+        for name in segment_names
+        if name not in synced_etags and get_prefix(name) not in changed_prefixes
+    ]
+    chunk_size = constants.CACHE_DOWNLOAD_CONCURRENCY * 4
+    for start in range(0, len(new_segment_names), chunk_size):
+        chunk = new_segment_names[start : start + chunk_size]
+        for entries in cache_storage.download_many_entries(container, chunk):
+            apply_entries(disk, entries)
+
+    blob_names = (
+        ([cache_file_name] if legacy_changed else [])
+        + [name for prefix in prefixes for name in blob_names_by_prefix[prefix]]
+        + new_segment_names
+    )
+    disk.set_blob_etags(
+        etags={name: etags[name] for name in blob_names + compacted_shard_names},
+        deleted=[name for name in synced_etags if name not in etags],
+    )
+
+    n_downloaded = len(blob_names)
+    logging.info(
+        f"Synced the disk tier of {cache_file_name}: downloaded {n_downloaded} of {len(etags)} blobs"
+    )
+
+    return n_downloaded
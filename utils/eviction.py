@@ -0,0 +1,134 @@
+"""
+Cache eviction
+
+An EvictionPolicy tracks the size, the creation time, the last access and the number of accesses of the entries of a
+cache, and selects the entries to evict when the cache is over its budget:
+
+- 'lru' evicts the least recently used entries
+- 'lfu' evicts the least frequently used entries, the least recently used first if they were used as often
+- 'ttl' evicts the oldest entries
+
+With a TTL, entries older than the TTL are evicted whatever the policy, and they are deleted from the lower tiers of
+a cache too. Once a cache is over its budget, entries are evicted until it is at the low watermark of its budget, so a
+full cache doesn't evict on every insert.
+"""
+
+import time
+from collections import Counter
+from collections import OrderedDict
+
+from .. import constants
+
+eviction_policies = ["lru", "lfu", "ttl"]
+
+# The fraction of the budget a cache is trimmed to
+low_watermark = 0.9
+
+
+class EvictionPolicy:
+    """
+    Tracks the entries of a cache and selects the entries to evict
+
+    A budget of 0 entries or 0 bytes is no budget.
+    """
+
+    def __init__(
+        self,
+        policy: str = constants.CACHE_EVICTION_POLICY,
+        max_entries: int = 0,
+        max_bytes: int = 0,
+        ttl_seconds: float = constants.CACHE_TTL_SECONDS,
+    ):
+        if policy not in eviction_policies:
+            raise ValueError(
+                f"Eviction policy must be one of {', '.join(eviction_policies)}"
+            )
+
+        self.policy = policy
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.nbytes = 0
+        self._sizes: dict[str, int] = {}
+        self._created_at: OrderedDict[str, float] = OrderedDict()
+        self._accessed: OrderedDict[str, None] = OrderedDict()
+        self._hits: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._sizes
+
+    def add(self, key: str, nbytes: int):
+        """Track a new or replaced entry"""
+
+        self.nbytes += nbytes - self._sizes.get(key, 0)
+        self._sizes[key] = nbytes
+        self._created_at[key] = time.time()
+        self._created_at.move_to_end(key)
+        self.touch(key)
+
+    def touch(self, key: str):
+        """Track an access of an entry"""
+
+        if key in self._sizes:
+            self._accessed[key] = None
+            self._accessed.move_to_end(key)
+            self._hits[key] += 1
+
+    def remove(self, key: str):
+        """Stop tracking an entry"""
+
+        self.nbytes -= self._sizes.pop(key, 0)
+        self._created_at.pop(key, None)
+        self._accessed.pop(key, None)
+        self._hits.pop(key, None)
+
+    def is_over_budget(self, n_entries: int, nbytes: int, fraction: float = 1) -> bool:
+        """Check if a number of entries and bytes is over (a fraction of) the budget"""
+
+        return (self.max_entries > 0 and n_entries > self.max_entries * fraction) or (
+            self.max_bytes > 0 and nbytes > self.max_bytes * fraction
+        )
+
+    def select_expired(self) -> list[str]:
+        """Select the entries that are older than the TTL"""
+
+        expired = []
+        if self.ttl_seconds > 0:
+            expired_before = time.time() - self.ttl_seconds
+            for key, created_at in self._created_at.items():
+                if created_at >= expired_before:
+                    break
+                expired.append(key)
+
+        return expired
+
+    def select(self) -> list[str]:
+        """Select the entries to evict: the expired entries, then entries until the cache is at its low watermark"""
+
+        victims = self.select_expired()
+        n_entries = len(self) - len(victims)
+        nbytes = self.nbytes - sum(self._sizes[key] for key in victims)
+
+        if self.is_over_budget(n_entries, nbytes):
+            if self.policy == "lru":
+                candidates = iter(self._accessed)
+            elif self.policy == "lfu":
+                # The sort is stable, so entries used as often stay in the order of their last access
+                candidates = iter(sorted(self._accessed, key=self._hits.__getitem__))
+            else:
+                candidates = iter(self._created_at)
+
+            selected = set(victims)
+            for key in candidates:
+                if not self.is_over_budget(n_entries, nbytes, low_watermark):
+                    break
+                if key in selected:
+                    continue
+                victims.append(key)
+                n_entries -= 1
+                nbytes -= self._sizes[key]
+
+        return victims
@@ -0,0 +1,193 @@
+"""
+Harmony API client
+
+All calls to the Harmony API share one aiohttp session per event loop, so connections are pooled and kept alive. Every
+call has a connect and a read timeout, and is retried with exponential backoff on connection errors, 429 and 5xx
+responses.
+
+Texts and files are sent in batches bounded by a number of items and a number of bytes, and the batches are sent
+concurrently, so a large number of cache misses doesn't end up in one huge request.
+"""
+
+import asyncio
+import json
+import time
+from typing import Iterator
+
+import aiohttp
+
+from .. import constants
+from . import metrics
+
+_async_sessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+# The statuses of responses that are retried
+retry_statuses = [429, 500, 502, 503, 504]
+
+
+def iter_batches(
+    items: list, max_items: int, max_bytes: int
+) -> Iterator[tuple[list, bytes]]:
+    """
+    Split items into batches of at most max_items items and max_bytes bytes of JSON, an item larger than max_bytes is
+    a batch of its own
+    :return: (the items of a batch, the JSON body of the batch)
+    """
+
+    batch = []
+    encoded = []
+    size = 2
+    for item in items:
+        item_encoded = json.dumps(item).encode()
+        if batch and (
+            len(batch) >= max_items or size + len(item_encoded) + 1 > max_bytes
+        ):
+            yield batch, b"[" + b",".join(encoded) + b"]"
+            batch = []
+            encoded = []
+            size = 2
+        batch.append(item)
+        encoded.append(item_encoded)
+        size += len(item_encoded) + 1
+
+    if batch:
+        yield batch, b"[" + b",".join(encoded) + b"]"
+
+
+def observe_batch(path: str, batch: list, started: float):
+    """Observe the items and the duration of a call, started at a perf_counter() time"""
+
+    metrics.observe("harmonycache_upstream_batch_items", len(batch), path=path)
+    metrics.observe(
+        "harmonycache_upstream_seconds", time.perf_counter() - started, path=path
+    )
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Get the shared aiohttp session of the running event loop"""
+
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=constants.HARMONY_API_CONNECT_TIMEOUT_SECONDS,
+                sock_read=constants.HARMONY_API_TIMEOUT_SECONDS,
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+        _async_sessions[loop] = session
+
+    return session
+
+
+def get_retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Get the delay before a retry, the Retry-After header of the response if it is given in seconds"""
+
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+
+    return constants.HARMONY_API_RETRY_BACKOFF_SECONDS * 2**attempt
+
+
+async def post_async(path: str, body: bytes) -> list:
+    """
+    Post a JSON body to the Harmony API
+    :raises aiohttp.ClientError: if the request failed after all retries
+    :raises asyncio.TimeoutError: if the last retry timed out
+    """
+
+    session = get_async_session()
+    for attempt in range(constants.HARMONY_API_RETRIES + 1):
+        is_last_attempt = attempt == constants.HARMONY_API_RETRIES
+        try:
+            async with session.post(
+                url=f"{constants.harmony_api}{path}", data=body
+            ) as response:
+                if response.status in retry_statuses and not is_last_attempt:
+                    delay = get_retry_delay(
+                        attempt, response.headers.get("Retry-After")
+                    )
+                else:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if is_last_attempt:
+                raise
+            delay = get_retry_delay(attempt)
+        await asyncio.sleep(delay)
+
+
+async def post_batches_async(
+    path: str, batches: list[tuple[list, bytes]]
+) -> list[list]:
+    """Post batches concurrently and return the response of each batch, in order"""
+
+    semaphore = asyncio.Semaphore(constants.HARMONY_API_CONCURRENCY)
+
+    async def post_batch(batch: tuple[list, bytes]) -> list:
+        async with semaphore:
+            started = time.perf_counter()
+            response = await post_async(path, batch[1])
+            observe_batch(path, batch[0], started)
+            return response
+
+    return list(await asyncio.gather(*(post_batch(batch) for batch in batches)))
+
+
+async def get_vectors_async(texts: list[str]) -> list[list[float]]:
+    """
+    Get the vectors of texts, in the order of the texts
+    :raises aiohttp.ClientError: if a batch failed after all retries
+    :raises asyncio.TimeoutError: if a batch timed out after all retries
+    :raises ValueError: if the Harmony API didn't return one vector per text
+    """
+
+    if not texts:
+        return []
+
+    batches = list(
+        iter_batches(
+            texts,
+            max_items=constants.HARMONY_API_VECTORS_BATCH_SIZE,
+            max_bytes=constants.HARMONY_API_MAX_BATCH_BYTES,
+        )
+    )
+
+    vectors = []
+    for (batch, _), batch_vectors in zip(
+        batches, await post_batches_async("/text/vectors", batches)
+    ):
+        if len(batch_vectors) != len(batch):
+            raise ValueError(
+                f"Expected {len(batch)} vectors from Harmony API, got {len(batch_vectors)}"
+            )
+        vectors.extend(batch_vectors)
+
+    return vectors
+
+
+async def parse_async(files: list) -> list:
+    """
+    Parse files into instruments
+    :raises aiohttp.ClientError: if a batch failed after all retries
+    :raises asyncio.TimeoutError: if a batch timed out after all retries
+    :raises ValueError: if the Harmony API returned a body that isn't JSON
+    """
+
+    if not files:
+        return []
+
+    batches = list(
+        iter_batches(
+            files,
+            max_items=constants.HARMONY_API_PARSE_BATCH_SIZE,
+            max_bytes=constants.HARMONY_API_MAX_BATCH_BYTES,
+        )
+    )
+
+    return [
+        instrument
+        for instruments in await post_batches_async("/text/parse", batches)
+        for instrument in instruments
+    ]
@@ -0,0 +1,77 @@
+"""
+Hashing of file contents into cache keys
+
+A content key is the hex digest of the content, prefixed with the version of the key, so keys hashed with different
+algorithms never collide:
+
+- 'sha256' keys have no prefix, they were hashed before keys were versioned
+- 'blake2b' keys (256-bit digests) start with 'b2:'
+
+sha256 is the default, as it is faster than blake2b on CPUs with SHA extensions. A client that hashes a file the same
+way can send its key as 'content_hash' instead of its content.
+
+A key can be put in a namespace, e.g. the version of the model its cached value was computed with, so the values of
+a new model don't mix with the values of the previous model: '<namespace>:<key>'. Keys in the empty namespace have no
+prefix, they were cached before keys had namespaces.
+
+Content is hashed a chunk at a time, so a large base64 content string is never encoded as a whole.
+"""
+
+import hashlib
+import re
+
+from .. import constants
+
+# The prefix of the keys hashed with each algorithm
+key_prefixes = {"sha256": "", "blake2b": "b2:"}
+
+# The size of the chunks content is encoded and hashed in
+chunk_size = 1 << 20
+
+_key_pattern = re.compile(
+    f"^({'|'.join(re.escape(prefix) for prefix in key_prefixes.values())})[0-9a-f]{{64}}$"
+)
+
+
+def get_hash(algorithm: str):
+    """Get a new hash object of an algorithm"""
+
+    if algorithm not in key_prefixes:
+        raise ValueError(f"Hash algorithm must be one of {', '.join(key_prefixes)}")
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+
+    return hashlib.new(algorithm)
+
+
+def get_content_key(
+    content: str | bytes, algorithm: str = constants.CONTENT_HASH_ALGORITHM
+) -> str:
+    """Get the key of a content, the same key as of its UTF-8 bytes for a string"""
+
+    content_hash = get_hash(algorithm)
+    if isinstance(content, str):
+        for start in range(0, len(content), chunk_size):
+            content_hash.update(content[start : start + chunk_size].encode())
+    else:
+        content_hash.update(content)
+
+    return key_prefixes[algorithm] + content_hash.hexdigest()
+
+
+def is_content_key(value) -> bool:
+    """Check if a value is a well-formed content key, e.g. a client-supplied content hash"""
+
+    return isinstance(value, str) and _key_pattern.match(value) is not None
+
+
+def get_digest(key: str) -> str:
+    """Get the hex digest of a key, without the prefixes of its namespace and version"""
+
+    return key.rsplit(":", 1)[-1]
+
+
+def add_namespace(key: str, namespace: str) -> str:
+    """Put a key in a namespace"""
+
+    return f"{namespace}:{key}" if namespace else key
@@ -1,19 +1,25 @@
-import json
-import json
+import asyncio
+import itertools
 import logging
-import os
-import pickle
-import tempfile
+import time
 import traceback
 from hashlib import sha256
+from typing import Coroutine
 from typing import List
 
-import numpy as np
 from azure.storage.blob import ContainerClient
+from azure.storage.blob.aio import ContainerClient as AsyncContainerClient
 
 from .. import constants
 from ..models.instrument import Instrument
-from ..models.question import Question
+from . import cache_storage
+from . import disk_cache
+from . import metrics
+from . import vector_snapshot
+from .bounded_cache import BoundedCache
+from .disk_cache import DiskCache
+from .eviction import EvictionPolicy
+from .vector_store import VectorStore
 
 
 def get_container_harmonycache() -> ContainerClient:
@@ -25,6 +31,15 @@ def get_container_harmonycache() -> ContainerClient:
     )
 
 
+def get_container_harmonycache_async() -> AsyncContainerClient:
+    """Get container 'harmonycache' with an async client"""
+
+    return AsyncContainerClient.from_connection_string(
+        conn_str=constants.AZURE_STORAGE_CONNECTION_STRING,
+        container_name="harmonycache",
+    )
+
+
 def get_container_mhc() -> ContainerClient:
     """Get container 'mhc'"""
 
@@ -50,78 +65,179 @@ def get_cache_from_azure(cache_file_name: str) -> dict:
     cache = {}
 
     try:
-        logging.info(f"Loading blob {cache_file_name} from Azure blob storage")
-        cache = pickle.loads(
-            container_harmonycache.download_blob(blob=cache_file_name).readall()
+        logging.info(f"Loading cache {cache_file_name} from Azure blob storage")
+        cache = cache_storage.load_entries(
+            container=container_harmonycache, cache_file_name=cache_file_name
         )
     except (Exception,):
-        logging.error(f"Could not download blob {cache_file_name}")
+        logging.error(f"Could not load cache {cache_file_name}")
         logging.error(traceback.format_exc())
 
     return cache
 
 
-def save_cache_to_blob_storage(
-    cache_tmp_file_path: str,
+def get_vector_store_from_azure(
     cache_file_name: str,
-    cache: dict,
-):
-    """Save cache to blob storage"""
+    policy: EvictionPolicy | None = None,
+    disk: DiskCache | None = None,
+) -> VectorStore:
+    """
+    Get vector store from Azure Blob Storage
+
+    The snapshot of the vector store is memory-mapped, only the entries written after the snapshot are loaded in
+    memory. With a disk tier, the disk is synced with the entries written after the snapshot instead, and they are
+    read from the disk on first use.
+    """
 
     container_harmonycache = get_container_harmonycache()
+    snapshot = None
 
-    # Store data
-    with open(cache_tmp_file_path, "wb") as file:
-        pickle.dump(cache, file, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        snapshot = vector_snapshot.download_snapshot(
+            container=container_harmonycache, cache_file_name=cache_file_name
+        )
+    except (Exception,):
+        logging.error(f"Could not download snapshot of {cache_file_name}")
+        logging.error(traceback.format_exc())
 
-    # Load data
-    with open(cache_tmp_file_path, "rb") as file:
-        data = file.read()
+    if disk is not None:
+        disk_cache.sync_from_blob_storage(
+            container=container_harmonycache, cache_file_name=cache_file_name, disk=disk
+        )
+        if snapshot is not None:
+            remove_snapshot_vectors_from_disk(disk=disk, snapshot=snapshot)
+
+        return VectorStore(
+            dtype=constants.VECTOR_STORE_DTYPE,
+            snapshot=snapshot,
+            policy=policy,
+            disk=disk,
+        )
 
-    # Upload cache
-    container_harmonycache.upload_blob(name=cache_file_name, data=data, overwrite=True)
+    return VectorStore.from_dict(
+        get_cache_from_azure(cache_file_name=cache_file_name),
+        dtype=constants.VECTOR_STORE_DTYPE,
+        snapshot=snapshot,
+        policy=policy,
+    )
 
 
-def get_hash_value(text: str) -> str:
-    """Get hash value"""
+def remove_snapshot_vectors_from_disk(
+    disk: DiskCache, snapshot: vector_snapshot.VectorSnapshot, chunk_size: int = 10000
+):
+    """Remove the vectors that were compacted into the snapshot from a disk tier, their negations are kept"""
+
+    keys = disk.iter_keys()
+    while chunk := list(itertools.islice(keys, chunk_size)):
+        rows = snapshot.find_rows(chunk)
+        in_snapshot = [key for key, row in zip(chunk, rows) if row >= 0]
+        disk.put_many(
+            {
+                key: (
+                    {"negations": entry["negations"]}
+                    if entry.get("negations")
+                    else None
+                )
+                for key, entry in disk.get_many(in_snapshot).items()
+                if "vector" in entry
+            }
+        )
 
-    return sha256(text.encode()).hexdigest()
 
+def observe_persisted(cache_file_name: str, new_entries: dict, started: float):
+    """Observe the duration of appending new cache entries to blob storage, started at a perf_counter() time"""
 
-def get_mhc_embeddings() -> tuple:
-    """Get MHC embeddings"""
+    cache = cache_storage.get_cache_folder(cache_file_name)
+    metrics.observe(
+        "harmonycache_persist_seconds", time.perf_counter() - started, cache=cache
+    )
+    metrics.increment(
+        "harmonycache_persist_entries_total", len(new_entries), cache=cache
+    )
 
-    mhc_questions = []
-    mhc_all_metadata = []
-    mhc_embeddings = np.zeros((0, 0))
 
-    container_mhc = get_container_mhc()
+def save_cache_to_blob_storage(cache_file_name: str, new_entries: dict):
+    """Append new cache entries to blob storage"""
 
-    mhc_questions_json = container_mhc.download_blob("mhc_questions.json").readall()
-    mhc_all_metadata_json = container_mhc.download_blob(
-        "mhc_all_metadatas.json"
-    ).readall()
-    mhc_embeddings_npy = container_mhc.download_blob("mhc_embeddings.npy").readall()
+    container_harmonycache = get_container_harmonycache()
 
+    started = time.perf_counter()
     try:
-        for line in mhc_questions_json.splitlines():
-            mhc_question = Question.parse_raw(line)
-            mhc_questions.append(mhc_question)
+        cache_storage.append_entries(
+            container=container_harmonycache,
+            cache_file_name=cache_file_name,
+            entries=new_entries,
+        )
+        observe_persisted(cache_file_name, new_entries, started)
+    except (Exception,):
+        logging.error(f"Could not save cache {cache_file_name}")
+        logging.error(traceback.format_exc())
 
-        for line in mhc_all_metadata_json.splitlines():
-            mhc_metadata = json.loads(line)
-            mhc_all_metadata.append(mhc_metadata)
 
-        mhc_embeddings_npy_tmp_file_path = os.path.join(
-            tempfile.gettempdir(), "mhc_embeddings.npy"
+async def save_cache_to_blob_storage_async(cache_file_name: str, new_entries: dict):
+    """Append new cache entries to blob storage with an async client"""
+
+    started = time.perf_counter()
+    try:
+        async with get_container_harmonycache_async() as container_harmonycache:
+            await cache_storage.append_entries_async(
+                container=container_harmonycache,
+                cache_file_name=cache_file_name,
+                entries=new_entries,
+            )
+        observe_persisted(cache_file_name, new_entries, started)
+    except (Exception,):
+        logging.error(f"Could not save cache {cache_file_name}")
+        logging.error(traceback.format_exc())
+
+
+# Background tasks are referenced until they are done, so they aren't garbage collected while running
+_background_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(coroutine: Coroutine):
+    """Run a coroutine in a background task of the running event loop"""
+
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def save_cache_in_background(cache_file_name: str, new_entries: dict):
+    """Append new cache entries to blob storage in a background task of the running event loop"""
+
+    run_in_background(
+        save_cache_to_blob_storage_async(
+            cache_file_name=cache_file_name, new_entries=new_entries
         )
-        with open(mhc_embeddings_npy_tmp_file_path, "wb") as file:
-            file.write(mhc_embeddings_npy)
-        mhc_embeddings = np.load(mhc_embeddings_npy_tmp_file_path)
-    except (Exception,) as e:
-        logging.error(f"Could not load MHC embeddings: {e}")
+    )
 
-    return mhc_questions, mhc_all_metadata, mhc_embeddings
+
+def trim_and_save_cache_in_background(
+    cache: BoundedCache | VectorStore, cache_file_name: str, new_entries: dict
+):
+    """Keep a cache within its budget, and append its new entries and tombstones to blob storage in the background"""
+
+    n_entries = len(cache.policy)
+    evicted = cache.trim()
+    metrics.increment(
+        "harmonycache_cache_evictions_total",
+        n_entries - len(cache.policy),
+        cache=cache_storage.get_cache_folder(cache_file_name),
+    )
+    if evicted and constants.CACHE_PERSIST_EVICTIONS:
+        new_entries = {**new_entries, **cache_storage.get_tombstones(evicted)}
+
+    if new_entries:
+        save_cache_in_background(
+            cache_file_name=cache_file_name, new_entries=new_entries
+        )
+
+
+def get_hash_value(text: str) -> str:
+    """Get hash value"""
+
+    return sha256(text.encode()).hexdigest()
 
 
 def get_example_questionnaires() -> List:
@@ -150,5 +266,8 @@ def clear_all_cache():
 
     container = get_container_harmonycache()
 
-    container.delete_blob(blob=constants.cache_instruments_pkl)
-    container.delete_blob(blob=constants.cache_vectors_pkl)
+    cache_storage.delete_all(
+        container=container, cache_file_name=constants.cache_instruments_pkl
+    )
+    for cache_file_name in cache_storage.vectors_caches:
+        cache_storage.delete_all(container=container, cache_file_name=cache_file_name)
@@ -0,0 +1,157 @@
+"""
+Segment files of JSON cache entries
+
+The values of a JSON cache, e.g. the instruments cache, are kept as serialized JSON bytes, so a cached value can be
+spliced into a response without serializing it again. They are stored in segment files:
+
+    segment := magic | record* | index | footer
+    record  := flags (uint8) | length (uint32) | data
+    index   := count (uint32) | (key length (uint16) | key | record offset (uint64))*, sorted by key
+    footer  := index offset (uint64) | magic
+
+All integers are little-endian. The data of a record is the JSON bytes of the value, zlib-compressed if the value is at
+least CACHE_COMPRESS_MIN_BYTES long and compressing makes it smaller. A tombstone is a record without data.
+"""
+
+import bisect
+import json
+import struct
+import zlib
+from typing import Iterator
+
+from .. import constants
+
+magic = b"HCSEG001"
+
+# Record flags
+flag_compressed = 1
+flag_tombstone = 2
+
+_record_header = struct.Struct("<BI")
+_count = struct.Struct("<I")
+_key_length = struct.Struct("<H")
+_offset = struct.Struct("<Q")
+
+
+def to_json_bytes(value) -> bytes:
+    """Get the JSON bytes of a value, values that are JSON bytes already are returned as they are"""
+
+    if isinstance(value, bytes):
+        return value
+
+    return json.dumps(value).encode()
+
+
+def is_segment(data: bytes) -> bool:
+    """Check if data is a segment file"""
+
+    return data[: len(magic)] == magic
+
+
+def write_segment(entries: dict) -> bytes:
+    """Write entries of {key: JSON bytes or JSON-serializable value, None for a tombstone} to a segment file"""
+
+    chunks = [magic]
+    position = len(magic)
+    offsets = {}
+    for key in sorted(entries):
+        value = entries[key]
+        if value is None:
+            flags, data = flag_tombstone, b""
+        else:
+            flags, data = 0, to_json_bytes(value)
+            if len(data) >= constants.CACHE_COMPRESS_MIN_BYTES:
+                compressed = zlib.compress(data)
+                if len(compressed) < len(data):
+                    flags, data = flag_compressed, compressed
+        offsets[key] = position
+        chunks += [_record_header.pack(flags, len(data)), data]
+        position += _record_header.size + len(data)
+
+    index_offset = position
+    chunks.append(_count.pack(len(offsets)))
+    for key, offset in offsets.items():
+        encoded_key = key.encode()
+        chunks += [
+            _key_length.pack(len(encoded_key)),
+            encoded_key,
+            _offset.pack(offset),
+        ]
+    chunks += [_offset.pack(index_offset), magic]
+
+    return b"".join(chunks)
+
+
+class SegmentReader:
+    """Reads the entries of a segment file, only the index is parsed up front"""
+
+    def __init__(self, data: bytes):
+        if (
+            len(data) < 2 * len(magic) + _count.size + _offset.size
+            or not is_segment(data)
+            or data[-len(magic) :] != magic
+        ):
+            raise ValueError("Not a segment file")
+
+        self._data = memoryview(data)
+        (index_offset,) = _offset.unpack_from(
+            self._data, len(data) - len(magic) - _offset.size
+        )
+        (count,) = _count.unpack_from(self._data, index_offset)
+        position = index_offset + _count.size
+        self._keys: list[str] = []
+        self._offsets: list[int] = []
+        for _ in range(count):
+            (key_length,) = _key_length.unpack_from(self._data, position)
+            position += _key_length.size
+            self._keys.append(
+                str(self._data[position : position + key_length], "utf-8")
+            )
+            position += key_length
+            self._offsets.append(_offset.unpack_from(self._data, position)[0])
+            position += _offset.size
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return self._find(key) >= 0
+
+    def _find(self, key: str) -> int:
+        """Find the position of a key in the index, -1 if it isn't there"""
+
+        i = bisect.bisect_left(self._keys, key)
+
+        return i if i < len(self._keys) and self._keys[i] == key else -1
+
+    def _read_record(self, offset: int) -> bytes | None:
+        """Read the value of the record at an offset, None for a tombstone"""
+
+        flags, length = _record_header.unpack_from(self._data, offset)
+        if flags & flag_tombstone:
+            return None
+        start = offset + _record_header.size
+        data = bytes(self._data[start : start + length])
+
+        return zlib.decompress(data) if flags & flag_compressed else data
+
+    def keys(self) -> list[str]:
+        return self._keys
+
+    def get(self, key: str, default=None) -> bytes | None:
+        """Get the JSON bytes of a key, None for a tombstone"""
+
+        i = self._find(key)
+        if i < 0:
+            return default
+
+        return self._read_record(self._offsets[i])
+
+    def items(self) -> Iterator[tuple[str, bytes | None]]:
+        """Iterate over (key, JSON bytes or None for a tombstone) by ascending key"""
+
+        for key, offset in zip(self._keys, self._offsets):
+            yield key, self._read_record(offset)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
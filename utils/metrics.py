@@ -0,0 +1,212 @@
+"""
+Metrics of the functions
+
+Counters and histograms are kept in the worker process, and exposed by /api/metrics in the Prometheus text format.
+Gauges, e.g. the size of the caches, are collected when the metrics are rendered.
+
+A request times its stages with a StageTimer. Once the request is done, the duration of each stage is observed, and
+the durations are returned in the Server-Timing header of the response.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from .. import constants
+
+# The buckets of durations in seconds
+duration_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The buckets of sizes, e.g. the number of items of a batch
+size_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# The type, help and buckets of each metric
+descriptions = {
+    "harmonycache_stage_seconds": (
+        "histogram",
+        "Duration of a stage of a request",
+        duration_buckets,
+    ),
+    "harmonycache_cache_hits_total": ("counter", "Cache lookups that were hits", None),
+    "harmonycache_cache_misses_total": (
+        "counter",
+        "Cache lookups that were misses",
+        None,
+    ),
+    "harmonycache_cache_evictions_total": (
+        "counter",
+        "Cache entries evicted from memory",
+        None,
+    ),
+    "harmonycache_upstream_batch_items": (
+        "histogram",
+        "Items of a Harmony API call",
+        size_buckets,
+    ),
+    "harmonycache_upstream_seconds": (
+        "histogram",
+        "Duration of a Harmony API call, with retries",
+        duration_buckets,
+    ),
+    "harmonycache_persist_seconds": (
+        "histogram",
+        "Duration of appending new cache entries to blob storage",
+        duration_buckets,
+    ),
+    "harmonycache_persist_entries_total": (
+        "counter",
+        "Cache entries and tombstones appended to blob storage",
+        None,
+    ),
+    "harmonycache_cache_entries": (
+        "gauge",
+        "Entries of a cache, of the vectors in memory and in the snapshot, of the instruments in memory or on disk",
+        None,
+    ),
+    "harmonycache_cache_bytes": ("gauge", "Bytes of a cache in memory", None),
+}
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, tuple], float] = {}
+_histograms: dict[tuple[str, tuple], list[float]] = {}
+_collectors: list[Callable[[], Iterable[tuple[str, dict, float]]]] = []
+
+
+def _get_key(name: str, labels: dict) -> tuple[str, tuple]:
+    if name not in descriptions:
+        raise ValueError(f"Unknown metric {name}")
+
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name: str, value: float = 1, **labels):
+    """Increment a counter"""
+
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """Observe a value of a histogram"""
+
+    key = _get_key(name, labels)
+    buckets = descriptions[name][2]
+    with _lock:
+        # The count of each bucket, then the count and the sum of all values
+        histogram = _histograms.setdefault(key, [0] * (len(buckets) + 2))
+        for i, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+def register_collector(collect: Callable[[], Iterable[tuple[str, dict, float]]]):
+    """Register a function that gets the (name, labels, value) of gauges when the metrics are rendered"""
+
+    _collectors.append(collect)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Iterable[tuple[str, object]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render() -> str:
+    """Render the metrics in the Prometheus text format"""
+
+    gauges = {}
+    for collect in _collectors:
+        for name, labels, value in collect():
+            gauges[_get_key(name, labels)] = value
+
+    with _lock:
+        values = {**_counters, **gauges}
+        histograms = {key: list(histogram) for key, histogram in _histograms.items()}
+
+    lines = []
+    for name, (kind, help_text, buckets) in descriptions.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        if kind == "histogram":
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bucket, count in zip(buckets, histogram):
+                    lines.append(
+                        f"{name}_bucket{_format_labels([*labels, ('le', bucket)])} {count}"
+                    )
+                lines += [
+                    f"{name}_bucket{_format_labels([*labels, ('le', '+Inf')])} {histogram[-2]}",
+                    f"{name}_count{_format_labels(labels)} {histogram[-2]}",
+                    f"{name}_sum{_format_labels(labels)} {_format_value(histogram[-1])}",
+                ]
+        else:
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(
+                        f"{name}{_format_labels(labels)} {_format_value(value)}"
+                    )
+
+    return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Times the stages of a request of a function"""
+
+    def __init__(self, function: str):
+        self.function = function
+        self.durations: dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time a stage, the durations of a stage that is timed more than once, e.g. per file, are added up"""
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = (
+                self.durations.get(name, 0) + time.perf_counter() - started
+            )
+
+    def finish(self) -> dict:
+        """
+        Observe the duration of each stage and of the whole request
+        :return: the Server-Timing header of the response, the durations in milliseconds
+        """
+
+        durations = {
+            **self.durations,
+            "total": time.perf_counter() - self._started,
+        }
+        for name, duration in durations.items():
+            observe(
+                "harmonycache_stage_seconds",
+                duration,
+                function=self.function,
+                stage=name,
+            )
+
+        if not constants.SERVER_TIMING:
+            return {}
+
+        return {
+            "Server-Timing": ", ".join(
+                f"{name};dur={duration * 1000:.1f}"
+                for name, duration in durations.items()
+            )
+        }
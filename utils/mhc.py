@@ -0,0 +1,101 @@
+"""
+MHC reference corpus
+
+The corpus is kept in the process. Once the refresh interval has passed, the ETag of the embeddings blob is checked
+and the corpus is only downloaded again if it changed. A check that failed is retried after a short delay.
+"""
+
+import io
+import json
+import logging
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from .. import constants
+from ..models.question import Question
+from . import helpers
+from .nn_index import build_index
+from .similarity import normalize
+
+_lock = threading.Lock()
+_corpus: tuple = (
+    [],
+    [],
+    np.zeros((0, 0), dtype=np.float32),
+    build_index(np.zeros((0, 0), dtype=np.float32)),
+)
+_etag: str | None = None
+_next_check_at = 0.0
+
+# The delay before a failed check or download is retried
+retry_interval_seconds = 10
+
+
+def download_mhc_embeddings() -> tuple:
+    """Download MHC embeddings"""
+
+    mhc_questions = []
+    mhc_all_metadata = []
+
+    container_mhc = helpers.get_container_mhc()
+
+    mhc_questions_json = container_mhc.download_blob("mhc_questions.json").readall()
+    mhc_all_metadata_json = container_mhc.download_blob(
+        "mhc_all_metadatas.json"
+    ).readall()
+    mhc_embeddings_npy = container_mhc.download_blob("mhc_embeddings.npy").readall()
+
+    for line in mhc_questions_json.splitlines():
+        mhc_question = Question.parse_raw(line)
+        mhc_questions.append(mhc_question.dict())
+
+    for line in mhc_all_metadata_json.splitlines():
+        mhc_metadata = json.loads(line)
+        mhc_all_metadata.append(mhc_metadata)
+
+    mhc_embeddings = normalize(np.load(io.BytesIO(mhc_embeddings_npy)))
+    mhc_index = build_index(mhc_embeddings)
+
+    return mhc_questions, mhc_all_metadata, mhc_embeddings, mhc_index
+
+
+def get_mhc_embeddings() -> tuple:
+    """
+    Get MHC embeddings
+    :return: the questions (as dicts), the metadata, the normalized embeddings and a nearest neighbour index of the
+        embeddings
+    """
+
+    global _corpus, _etag, _next_check_at
+
+    if time.monotonic() < _next_check_at:
+        return _corpus
+
+    with _lock:
+        if time.monotonic() < _next_check_at:
+            return _corpus
+
+        try:
+            etag = (
+                helpers.get_container_mhc()
+                .get_blob_client("mhc_embeddings.npy")
+                .get_blob_properties()
+                .etag
+            )
+            if etag != _etag:
+                logging.info("Loading MHC embeddings")
+                _corpus = download_mhc_embeddings()
+                _etag = etag
+            _next_check_at = time.monotonic() + constants.MHC_REFRESH_INTERVAL_SECONDS
+        except (Exception,):
+            # Keep serving the corpus that was loaded before, until a retry succeeds
+            logging.error("Could not load MHC embeddings")
+            logging.error(traceback.format_exc())
+            _next_check_at = time.monotonic() + min(
+                retry_interval_seconds, constants.MHC_REFRESH_INTERVAL_SECONDS
+            )
+
+    return _corpus
@@ -1,9 +1,19 @@
 """This file was copied from Harmony"""
 
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+
 import spacy
 
+from .. import constants
+
 nlp = spacy.blank("en")
 
+# Negated texts by (language, hash of text), least recently used first
+_memo: OrderedDict = OrderedDict()
+_memo_lock = threading.Lock()
+
 
 def get_change_en(doc) -> dict:
     """
@@ -83,22 +93,16 @@ def get_change_pt(doc) -> dict:
     return {0: ("insert_before", "não")}
 
 
-def negate(text: str, language: str) -> str:
-    """
-    Converts negative sentences to pos and vice versa.
-    Not meant to generate 100% accurate natural language, it's to go into transformer model and is not shown to a human.
-    :param text:
-    :param language: "en" or "pt"
-    :return: the sentence negated
-    """
-    doc = nlp(text)
+def get_negation_language(language: str) -> str:
+    """Get the language whose negation rules apply to a language, "pt" or "en" """
+
+    return "pt" if language == "pt" else "en"
 
-    if language == "pt":
-        changes = get_change_pt(doc)
-    else:
-        changes = get_change_en(doc)
 
-    text = ""
+def apply_changes(doc, changes: dict) -> str:
+    """Apply the changes to a doc and return the text"""
+
+    tokens = []
     for tok in doc:
         this_token_text = tok.text
         if tok.i in changes:
@@ -109,5 +113,66 @@ def negate(text: str, language: str) -> str:
                 this_token_text += " " + change_text
             elif change_operation == "insert_before":
                 this_token_text = change_text + " " + this_token_text
-        text += this_token_text + tok.whitespace_
-    return text
+        tokens.append(this_token_text)
+        tokens.append(tok.whitespace_)
+
+    return "".join(tokens)
+
+
+def negate(text: str, language: str) -> str:
+    """
+    Converts negative sentences to pos and vice versa.
+    Not meant to generate 100% accurate natural language, it's to go into transformer model and is not shown to a human.
+    :param text:
+    :param language: "en" or "pt"
+    :return: the sentence negated
+    """
+
+    return negate_many([text], [language])[0]
+
+
+def negate_many(texts: list[str], languages: list[str]) -> list[str]:
+    """
+    Negate many texts at once.
+    The texts are tokenized in batches with nlp.pipe, grouped by language, and the negated texts are memoized.
+    :param texts:
+    :param languages: the language of each text
+    :return: the negated texts
+    """
+
+    negated_texts: list[str | None] = [None] * len(texts)
+
+    # Positions of the texts that aren't memoized, by language and key
+    missing: dict[str, dict[tuple, list[int]]] = {}
+    with _memo_lock:
+        for i, (text, language) in enumerate(zip(texts, languages)):
+            language = get_negation_language(language)
+            key = (language, sha256(text.encode()).digest())
+            if key in _memo:
+                _memo.move_to_end(key)
+                negated_texts[i] = _memo[key]
+            else:
+                missing.setdefault(language, {}).setdefault(key, []).append(i)
+
+    for language, positions_by_key in missing.items():
+        keys = list(positions_by_key.keys())
+        docs = nlp.pipe(
+            (texts[positions_by_key[key][0]] for key in keys),
+            batch_size=constants.NEGATION_BATCH_SIZE,
+        )
+        for key, doc in zip(keys, docs):
+            if language == "pt":
+                changes = get_change_pt(doc)
+            else:
+                changes = get_change_en(doc)
+            negated = apply_changes(doc, changes)
+
+            for i in positions_by_key[key]:
+                negated_texts[i] = negated
+
+            with _memo_lock:
+                _memo[key] = negated
+                if len(_memo) > constants.NEGATION_MEMO_SIZE:
+                    _memo.popitem(last=False)
+
+    return negated_texts
@@ -0,0 +1,176 @@
+"""
+Nearest neighbour indexes over normalized vectors
+
+- ExactIndex searches all vectors with a blocked matmul, so its memory footprint is bounded by the block size
+- IVFIndex is an approximate inverted file index: the vectors are clustered with k-means, and a query only searches
+  the vectors of the n_probe clusters closest to it
+"""
+
+import numpy as np
+
+from .. import constants
+
+
+def merge_top_k(
+    best_indices: np.ndarray,
+    best_scores: np.ndarray,
+    indices: np.ndarray,
+    scores: np.ndarray,
+    k: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Merge the top k so far with new candidates, per row"""
+
+    all_indices = np.concatenate([best_indices, indices], axis=1)
+    all_scores = np.concatenate([best_scores, scores], axis=1)
+    if all_scores.shape[1] > k:
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        all_indices = np.take_along_axis(all_indices, top, axis=1)
+        all_scores = np.take_along_axis(all_scores, top, axis=1)
+
+    return all_indices, all_scores
+
+
+def sort_top_k(
+    indices: np.ndarray, scores: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sort the top k by descending score, per row"""
+
+    order = np.argsort(-scores, axis=1, kind="stable")
+
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(
+        scores, order, axis=1
+    )
+
+
+class ExactIndex:
+    """Exact nearest neighbour search with a blocked matmul"""
+
+    def __init__(
+        self, vectors: np.ndarray, block_size: int = constants.NN_INDEX_BLOCK_SIZE
+    ):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.block_size = block_size
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def search(self, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search the k nearest neighbours of normalized queries
+        :return: the indices and the cosine similarities of the neighbours of each query, by descending similarity
+        """
+
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+
+        best_indices = np.zeros((len(queries), 0), dtype=np.intp)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            block = self.vectors[start : start + self.block_size]
+            scores = np.matmul(queries, block.T)
+            indices = np.broadcast_to(
+                np.arange(start, start + len(block)), scores.shape
+            )
+            best_indices, best_scores = merge_top_k(
+                best_indices, best_scores, indices, scores, k
+            )
+
+        return sort_top_k(best_indices, best_scores)
+
+
+class IVFIndex:
+    """Approximate nearest neighbour search with an inverted file index, trained with spherical k-means"""
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        n_lists: int = 0,
+        n_probe: int = constants.NN_INDEX_N_PROBE,
+        n_iter: int = 10,
+        seed: int = 0,
+    ):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.n_lists = min(n_lists or max(int(np.sqrt(len(vectors))), 1), len(vectors))
+        self.n_probe = min(n_probe, self.n_lists)
+
+        self.centroids = self._train(n_iter=n_iter, seed=seed)
+        assignments = np.argmax(np.matmul(self.vectors, self.centroids.T), axis=1)
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            assignments[self.order], np.arange(self.n_lists + 1)
+        )
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def _train(self, n_iter: int, seed: int) -> np.ndarray:
+        """Cluster the vectors with spherical k-means"""
+
+        rng = np.random.default_rng(seed)
+        centroids = self.vectors[
+            rng.choice(len(self.vectors), size=self.n_lists, replace=False)
+        ].copy()
+        for _ in range(n_iter):
+            assignments = np.argmax(np.matmul(self.vectors, centroids.T), axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, self.vectors)
+            norms = np.linalg.norm(sums, axis=1)
+            # Keep the old centroid of an empty cluster
+            non_empty = norms > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty, np.newaxis]
+
+        return centroids
+
+    def search(self, queries: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Search the approximate k nearest neighbours of normalized queries
+        :return: the indices and the cosine similarities of the neighbours of each query, by descending similarity,
+            -1 and -inf for the neighbours that weren't found
+        """
+
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+
+        probes = np.argpartition(
+            -np.matmul(queries, self.centroids.T), self.n_probe - 1, axis=1
+        )[:, : self.n_probe]
+
+        best_indices = np.full((len(queries), k), -1, dtype=np.intp)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        # Search list by list, every list with all the queries that probe it
+        for list_idx in np.unique(probes):
+            query_rows = np.flatnonzero((probes == list_idx).any(axis=1))
+            indices = self.order[self.offsets[list_idx] : self.offsets[list_idx + 1]]
+            if len(indices) == 0:
+                continue
+            scores = np.matmul(queries[query_rows], self.vectors[indices].T)
+            merged_indices, merged_scores = merge_top_k(
+                best_indices[query_rows],
+                best_scores[query_rows],
+                np.broadcast_to(indices, scores.shape),
+                scores,
+                k,
+            )
+            best_indices[query_rows] = merged_indices
+            best_scores[query_rows] = merged_scores
+
+        # The probed lists of a query can all be empty, then the query is searched exactly, so every query has a
+        # nearest neighbour. A query whose probed lists hold fewer than k vectors has -1 for the missing neighbours
+        if k > 0:
+            unmatched = np.flatnonzero(best_indices[:, 0] < 0)
+            if len(unmatched) > 0:
+                best_indices[unmatched], best_scores[unmatched] = ExactIndex(
+                    self.vectors
+                ).search(queries[unmatched], k)
+
+        return sort_top_k(best_indices, best_scores)
+
+
+def build_index(vectors: np.ndarray, kind: str = constants.NN_INDEX):
+    """Build a nearest neighbour index of kind 'exact' or 'ivf'"""
+
+    if kind == "ivf" and len(vectors) > 0:
+        return IVFIndex(vectors, n_lists=constants.NN_INDEX_N_LISTS)
+
+    return ExactIndex(vectors)
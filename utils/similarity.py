@@ -0,0 +1,193 @@
+"""
+Similarity engine
+
+All vectors are normalized once, when they enter the vector cache or the MHC corpus, so a cosine similarity is a plain
+matrix product. The similarity with polarity is computed in blocks of rows with a few BLAS matmuls into preallocated
+float32 buffers, and the polarity is applied in place.
+"""
+
+from typing import Iterator
+
+import numpy as np
+
+from .. import constants
+
+# Differences in similarity below this threshold don't flip the polarity
+polarity_threshold = 0.001
+
+
+def normalize(vectors, dtype="float32") -> np.ndarray:
+    """Normalize the rows of a matrix to unit length"""
+
+    vectors = np.array(vectors, dtype=dtype)
+    if vectors.size == 0:
+        return vectors
+
+    norms = np.linalg.norm(vectors.astype(np.float32, copy=False), axis=1)
+    norms[norms == 0] = 1
+    vectors /= norms[:, np.newaxis].astype(vectors.dtype)
+
+    return vectors
+
+
+def cosine_similarity(vectors_1: np.ndarray, vectors_2: np.ndarray) -> np.ndarray:
+    """Cosine similarity of normalized vectors"""
+
+    return np.matmul(
+        np.asarray(vectors_1, dtype=np.float32),
+        np.asarray(vectors_2, dtype=np.float32).T,
+    )
+
+
+def iter_similarity_with_polarity(
+    vectors_pos: np.ndarray,
+    vectors_neg: np.ndarray,
+    block_size: int = constants.SIMILARITY_BLOCK_SIZE,
+) -> Iterator[tuple[slice, np.ndarray]]:
+    """
+    Iterate over blocks of rows of the similarity with polarity of normalized vectors
+
+    For every pair of questions, the similarity of the positive forms is compared with the mean of the similarities
+    between the positive and the negated forms. The larger of the two is the similarity, and its sign is negative if
+    the negated forms are more similar.
+    :return: (the rows of the block, the block), the block is a buffer that is reused for the next block
+    """
+
+    vectors_pos = np.ascontiguousarray(vectors_pos, dtype=np.float32)
+    vectors_neg = np.ascontiguousarray(vectors_neg, dtype=np.float32)
+    n = len(vectors_pos)
+    block_size = max(min(block_size, n), 1)
+
+    similarity = np.empty((block_size, n), dtype=np.float32)
+    similarity_neg = np.empty((block_size, n), dtype=np.float32)
+    buffer = np.empty((block_size, n), dtype=np.float32)
+
+    for start in range(0, n, block_size):
+        rows = slice(start, min(start + block_size, n))
+        size = rows.stop - rows.start
+        yield rows, similarity_with_polarity_block(
+            vectors_pos=vectors_pos,
+            vectors_neg=vectors_neg,
+            rows=rows,
+            out=similarity[:size],
+            similarity_neg=similarity_neg[:size],
+            buffer=buffer[:size],
+        )
+
+
+def similarity_with_polarity_block(
+    vectors_pos: np.ndarray,
+    vectors_neg: np.ndarray,
+    rows: slice,
+    out: np.ndarray,
+    similarity_neg: np.ndarray,
+    buffer: np.ndarray,
+) -> np.ndarray:
+    """Compute a block of rows of the similarity with polarity into out"""
+
+    np.matmul(vectors_pos[rows], vectors_pos.T, out=out)
+
+    # The mean of neg/pos and pos/neg similarity
+    np.matmul(vectors_neg[rows], vectors_pos.T, out=similarity_neg)
+    np.matmul(vectors_pos[rows], vectors_neg.T, out=buffer)
+    similarity_neg += buffer
+    similarity_neg *= 0.5
+
+    # Polarity is negative where the negated forms are more similar
+    np.subtract(out, similarity_neg, out=buffer)
+    np.maximum(out, similarity_neg, out=out)
+    np.negative(out, out=out, where=buffer <= -polarity_threshold)
+
+    return out
+
+
+def get_similarity_with_polarity(
+    vectors_pos: np.ndarray, vectors_neg: np.ndarray
+) -> np.ndarray:
+    """Get the similarity with polarity matrix of normalized vectors"""
+
+    vectors_pos = np.ascontiguousarray(vectors_pos, dtype=np.float32)
+    vectors_neg = np.ascontiguousarray(vectors_neg, dtype=np.float32)
+    n = len(vectors_pos)
+    block_size = max(min(constants.SIMILARITY_BLOCK_SIZE, n), 1)
+
+    similarity_with_polarity = np.empty((n, n), dtype=np.float32)
+    similarity_neg = np.empty((block_size, n), dtype=np.float32)
+    buffer = np.empty((block_size, n), dtype=np.float32)
+
+    for start in range(0, n, block_size):
+        rows = slice(start, min(start + block_size, n))
+        size = rows.stop - rows.start
+        similarity_with_polarity_block(
+            vectors_pos=vectors_pos,
+            vectors_neg=vectors_neg,
+            rows=rows,
+            out=similarity_with_polarity[rows],
+            similarity_neg=similarity_neg[:size],
+            buffer=buffer[:size],
+        )
+
+    return similarity_with_polarity
+
+
+def get_sparse_similarity_with_polarity(
+    vectors_pos: np.ndarray,
+    vectors_neg: np.ndarray,
+    top_k: int | None = None,
+    min_similarity: float | None = None,
+    groups: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the similarity with polarity of normalized vectors as a CSR matrix, without the similarity of a question with
+    itself. The dense matrix is never materialized, pairs are selected block by block.
+    :param top_k: keep only the top_k most similar questions (by absolute similarity) of each question
+    :param min_similarity: keep only pairs with an absolute similarity of at least min_similarity
+    :param groups: keep only pairs of questions in different groups, e.g. the instruments of the questions
+    :return: indptr, indices and data of the CSR matrix, the columns of a row are sorted by descending absolute
+        similarity if top_k is given
+    """
+
+    n = len(vectors_pos)
+    row_lengths = np.zeros(n + 1, dtype=np.int64)
+    indices = []
+    data = []
+    scores = None
+
+    for rows, block in iter_similarity_with_polarity(vectors_pos, vectors_neg):
+        size = rows.stop - rows.start
+        if scores is None:
+            scores = np.empty_like(block)
+        score = scores[:size]
+
+        # Excluded pairs get a score below any absolute similarity
+        np.abs(block, out=score)
+        score[np.arange(size), np.arange(rows.start, rows.stop)] = -1
+        if groups is not None:
+            score[groups[rows, np.newaxis] == groups[np.newaxis, :]] = -1
+        if min_similarity is not None:
+            score[score < min_similarity] = -1
+
+        if top_k is not None:
+            k = min(top_k, n)
+            columns = np.argpartition(score, n - k, axis=1)[:, n - k :]
+            order = np.argsort(
+                -np.take_along_axis(score, columns, axis=1), axis=1, kind="stable"
+            )
+            columns = np.take_along_axis(columns, order, axis=1)
+            keep = np.take_along_axis(score, columns, axis=1) >= 0
+            block_rows = np.nonzero(keep)[0]
+            block_columns = columns[keep]
+        else:
+            block_rows, block_columns = np.nonzero(score >= 0)
+
+        row_lengths[rows.start + 1 : rows.stop + 1] = np.bincount(
+            block_rows, minlength=size
+        )
+        indices.append(block_columns)
+        data.append(block[block_rows, block_columns])
+
+    indptr = np.cumsum(row_lengths)
+    if not indices:
+        return indptr, np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.float32)
+
+    return indptr, np.concatenate(indices), np.concatenate(data)
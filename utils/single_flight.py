@@ -0,0 +1,78 @@
+"""
+Request coalescing
+
+Concurrent cache misses on the same key share one upstream call: the first miss of a key registers a future, the
+misses after it wait on that future. Misses that arrive within a short window, from any number of requests, are
+fetched together in one batch.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    An in-flight registry of keys of one event loop
+
+    fetch gets a list of items and returns one result per item, in the order of the items.
+    """
+
+    def __init__(self, fetch: Callable[[list], Awaitable[list]], window_seconds: float):
+        self.fetch = fetch
+        self.window_seconds = window_seconds
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._pending: list[tuple[str, Any]] = []
+        self._flush_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def get_many(self, keys: list[str], items: list) -> list:
+        """
+        Get the results of items, an item is only fetched if its key isn't in flight already
+        :raises Exception: the exception of the fetch of any of the items
+        """
+
+        loop = asyncio.get_running_loop()
+
+        futures = []
+        for key, item in zip(keys, items):
+            future = self._in_flight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._in_flight[key] = future
+                self._pending.append((key, item))
+            futures.append(future)
+
+        if self._pending and self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush())
+
+        # A cancelled request doesn't cancel the futures other requests wait on
+        return list(await asyncio.gather(*(asyncio.shield(f) for f in futures)))
+
+    async def _flush(self):
+        """Fetch the pending items once the window has passed"""
+
+        await asyncio.sleep(self.window_seconds)
+
+        pending = self._pending
+        self._pending = []
+        self._flush_task = None
+
+        # The keys stay in flight until the fetch is done, so later misses on them wait on it too
+        futures = [self._in_flight[key] for key, _ in pending]
+        try:
+            results = await self.fetch([item for _, item in pending])
+            if len(results) != len(pending):
+                raise ValueError(f"Expected {len(pending)} results, got {len(results)}")
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            for (key, _), future in zip(pending, futures):
+                del self._in_flight[key]
+                if not future.done():
+                    future.cancel()
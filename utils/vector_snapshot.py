@@ -0,0 +1,461 @@
+"""
+Memory-mapped vector snapshots
+
+A snapshot of a vector cache, e.g. 'cache_vectors.pkl', is stored under 'cache_vectors/snapshot/<snapshot id>/':
+
+- 'keys.npy' the sorted cache keys, which are the on-disk hash index
+- 'vectors.npy' the vectors, in the order of the keys
+- 'texts.bin' the UTF-8 encoded texts, in the order of the keys
+- 'text_offsets.npy' the offsets of the texts in 'texts.bin'
+- 'negations.npy' for each row and each negation language, the row of the negated text, -1 if there is none
+
+'cache_vectors/snapshot.json' points to the current snapshot. A snapshot is downloaded once to the temp dir and opened
+with np.memmap, so a lookup only pages in the rows it touches.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import uuid
+
+import numpy as np
+from azure.core.exceptions import ResourceExistsError
+from azure.core.exceptions import ResourceModifiedError
+from azure.storage.blob import ContainerClient
+
+from .. import constants
+from . import cache_storage
+from .similarity import normalize
+
+snapshot_file_names = [
+    "keys.npy",
+    "vectors.npy",
+    "texts.bin",
+    "text_offsets.npy",
+    "negations.npy",
+]
+
+# The languages whose negation rules differ, see utils.negator
+negation_languages = ["en", "pt"]
+
+
+class VectorSnapshot:
+    """A read-only, memory-mapped snapshot of a vector cache"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.text_offsets = np.load(
+            os.path.join(path, "text_offsets.npy"), mmap_mode="r"
+        )
+        if os.path.getsize(os.path.join(path, "texts.bin")) > 0:
+            self.texts = np.memmap(
+                os.path.join(path, "texts.bin"), dtype=np.uint8, mode="r"
+            )
+        else:
+            self.texts = np.zeros(0, dtype=np.uint8)
+        if os.path.exists(os.path.join(path, "negations.npy")):
+            self.negations = np.load(os.path.join(path, "negations.npy"), mmap_mode="r")
+        else:
+            self.negations = np.full(
+                (len(self.keys), len(negation_languages)), -1, dtype=np.int64
+            )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def find_rows(self, keys: list[str]) -> np.ndarray:
+        """Find the rows of keys, -1 for keys that aren't in the snapshot"""
+
+        if len(keys) == 0 or len(self) == 0:
+            return np.full(len(keys), -1, dtype=np.intp)
+
+        query = np.array([key.encode() for key in keys])
+        rows = np.minimum(np.searchsorted(self.keys, query), len(self) - 1)
+        rows[self.keys[rows] != query] = -1
+
+        return rows
+
+    def find_row(self, key: str) -> int:
+        """Find the row of a key, -1 if the key isn't in the snapshot"""
+
+        return int(self.find_rows([key])[0])
+
+    def get_key(self, row: int) -> str:
+        """Get the key of a row"""
+
+        return self.keys[row].decode()
+
+    def get_text(self, row: int) -> str:
+        """Get the text of a row"""
+
+        return bytes(
+            self.texts[self.text_offsets[row] : self.text_offsets[row + 1]]
+        ).decode()
+
+    def get_negations(self, row: int) -> dict[str, str]:
+        """Get the keys of the negated texts of a row, by negation language"""
+
+        return {
+            language: self.get_key(negated_row)
+            for language, negated_row in zip(negation_languages, self.negations[row])
+            if negated_row >= 0
+        }
+
+
+def write_snapshot(
+    path: str,
+    keys: np.ndarray,
+    negations: np.ndarray,
+    get_vectors,
+    get_texts,
+    dim: int,
+    dtype: str,
+    chunk_size: int = 4096,
+):
+    """
+    Write a snapshot to a local folder
+    :param keys: the keys of the snapshot, sorted
+    :param negations: the rows of the negated texts of each row
+    :param get_vectors: a function that returns the vectors of a slice of the keys
+    :param get_texts: a function that returns the texts of a slice of the keys
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    np.save(os.path.join(path, "keys.npy"), keys)
+    np.save(os.path.join(path, "negations.npy"), negations)
+
+    vectors = np.lib.format.open_memmap(
+        os.path.join(path, "vectors.npy"),
+        mode="w+",
+        dtype=np.dtype(dtype),
+        shape=(len(keys), dim),
+    )
+    text_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    with open(os.path.join(path, "texts.bin"), "wb") as file:
+        for start in range(0, len(keys), chunk_size):
+            chunk = slice(start, min(start + chunk_size, len(keys)))
+            vectors[chunk] = get_vectors(chunk)
+            encoded_texts = [text.encode() for text in get_texts(chunk)]
+            text_offsets[chunk.start + 1 : chunk.stop + 1] = text_offsets[
+                chunk.start
+            ] + np.cumsum([len(encoded_text) for encoded_text in encoded_texts])
+            file.write(b"".join(encoded_texts))
+    vectors.flush()
+    del vectors
+
+    np.save(os.path.join(path, "text_offsets.npy"), text_offsets)
+
+
+def normalize_snapshot(path: str, chunk_size: int = 4096):
+    """Normalize the vectors of a snapshot that was written before vectors were normalized, in place"""
+
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r+")
+    for start in range(0, len(vectors), chunk_size):
+        vectors[start : start + chunk_size] = normalize(
+            vectors[start : start + chunk_size], dtype=vectors.dtype
+        )
+    vectors.flush()
+
+
+def get_manifest_blob_name(cache_file_name: str) -> str:
+    """Get the blob name of the manifest of the current snapshot"""
+
+    return f"{cache_storage.get_cache_folder(cache_file_name)}/snapshot.json"
+
+
+def get_snapshot_folder(cache_file_name: str, snapshot_id: str = "") -> str:
+    """Get the blob folder of (a) snapshot"""
+
+    folder = f"{cache_storage.get_cache_folder(cache_file_name)}/snapshot/"
+    if snapshot_id:
+        folder += f"{snapshot_id}/"
+
+    return folder
+
+
+def get_local_snapshot_path(cache_file_name: str, snapshot_id: str) -> str:
+    """Get the local path of a snapshot in the temp dir"""
+
+    return os.path.join(
+        tempfile.gettempdir(),
+        "harmonycache",
+        cache_storage.get_cache_folder(cache_file_name),
+        snapshot_id,
+    )
+
+
+def get_manifest(container: ContainerClient, cache_file_name: str) -> dict | None:
+    """Get the manifest of the current snapshot, None if there is no snapshot"""
+
+    return get_manifest_and_etag(container=container, cache_file_name=cache_file_name)[
+        0
+    ]
+
+
+def get_manifest_and_etag(
+    container: ContainerClient, cache_file_name: str
+) -> tuple[dict | None, str | None]:
+    """Get the manifest of the current snapshot with its ETag, (None, None) if there is no snapshot"""
+
+    try:
+        downloader = container.download_blob(
+            blob=get_manifest_blob_name(cache_file_name)
+        )
+        return json.loads(downloader.readall()), downloader.properties.etag
+    except (Exception,):
+        return None, None
+
+
+def download_snapshot(
+    container: ContainerClient, cache_file_name: str
+) -> VectorSnapshot | None:
+    """
+    Download the current snapshot to the temp dir, unless it was downloaded before, and open it
+    :return: the snapshot, None if there is no snapshot
+    """
+
+    manifest = get_manifest(container=container, cache_file_name=cache_file_name)
+    if not manifest:
+        return None
+
+    path = get_local_snapshot_path(cache_file_name, manifest["id"])
+    if not os.path.isdir(path):
+        logging.info(f"Downloading snapshot {manifest['id']} of {cache_file_name}")
+        partial_path = f"{path}.{uuid.uuid4().hex}.partial"
+        os.makedirs(partial_path)
+        for file_name in snapshot_file_names:
+            # Snapshots written before negations were cached have no negations
+            if file_name == "negations.npy" and not manifest.get("negations"):
+                continue
+            with open(os.path.join(partial_path, file_name), "wb") as file:
+                container.download_blob(
+                    blob=f"{get_snapshot_folder(cache_file_name, manifest['id'])}{file_name}"
+                ).readinto(file)
+        if not manifest.get("normalized"):
+            normalize_snapshot(partial_path)
+        try:
+            os.rename(partial_path, path)
+        except OSError:
+            # The snapshot was downloaded by another worker in the meantime
+            shutil.rmtree(partial_path, ignore_errors=True)
+
+        # Older snapshots can be removed, workers that still have them memory-mapped keep their pages
+        parent_path = os.path.dirname(path)
+        for name in os.listdir(parent_path):
+            if name != manifest["id"] and not name.endswith(".partial"):
+                shutil.rmtree(os.path.join(parent_path, name), ignore_errors=True)
+
+    return VectorSnapshot(path)
+
+
+def compact(container: ContainerClient, cache_file_name: str) -> int:
+    """
+    Merge the current snapshot and all other entries of a vector cache (log segments, shards, legacy single pickle)
+    into a new snapshot
+    :return: the number of entries merged into the snapshot
+    """
+
+    # The new snapshot only replaces the current snapshot if no other compaction replaced it in the meantime
+    _, manifest_etag = get_manifest_and_etag(
+        container=container, cache_file_name=cache_file_name
+    )
+    snapshot = download_snapshot(container=container, cache_file_name=cache_file_name)
+
+    entry_blob_names = [
+        blob.name
+        for blob in container.list_blobs(
+            name_starts_with=f"{cache_storage.get_cache_folder(cache_file_name)}/"
+        )
+        if not blob.name.startswith(get_snapshot_folder(cache_file_name))
+        and blob.name != get_manifest_blob_name(cache_file_name)
+    ]
+    entries = cache_storage.load_entries(
+        container=container, cache_file_name=cache_file_name, keep_tombstones=True
+    )
+    deleted_keys = np.array(
+        sorted(key for key, entry in entries.items() if entry is None), dtype=bytes
+    )
+    entries = cache_storage.remove_tombstones(entries)
+
+    # Entries that only add negations to an entry of the snapshot are completed from the snapshot
+    for key, entry in list(entries.items()):
+        if "vector" not in entry:
+            row = snapshot.find_row(key) if snapshot is not None else -1
+            if row < 0:
+                del entries[key]
+                continue
+            entries[key] = {
+                "text": snapshot.get_text(row),
+                "vector": snapshot.vectors[row],
+                "negations": {
+                    **snapshot.get_negations(row),
+                    **entry.get("negations", {}),
+                },
+            }
+
+    if not entries and len(deleted_keys) == 0:
+        return 0
+
+    new_keys = np.array(sorted(entries.keys()), dtype=bytes)
+    if snapshot is not None and len(snapshot) > 0:
+        old_rows = np.flatnonzero(
+            ~np.isin(snapshot.keys, new_keys) & ~np.isin(snapshot.keys, deleted_keys)
+        )
+        old_keys = snapshot.keys[old_rows]
+    else:
+        old_rows = np.zeros(0, dtype=np.intp)
+        old_keys = np.zeros(0, dtype=new_keys.dtype)
+
+    keys = np.concatenate([old_keys, new_keys])
+    order = np.argsort(keys, kind="stable")
+    new_entries = [entries[key.decode()] for key in new_keys]
+    if new_entries:
+        dim = len(new_entries[0]["vector"])
+    elif snapshot is not None:
+        dim = snapshot.dim
+    else:
+        return 0
+
+    # The keys of the negated texts, which are looked up again because the rows change
+    negation_keys = np.full((len(keys), len(negation_languages)), b"", dtype=keys.dtype)
+    if len(old_keys) > 0:
+        old_negations = np.asarray(snapshot.negations[old_rows])
+        has_negation = old_negations >= 0
+        negation_keys[: len(old_keys)][has_negation] = snapshot.keys[
+            old_negations[has_negation]
+        ]
+    for i, entry in enumerate(new_entries):
+        for language, negated_key in entry.get("negations", {}).items():
+            negation_keys[len(old_keys) + i, negation_languages.index(language)] = (
+                negated_key.encode()
+            )
+    sorted_keys = keys[order]
+    negation_keys = negation_keys[order]
+    negations = np.full(negation_keys.shape, -1, dtype=np.int64)
+    if len(sorted_keys) > 0:
+        negations = np.minimum(
+            np.searchsorted(sorted_keys, negation_keys), len(sorted_keys) - 1
+        )
+        negations[sorted_keys[negations] != negation_keys] = -1
+
+    def get_vectors(chunk: slice) -> np.ndarray:
+        positions = order[chunk]
+        vectors = np.empty((len(positions), dim), dtype=constants.VECTOR_STORE_DTYPE)
+        from_old = positions < len(old_keys)
+        if from_old.any():
+            vectors[from_old] = snapshot.vectors[old_rows[positions[from_old]]]
+        for i in np.flatnonzero(~from_old):
+            vectors[i] = new_entries[positions[i] - len(old_keys)]["vector"]
+        return normalize(vectors, dtype=constants.VECTOR_STORE_DTYPE)
+
+    def get_texts(chunk: slice) -> list[str]:
+        return [
+            (
+                snapshot.get_text(old_rows[position])
+                if position < len(old_keys)
+                else new_entries[position - len(old_keys)]["text"]
+            )
+            for position in order[chunk]
+        ]
+
+    # The snapshot is written to a partial folder until it is published, so a concurrent download doesn't remove it
+    snapshot_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+    path = get_local_snapshot_path(cache_file_name, snapshot_id)
+    partial_path = f"{path}.{uuid.uuid4().hex}.partial"
+    write_snapshot(
+        path=partial_path,
+        keys=sorted_keys,
+        negations=negations,
+        get_vectors=get_vectors,
+        get_texts=get_texts,
+        dim=dim,
+        dtype=constants.VECTOR_STORE_DTYPE,
+    )
+
+    for file_name in snapshot_file_names:
+        with open(os.path.join(partial_path, file_name), "rb") as file:
+            container.upload_blob(
+                name=f"{get_snapshot_folder(cache_file_name, snapshot_id)}{file_name}",
+                data=file,
+                overwrite=True,
+            )
+    try:
+        cache_storage.upload_blob_if_unchanged(
+            container=container,
+            blob_name=get_manifest_blob_name(cache_file_name),
+            data=json.dumps(
+                {
+                    "id": snapshot_id,
+                    "count": len(keys),
+                    "dim": dim,
+                    "dtype": constants.VECTOR_STORE_DTYPE,
+                    "normalized": True,
+                    "negations": True,
+                }
+            ),
+            etag=manifest_etag,
+        )
+    except (ResourceExistsError, ResourceModifiedError):
+        # The merged entries are kept, they are merged again by the next compaction
+        logging.warning(
+            f"The snapshot of {cache_file_name} changed while it was compacted, discarding snapshot {snapshot_id}"
+        )
+        for blob in list(
+            container.list_blobs(
+                name_starts_with=get_snapshot_folder(cache_file_name, snapshot_id)
+            )
+        ):
+            container.delete_blob(blob=blob.name)
+        shutil.rmtree(partial_path, ignore_errors=True)
+        return 0
+
+    try:
+        os.rename(partial_path, path)
+    except OSError:
+        # The snapshot was downloaded by another worker in the meantime
+        shutil.rmtree(partial_path, ignore_errors=True)
+
+    # The merged entries and older snapshots are not needed anymore, the previous snapshot is kept for workers that
+    # are still downloading it
+    previous_snapshot_ids = sorted(
+        {
+            blob.name[len(get_snapshot_folder(cache_file_name)) :].split("/", 1)[0]
+            for blob in container.list_blobs(
+                name_starts_with=get_snapshot_folder(cache_file_name)
+            )
+        }
+        - {snapshot_id}
+    )
+    obsolete_blob_names = entry_blob_names + [
+        blob.name
+        for obsolete_snapshot_id in previous_snapshot_ids[:-1]
+        for blob in container.list_blobs(
+            name_starts_with=get_snapshot_folder(cache_file_name, obsolete_snapshot_id)
+        )
+    ]
+    if cache_storage.has_legacy_cache(container, cache_file_name):
+        obsolete_blob_names.append(cache_file_name)
+    for blob_name in obsolete_blob_names:
+        try:
+            container.delete_blob(blob=blob_name)
+        except (Exception,):
+            logging.error(f"Could not delete blob {blob_name}")
+            logging.error(traceback.format_exc())
+
+    logging.info(
+        f"Merged {len(new_keys)} entries and {len(deleted_keys)} tombstones into snapshot {snapshot_id} of "
+        f"{cache_file_name}"
+    )
+
+    return len(new_keys)
@@ -0,0 +1,538 @@
+import heapq
+from typing import Iterator
+
+import numpy as np
+
+from .disk_cache import DiskCache
+from .disk_cache import apply_entries
+from .eviction import EvictionPolicy
+from .similarity import normalize
+from .vector_snapshot import VectorSnapshot
+from .vector_snapshot import negation_languages
+
+
+class VectorStore:
+    """
+    Vector store
+
+    All vectors are kept in one contiguous matrix. A hash -> row index and a separate text table point into it, so
+    a cached vector is never held as a list of Python floats.
+
+    Vectors are normalized to unit length when they are added, so a cosine similarity of stored vectors is a plain
+    matrix product.
+
+    A question can be linked to its negated text, by negation language, so the negation of a cached question doesn't
+    have to be computed again.
+
+    The store can be layered on top of a read-only, memory-mapped snapshot. Rows 0 to len(snapshot) - 1 are the rows
+    of the snapshot, the rows after that are the rows in memory.
+
+    The rows in memory are tracked by an eviction policy and can be evicted, which moves the last row in memory into
+    the evicted row. The pages of the snapshot are managed by the OS and don't count towards the budget.
+
+    With a disk tier, the entries that aren't in the snapshot are written through to the disk, and a vector that is
+    neither in memory nor in the snapshot is read from the disk and promoted to memory. A row evicted because the
+    store is over its budget stays on the disk, only expired rows are deleted from it.
+    """
+
+    def __init__(
+        self,
+        dtype: str = "float32",
+        capacity: int = 1024,
+        snapshot: VectorSnapshot | None = None,
+        policy: EvictionPolicy | None = None,
+        disk: DiskCache | None = None,
+    ):
+        self.dtype = np.dtype(dtype)
+        self.snapshot = snapshot
+        self.policy = policy if policy is not None else EvictionPolicy()
+        self.disk = disk
+        self._capacity = capacity
+        self._matrix: np.ndarray | None = None
+        self._index: dict[str, int] = {}
+        self._hashes: list[str] = []
+        self._texts: list[str] = []
+        self._negations: dict[tuple[str, str], str] = {}
+        self._text_nbytes = 0
+
+    def __len__(self) -> int:
+        return self._n_snapshot_rows + len(self._hashes)
+
+    def __contains__(self, hash_value: str) -> bool:
+        return self.get_row(hash_value) is not None
+
+    def __getstate__(self) -> dict:
+        hash_values = [hash_value for hash_value, _, _ in self.items()]
+        return {
+            "dtype": self.dtype.str,
+            "hashes": hash_values,
+            "texts": [text for _, text, _ in self.items()],
+            "vectors": self.get_vectors(hash_values),
+        }
+
+    def __setstate__(self, state: dict):
+        self.__init__(dtype=state["dtype"], capacity=max(len(state["hashes"]), 1))
+        self.add_many(
+            hash_values=state["hashes"], texts=state["texts"], vectors=state["vectors"]
+        )
+
+    @property
+    def _n_snapshot_rows(self) -> int:
+        return 0 if self.snapshot is None else len(self.snapshot)
+
+    @property
+    def _memory_vectors(self) -> np.ndarray:
+        if self._matrix is None:
+            return np.zeros((0, self.dim), dtype=self.dtype)
+
+        return self._matrix[: len(self._hashes)]
+
+    @property
+    def dim(self) -> int:
+        """The dimension of the vectors, 0 if the store is empty"""
+
+        if self._matrix is not None:
+            return self._matrix.shape[1]
+        if self._n_snapshot_rows > 0:
+            return self.snapshot.dim
+
+        return 0
+
+    @property
+    def nbytes(self) -> int:
+        """The number of bytes used by the vector matrix and the texts in memory"""
+
+        matrix_nbytes = 0 if self._matrix is None else self._matrix.nbytes
+
+        return matrix_nbytes + self._text_nbytes
+
+    def _reserve(self, n_rows: int, dim: int):
+        """Make sure the matrix in memory has room for n_rows rows"""
+
+        if self.dim and dim != self.dim:
+            raise ValueError(f"Expected vectors of dimension {self.dim}, got {dim}")
+
+        if self._matrix is None:
+            self._matrix = np.empty(
+                (max(self._capacity, n_rows), dim), dtype=self.dtype
+            )
+        elif n_rows > self._matrix.shape[0]:
+            matrix = np.empty(
+                (max(self._matrix.shape[0] * 2, n_rows), dim), dtype=self.dtype
+            )
+            matrix[: len(self._hashes)] = self._memory_vectors
+            self._matrix = matrix
+
+    def add(self, hash_value: str, text: str, vector) -> int:
+        """Add a vector and return its row"""
+
+        return self.add_many(hash_values=[hash_value], texts=[text], vectors=[vector])[
+            0
+        ]
+
+    def add_many(self, hash_values: list[str], texts: list[str], vectors) -> list[int]:
+        """Add vectors and return their rows, vectors that are in the snapshot already are not added again"""
+
+        rows = self._add_rows(hash_values=hash_values, texts=texts, vectors=vectors)
+
+        # Write the vectors through to the disk
+        if self.disk is not None:
+            self.disk.put_many(
+                {
+                    hash_value: {
+                        "text": self._texts[row - self._n_snapshot_rows],
+                        "vector": np.array(self._matrix[row - self._n_snapshot_rows]),
+                    }
+                    for hash_value, row in zip(hash_values, rows)
+                    if row >= self._n_snapshot_rows
+                }
+            )
+
+        return rows
+
+    def _add_rows(self, hash_values: list[str], texts: list[str], vectors) -> list[int]:
+        """Add vectors to memory and return their rows"""
+
+        vectors = normalize(vectors, dtype=self.dtype)
+        if len(hash_values) == 0:
+            return []
+        if vectors.ndim != 2 or vectors.shape[0] != len(hash_values):
+            raise ValueError("Expected one vector per hash value")
+
+        self._reserve(n_rows=len(self._hashes) + len(hash_values), dim=vectors.shape[1])
+
+        rows = []
+        for hash_value, text, vector in zip(hash_values, texts, vectors):
+            row = self._index.get(hash_value)
+            if row is None and self._n_snapshot_rows > 0:
+                row = self.snapshot.find_row(hash_value)
+                if row < 0:
+                    row = None
+            if row is None:
+                row = self._n_snapshot_rows + len(self._hashes)
+                self._index[hash_value] = row
+                self._hashes.append(hash_value)
+                self._texts.append(text)
+                text_nbytes = len(text.encode())
+                self._text_nbytes += text_nbytes
+                self.policy.add(
+                    hash_value, vectors.shape[1] * self.dtype.itemsize + text_nbytes
+                )
+            if row >= self._n_snapshot_rows:
+                self._matrix[row - self._n_snapshot_rows] = vector
+            rows.append(row)
+
+        return rows
+
+    def _promote(self, hash_values: list[str]) -> dict[str, int]:
+        """Read vectors from the disk into memory and return their rows"""
+
+        if self.disk is None or len(hash_values) == 0:
+            return {}
+
+        entries = self.disk.get_many(hash_values)
+        with_vectors = {k: v for k, v in entries.items() if "vector" in v}
+        rows = self._add_rows(
+            hash_values=list(with_vectors.keys()),
+            texts=[v["text"] for v in with_vectors.values()],
+            vectors=[v["vector"] for v in with_vectors.values()],
+        )
+        for hash_value, entry in with_vectors.items():
+            for language, negated_hash_value in entry.get("negations", {}).items():
+                self._negations[(language, hash_value)] = negated_hash_value
+
+        return dict(zip(with_vectors.keys(), rows))
+
+    def get_row(self, hash_value: str) -> int | None:
+        """Get the row of a hash value"""
+
+        row = self._index.get(hash_value)
+        if row is not None:
+            self.policy.touch(hash_value)
+        elif self._n_snapshot_rows > 0:
+            row = self.snapshot.find_row(hash_value)
+            if row < 0:
+                row = None
+        if row is None:
+            row = self._promote([hash_value]).get(hash_value)
+
+        return row
+
+    def get_rows(self, hash_values: list[str]) -> np.ndarray:
+        """Get the rows of hash values, -1 for hash values that aren't stored"""
+
+        rows = np.fromiter(
+            (self._index.get(hash_value, -1) for hash_value in hash_values),
+            dtype=np.intp,
+            count=len(hash_values),
+        )
+        for i in np.flatnonzero(rows >= 0):
+            self.policy.touch(hash_values[i])
+        if self._n_snapshot_rows > 0:
+            not_in_memory = np.flatnonzero(rows < 0)
+            rows[not_in_memory] = self.snapshot.find_rows(
+                [hash_values[i] for i in not_in_memory]
+            )
+        if self.disk is not None:
+            not_found = np.flatnonzero(rows < 0)
+            promoted = self._promote([hash_values[i] for i in not_found])
+            for i in not_found:
+                rows[i] = promoted.get(hash_values[i], -1)
+
+        return rows
+
+    def get_many(self, hash_values: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Look up hash values at once
+        :return: the rows of the hash values in their order, -1 for the hash values that aren't stored, and the
+            positions of the hash values that aren't stored
+        """
+
+        rows = self.get_rows(hash_values)
+
+        return rows, np.flatnonzero(rows < 0)
+
+    def get_text(self, hash_value: str) -> str:
+        """Get the text of a hash value"""
+
+        row = self.get_row(hash_value)
+        if row is None:
+            raise KeyError(hash_value)
+        if row < self._n_snapshot_rows:
+            return self.snapshot.get_text(row)
+
+        return self._texts[row - self._n_snapshot_rows]
+
+    def peek_text(self, hash_value: str) -> str | None:
+        """
+        Get the text of a hash value, None if it isn't stored. Unlike get_text, it isn't an access of the row and
+        doesn't promote the row from the disk to memory
+        """
+
+        row = self._index.get(hash_value)
+        if row is not None:
+            return self._texts[row - self._n_snapshot_rows]
+        if self._n_snapshot_rows > 0:
+            row = self.snapshot.find_row(hash_value)
+            if row >= 0:
+                return self.snapshot.get_text(row)
+        if self.disk is not None:
+            entry = self.disk.get(hash_value)
+            if entry is not None and "vector" in entry:
+                return entry["text"]
+
+        return None
+
+    def get_vector(self, hash_value: str) -> np.ndarray:
+        """Get a view of the vector of a hash value"""
+
+        row = self.get_row(hash_value)
+        if row is None:
+            raise KeyError(hash_value)
+        if row < self._n_snapshot_rows:
+            return self.snapshot.vectors[row]
+
+        return self._matrix[row - self._n_snapshot_rows]
+
+    def set_negation(self, hash_value: str, language: str, negated_hash_value: str):
+        """Link a hash value to the hash value of its negated text in a negation language"""
+
+        self._negations[(language, hash_value)] = negated_hash_value
+        if self.disk is not None:
+            apply_entries(
+                self.disk, {hash_value: {"negations": {language: negated_hash_value}}}
+            )
+
+    def get_negation(self, hash_value: str, language: str) -> str | None:
+        """Get the hash value of the negated text of a hash value in a negation language, None if it isn't linked"""
+
+        return self.get_negations(hash_value).get(language)
+
+    def get_negations(self, hash_value: str) -> dict[str, str]:
+        """Get the hash values of the negated texts of a hash value, by negation language"""
+
+        negations = {}
+        if self._n_snapshot_rows > 0:
+            row = self.snapshot.find_row(hash_value)
+            if row >= 0:
+                negations = self.snapshot.get_negations(row)
+        if self.disk is not None and hash_value not in self._index:
+            negations.update(self.disk.get(hash_value, {}).get("negations", {}))
+        for language in negation_languages:
+            negated_hash_value = self._negations.get((language, hash_value))
+            if negated_hash_value is not None:
+                negations[language] = negated_hash_value
+
+        return negations
+
+    def evict(self, hash_values: list[str]):
+        """Evict rows in memory, the rows of the snapshot can't be evicted"""
+
+        for hash_value in hash_values:
+            row = self._index.pop(hash_value, None)
+            if row is None:
+                continue
+            self.policy.remove(hash_value)
+            self._text_nbytes -= len(self._texts[row - self._n_snapshot_rows].encode())
+            for language in negation_languages:
+                self._negations.pop((language, hash_value), None)
+
+            # Move the last row in memory into the evicted row
+            local_row = row - self._n_snapshot_rows
+            last_row = len(self._hashes) - 1
+            if local_row != last_row:
+                self._matrix[local_row] = self._matrix[last_row]
+                self._hashes[local_row] = self._hashes[last_row]
+                self._texts[local_row] = self._texts[last_row]
+                self._index[self._hashes[local_row]] = row
+            self._hashes.pop()
+            self._texts.pop()
+
+    def apply_entries(self, entries: dict):
+        """
+        Apply newer cache entries of {hash: {"text": ..., "vector": [...], "negations": {...}}}, e.g. entries pulled
+        from other instances. A tombstone (None) evicts its row from memory, the rows of the snapshot can't be evicted.
+        """
+
+        self.evict(
+            [hash_value for hash_value, entry in entries.items() if entry is None]
+        )
+
+        new_entries = {
+            hash_value: entry
+            for hash_value, entry in entries.items()
+            if entry is not None and "vector" in entry and hash_value not in self
+        }
+        self.add_many(
+            hash_values=list(new_entries.keys()),
+            texts=[entry["text"] for entry in new_entries.values()],
+            vectors=[entry["vector"] for entry in new_entries.values()],
+        )
+        for hash_value, entry in entries.items():
+            if entry is None:
+                continue
+            for language, negated_hash_value in entry.get("negations", {}).items():
+                self.set_negation(hash_value, language, negated_hash_value)
+
+    def trim(self) -> list[str]:
+        """
+        Evict the rows selected by the eviction policy
+        :return: the hash values of the rows that were deleted, not only evicted from memory
+        """
+
+        expired = set(self.policy.select_expired())
+        evicted = self.policy.select()
+        self.evict(evicted)
+
+        if self.disk is None:
+            return evicted
+
+        deleted = [hash_value for hash_value in evicted if hash_value in expired]
+        self.disk.delete_many(deleted)
+
+        return deleted
+
+    def gather(self, rows: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+        """Gather the vectors of rows into one matrix"""
+
+        if out is None:
+            out = np.empty((len(rows), self.dim), dtype=self.dtype)
+
+        in_snapshot = rows < self._n_snapshot_rows
+        if in_snapshot.any():
+            out[in_snapshot] = self.snapshot.vectors[rows[in_snapshot]]
+        if not in_snapshot.all():
+            out[~in_snapshot] = self._memory_vectors[
+                rows[~in_snapshot] - self._n_snapshot_rows
+            ]
+
+        return out
+
+    def get_vectors(self, hash_values: list[str]) -> np.ndarray:
+        """Gather the vectors of hash values into one matrix"""
+
+        rows = self.get_rows(hash_values)
+        if (rows < 0).any():
+            raise KeyError(hash_values[int(np.flatnonzero(rows < 0)[0])])
+
+        return self.gather(rows)
+
+    def _iter_disk_sorted(
+        self, after: str | None = None
+    ) -> Iterator[tuple[str, str, np.ndarray]]:
+        """Iterate over (hash value, text, vector) of the vectors on the disk by ascending hash value"""
+
+        for hash_value, entry in self.disk.iter_sorted(after=after):
+            if "vector" in entry:
+                yield hash_value, entry["text"], normalize(
+                    [entry["vector"]], dtype=self.dtype
+                )[0]
+
+    def items(self) -> Iterator[tuple[str, str, np.ndarray]]:
+        """Iterate over (hash value, text, vector)"""
+
+        for row in range(self._n_snapshot_rows):
+            yield self.snapshot.get_key(row), self.snapshot.get_text(
+                row
+            ), self.snapshot.vectors[row]
+
+        if self.disk is not None:
+            yield from self._iter_disk_sorted()
+            return
+
+        vectors = self._memory_vectors
+        for row, (hash_value, text) in enumerate(zip(self._hashes, self._texts)):
+            yield hash_value, text, vectors[row]
+
+    def iter_sorted(
+        self, after: str | None = None
+    ) -> Iterator[tuple[str, str, np.ndarray]]:
+        """
+        Iterate over (hash value, text, vector) by ascending hash value, starting after a hash value. The order doesn't
+        depend on when vectors were added, so the iteration can be resumed by another instance.
+        """
+
+        start = 0
+        if self._n_snapshot_rows > 0 and after is not None:
+            start = int(
+                np.searchsorted(self.snapshot.keys, after.encode(), side="right")
+            )
+        snapshot_items = (
+            (
+                self.snapshot.get_key(row),
+                self.snapshot.get_text(row),
+                self.snapshot.vectors[row],
+            )
+            for row in range(start, self._n_snapshot_rows)
+        )
+        if self.disk is not None:
+            other_items = self._iter_disk_sorted(after=after)
+        else:
+            vectors = self._memory_vectors
+            other_items = (
+                (hash_value, self._texts[row], vectors[row])
+                for hash_value, row in sorted(
+                    (hash_value, row)
+                    for row, hash_value in enumerate(self._hashes)
+                    if after is None or hash_value > after
+                )
+            )
+
+        # A vector on the disk may have been compacted into the snapshot since the snapshot was loaded
+        previous_hash_value = None
+        for hash_value, text, vector in heapq.merge(
+            snapshot_items, other_items, key=lambda item: item[0]
+        ):
+            if hash_value != previous_hash_value:
+                yield hash_value, text, vector
+            previous_hash_value = hash_value
+
+    def to_dict(self, hash_values: list[str] | None = None) -> dict:
+        """Get {hash: {"text": ..., "vector": ...}} of (some of) the stored vectors"""
+
+        if hash_values is None:
+            hash_values = [hash_value for hash_value, _, _ in self.items()]
+
+        entries = {}
+        for hash_value in hash_values:
+            entries[hash_value] = {
+                "text": self.get_text(hash_value),
+                "vector": np.array(self.get_vector(hash_value), dtype=self.dtype),
+            }
+            negations = self.get_negations(hash_value)
+            if negations:
+                entries[hash_value]["negations"] = negations
+
+        return entries
+
+    @classmethod
+    def from_dict(
+        cls,
+        cache: dict,
+        dtype: str = "float32",
+        snapshot: VectorSnapshot | None = None,
+        policy: EvictionPolicy | None = None,
+    ) -> "VectorStore":
+        """
+        Create a vector store from a cache dict of {hash: {"text": ..., "vector": [...], "negations": {...}}} (on top of
+        a snapshot). An entry may only hold "negations", if its vector is in the snapshot.
+        """
+
+        with_vectors = {k: v for k, v in cache.items() if "vector" in v}
+
+        store = cls(
+            dtype=dtype,
+            capacity=max(len(with_vectors), 1),
+            snapshot=snapshot,
+            policy=policy,
+        )
+        store.add_many(
+            hash_values=list(with_vectors.keys()),
+            texts=[v["text"] for v in with_vectors.values()],
+            vectors=[v["vector"] for v in with_vectors.values()],
+        )
+        for hash_value, entry in cache.items():
+            for language, negated_hash_value in entry.get("negations", {}).items():
+                store.set_negation(hash_value, language, negated_hash_value)
+
+        return store